@@ -0,0 +1,196 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import tensorflow as tf
+from app.predict import predict_students
+from app.registry import LoadedModel
+from app.mems_cache import MemsCache
+
+
+class BatcherFull(Exception):
+    pass
+
+
+class BatcherStopped(Exception):
+    pass
+
+
+class MicroBatcher:
+    '''
+    Async queue in front of predict_students. The students submitted within window_ms (or the first max_students of
+    them) are predicted together, a lane each, and every request gets back its own predictions.
+    max_queue is the admission limit: submit raises BatcherFull when that many students are already waiting, in the
+    queue or for the lock of their student.
+    workers batches run at the same time, each on a thread of the bounded executor; the next batch is collected only
+    when a worker is free, so the students keep gathering in the queue meanwhile.
+    With a MemsCache the lane of a student goes on from its cached mems and only runs its new interactions.
+    The requests of one student (model version, uid) run one at a time: the next one waits before the queue, so it
+    starts from the mems the previous one cached and two workers never predict and cache the same student at once.
+    '''
+    def __init__(self, max_students=16, window_ms=5.0, max_queue=256, cache : MemsCache = None, workers=1):
+        self.max_students = max_students
+        self.window = window_ms / 1000
+        self.max_queue = max_queue
+        self.cache = cache
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="micro-batch")
+        self.queue = None
+        self._task = None
+        self._slots = None
+        self._batches = set()
+        # (version, uid) => (lock, requests holding or waiting for it), used from the event loop only
+        self._students = {}
+        # requests waiting for the lock of their student, they go in the queue after it
+        self._waiting = 0
+
+    def start(self):
+        # the queue belongs to the running event loop, so it is made here and not in __init__
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.workers)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._batches:
+            await asyncio.gather(*self._batches, return_exceptions=True)
+        while self.queue is not None and not self.queue.empty():
+            _, _, future, _, _ = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(BatcherStopped("the server is stopping"))
+        self.executor.shutdown(wait=True)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def qsize(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, entry : LoadedModel, uid, question_list, concepts_list, responses_list, timings=None) -> list:
+        '''
+        timings: a dict that gets the queue and batch time (seconds) of this request
+        '''
+        if not self.running:
+            raise BatcherStopped("the batcher is not running")
+        if self._waiting + self.qsize() >= self.max_queue:
+            raise BatcherFull(f"{self.max_queue} students are already waiting")
+        async with self._student(entry.version, uid):
+            if not self.running:
+                raise BatcherStopped("the batcher is not running")
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            try:
+                self.queue.put_nowait((entry, (uid, question_list, concepts_list, responses_list), future, loop.time(),
+                                       timings if timings is not None else {}))
+            except asyncio.QueueFull:
+                raise BatcherFull(f"{self.max_queue} students are already waiting")
+            return await future
+
+    @contextlib.asynccontextmanager
+    async def _student(self, version, uid):
+        key = (version, uid)
+        lock, users = self._students.get(key, (None, 0))
+        lock = lock if lock is not None else asyncio.Lock()
+        self._students[key] = (lock, users + 1)
+        try:
+            self._waiting += 1
+            try:
+                await lock.acquire()
+            finally:
+                self._waiting -= 1
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            lock, users = self._students[key]
+            if users == 1:
+                del self._students[key]
+            else:
+                self._students[key] = (lock, users - 1)
+
+    async def _collect(self) -> list:
+        batch = []
+        try:
+            batch.append(await self.queue.get())
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_students:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # stop() cancelled the collection, the students taken from the queue are not predicted
+            for _, _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(BatcherStopped("the server is stopping"))
+            raise
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            task = loop.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch : list):
+        loop = asyncio.get_running_loop()
+        try:
+            # the requests pinned to another model version make their own batch
+            by_version = {}
+            for request in batch:
+                by_version.setdefault(id(request[0]), []).append(request)
+            for requests in by_version.values():
+                entry = requests[0][0]
+                start = loop.time()
+                for _, _, _, submitted, timings in requests:
+                    timings["queue"] = start - submitted
+                try:
+                    predictions = await loop.run_in_executor(
+                        self.executor, self._predict, entry, [student for _, student, _, _, _ in requests])
+                except Exception as e:
+                    for _, _, future, _, _ in requests:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, _, future, _, timings), prediction in zip(requests, predictions):
+                    timings["batch"] = loop.time() - start
+                    if not future.done():
+                        future.set_result(prediction)
+        finally:
+            self._slots.release()
+
+    def _predict(self, entry : LoadedModel, students : list) -> list:
+        histories = [student[1:] for student in students]
+        if self.cache is None:
+            with tf.device(entry.device):
+                return predict_students(entry.model, entry.config, histories)
+        states = [self.cache.get(entry.version, uid, *history) for uid, *history in students]
+        with tf.device(entry.device):
+            predictions, states = predict_students(entry.model, entry.config, histories, states, return_states=True)
+        for (uid, *history), (pos, mems, state_predictions) in zip(students, states):
+            if pos > 0:
+                self.cache.put(entry.version, uid, *history, pos, mems, state_predictions)
+        return predictions
@@ -0,0 +1,87 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import numpy as np
+import pandas as pd
+import pytest
+import tensorflow as tf
+from transformers import TransfoXLConfig
+from models.model_for_kt import TFTransfoXLMLMHeadModel
+from preprocess.data_utils import get_evalmask_token
+import app.predict
+from app.registry import ModelRegistry
+
+
+def save_checkpoint(ckpt_dir, seed):
+    config = TransfoXLConfig(d_embed=32, d_head=8, d_model=32, d_inner=64, mem_len=16, tgt_len=8, n_head=4, n_layer=2,
+                             C_vocab_size=50, Q_vocab_size=50, R_vocab_size=2, mode="concepts", mask_token=3, eos_token=2,
+                             dropout=0.0, dropatt=0.0)
+    tf.random.set_seed(seed)
+    model = TFTransfoXLMLMHeadModel(config)
+    dummy = tf.fill([1, config.tgt_len], config.mask_token)
+    model(concepts=dummy, responses=dummy)
+    config.save_pretrained(ckpt_dir)
+    model.save_weights(os.path.join(ckpt_dir, "my_checkpoint"))
+    return ckpt_dir
+
+
+@pytest.fixture(scope="session")
+def model_root(tmp_path_factory):
+    '''
+    A dir with two small checkpoints, ckpt_a and ckpt_b
+    '''
+    root = tmp_path_factory.mktemp("models")
+    save_checkpoint(str(root / "ckpt_a"), 0)
+    save_checkpoint(str(root / "ckpt_b"), 1)
+    return str(root)
+
+
+@pytest.fixture(scope="session")
+def entry(model_root):
+    '''
+    The LoadedModel of ckpt_a, version "a"
+    '''
+    return ModelRegistry().load("a", os.path.join(model_root, "ckpt_a"))
+
+
+@pytest.fixture(scope="session")
+def log_csv(tmp_path_factory):
+    '''
+    The idx log csv of /predict, 12 students of 5 ~ 40 interactions
+    '''
+    rng = np.random.default_rng(0)
+    rows = []
+    for uid in range(12):
+        n = int(rng.integers(5, 41))
+        rows.append({"uid": uid, "questions": ",".join(map(str, rng.integers(4, 50, n))),
+                     "concepts": ",".join(map(str, rng.integers(4, 50, n))),
+                     "responses": ",".join(map(str, rng.integers(0, 2, n)))})
+    path = str(tmp_path_factory.mktemp("logs") / "students.csv")
+    pd.DataFrame(rows).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture(scope="session")
+def students(log_csv):
+    '''
+    uid => (question_list, concepts_list, responses_list) of the log csv, read with pandas
+    '''
+    df = pd.read_csv(log_csv)
+    return {row.uid: tuple([int(v) for v in getattr(row, key).split(",")] for key in ["questions", "concepts", "responses"])
+            for row in df.itertuples()}
+
+
+@pytest.fixture
+def seeded_eval_mask(monkeypatch):
+    # the eval mask of a history only depends on it, so two runs over the same history draw the same mask
+    monkeypatch.setattr(app.predict, "get_evalmask_token",
+                        lambda R, mask_token, eos_token: get_evalmask_token(R, mask_token, eos_token, seed=len(R)))
+
+
+@pytest.fixture
+def no_eval_mask(monkeypatch):
+    # nothing masked, the predictions of a history do not depend on where a run starts
+    monkeypatch.setattr(app.predict, "get_evalmask_token",
+                        lambda R, mask_token, eos_token: (np.asarray(R, dtype=np.int32), np.full(len(R), -100, dtype=np.int32)))
@@ -4,32 +4,156 @@ current_directory = os.path.dirname(os.path.abspath(__file__))
 parent_directory = os.path.dirname(current_directory)
 sys.path.append(parent_directory)
 
-from fastapi import FastAPI
-from pydantic import BaseModel
-from app.predict import predict_pipline
+import asyncio
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import tensorflow as tf
+from fastapi import FastAPI, HTTPException, Response
+from pydantic import BaseModel, field_validator
+from typing import Optional
+from app.predict import read_student, write_predictions, DEFAULT_CKPT_DIR, BASE_DIR
 from app.predict import __version__ as model_version
+from app.registry import registry
+from app.batching import MicroBatcher, BatcherFull, BatcherStopped
+from app.mems_cache import MemsCache
+from app.metrics import StageMetrics, server_timing
+from app.student_logs import UnknownStudent
 import argparse
 import uvicorn
 
 
+# TF_INTRA_OP_THREADS / TF_INTER_OP_THREADS set the TF thread pools (0: TF default, all the cores), before any op runs
+intra_op_threads = int(os.environ.get("TF_INTRA_OP_THREADS", 0))
+inter_op_threads = int(os.environ.get("TF_INTER_OP_THREADS", 0))
+tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
 app = FastAPI()
+metrics = StageMetrics()
+# csv read and write of the requests, off the event loop and off the model threads
+io_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("IO_WORKERS", 4)), thread_name_prefix="predict-io")
+# the mems of each student, MEMS_CACHE_MB in memory and the rest in MEMS_CACHE_DIR if set
+mems_cache = MemsCache(max_bytes=int(os.environ.get("MEMS_CACHE_MB", 1024)) << 20,
+                       spill_dir=os.environ.get("MEMS_CACHE_DIR"))
+# BATCH_MAX_STUDENTS students per batch, waiting at most BATCH_WINDOW_MS, BATCH_MAX_QUEUE students admitted.
+# One batch uses the intra-op threads, so the batches run one at a time unless TF_INTER_OP_THREADS allows more
+batcher = MicroBatcher(max_students=int(os.environ.get("BATCH_MAX_STUDENTS", 16)),
+                       window_ms=float(os.environ.get("BATCH_WINDOW_MS", 5)),
+                       max_queue=int(os.environ.get("BATCH_MAX_QUEUE", 256)), cache=mems_cache,
+                       workers=max(1, inter_op_threads))
+
+# POST /models only loads the checkpoint dirs under MODEL_ROOT
+model_root = os.path.realpath(os.environ.get("MODEL_ROOT", os.path.join(BASE_DIR, "save_model")))
 
 class StudentLogPath(BaseModel):
     Path : str
     uid : int
     devices : str
+    version : Optional[str] = None
 
 
 class PredictionOut(BaseModel):
     output_path : str
+    model_version : str
+
+
+class ModelCheckpoint(BaseModel):
+    version : str
+    ckpt_dir : str
+    devices : str = "cpu"
+
+    @field_validator("version")
+    @classmethod
+    def version_name(cls, version):
+        # the version names a dir of MEMS_CACHE_DIR, so it is a plain file name (422 otherwise)
+        if not re.fullmatch(r"[A-Za-z0-9._-]+", version) or ".." in version:
+            raise ValueError("version must match [A-Za-z0-9._-]+ and not contain ..")
+        return version
+
+
+@app.on_event("startup")
+async def load_default_model():
+    # MODEL_CKPT_DIR / MODEL_VERSION select the checkpoint served from the start
+    registry.load(os.environ.get("MODEL_VERSION", model_version), os.environ.get("MODEL_CKPT_DIR", DEFAULT_CKPT_DIR))
+    batcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await batcher.stop()
+    io_executor.shutdown(wait=True)
+
 
 @app.get("/")
 def home():
-    return {"Status" : "OK", "model_version": model_version}
+    return {"Status" : "OK", "model_version": registry.active_version, "loaded_versions": registry.versions(),
+            "mems_cache": {"students": len(mems_cache), "hits": mems_cache.hits, "misses": mems_cache.misses}}
 
-@app.post("/predict", response_model=PredictionOut)
-def predict(payload : StudentLogPath):
-    out_path =predict_pipline(payload.Path, payload.uid, payload.devices)
-    return {"output_path": out_path}
+@app.get("/metrics")
+def get_metrics():
+    return {**metrics.snapshot(), "queued_students": batcher.qsize()}
 
+@app.post("/predict", response_model=PredictionOut)
+async def predict(payload : StudentLogPath, response : Response):
+    try:
+        # the request keeps this model even if another version is activated meanwhile
+        entry = registry.get(payload.version)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    loop = asyncio.get_running_loop()
+    timings = {}
+    start = time.perf_counter()
+    try:
+        if not batcher.running:
+            raise BatcherStopped("the server is not serving")
+        question_list, concepts_list, responses_list = await loop.run_in_executor(
+            io_executor, read_student, payload.Path, payload.uid, False, entry.vocab_path)
+        timings["read"] = time.perf_counter() - start
+        # predicted together with the other students of the same few ms, on entry.device
+        predictions = await batcher.submit(entry, payload.uid, question_list, concepts_list, responses_list, timings)
+        write_start = time.perf_counter()
+        out_path = await loop.run_in_executor(io_executor, write_predictions, payload.uid, question_list, concepts_list, predictions)
+        timings["write"] = time.perf_counter() - write_start
+    except BatcherFull as e:
+        metrics.reject(429)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    except BatcherStopped as e:
+        metrics.reject(503)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except UnknownStudent as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=422, detail=f"{payload.Path} does not exist")
+    except Exception:
+        # the error stays in the server log, the client only gets the status
+        logging.exception("predict of uid %s failed", payload.uid)
+        raise HTTPException(status_code=500, detail="internal error")
+    timings["total"] = time.perf_counter() - start
+    metrics.record(timings)
+    response.headers["Server-Timing"] = server_timing(timings)
+    return {"output_path": out_path, "model_version": entry.version}
 
+@app.post("/models")
+def load_model(payload : ModelCheckpoint):
+    '''
+    Load, warm and activate a checkpoint, the requests in flight finish on the previous model
+    '''
+    # a relative ckpt_dir is taken from MODEL_ROOT, the symlinks and .. are resolved before the check
+    ckpt_dir = os.path.realpath(os.path.join(model_root, payload.ckpt_dir))
+    if os.path.commonpath([ckpt_dir, model_root]) != model_root:
+        raise HTTPException(status_code=403, detail=f"ckpt_dir {payload.ckpt_dir} is not under the model root")
+    previous = registry.active_version
+    device = "/cpu:0" if payload.devices == "cpu" else "/gpu:0"
+    try:
+        registry.load(payload.version, ckpt_dir, device)
+    except Exception:
+        logging.exception("loading %s from %s failed", payload.version, ckpt_dir)
+        raise HTTPException(status_code=422, detail=f"cannot load a model from {payload.ckpt_dir}")
+    # the mems of the version were made by the checkpoint it had before, even when it is loaded again
+    mems_cache.drop_version(payload.version)
+    if previous is not None and previous != payload.version:
+        registry.unload(previous)
+        mems_cache.drop_version(previous)
+    return {"model_version": registry.active_version, "previous_version": previous}
@@ -0,0 +1,141 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+
+
+@dataclass
+class StudentState:
+    '''
+    The mems after the first pos interactions of a student (pos a multiple of tgt_len) and their predictions
+    '''
+    pos : int
+    mems : np.ndarray
+    predictions : list
+    digest : bytes
+
+    @property
+    def nbytes(self) -> int:
+        return self.mems.nbytes + 8 * len(self.predictions)
+
+
+def history_digest(question_list, concepts_list, responses_list, pos) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for values in (question_list, concepts_list, responses_list):
+        h.update(np.asarray(values[:pos], dtype=np.int64).tobytes())
+    return h.digest()
+
+
+class MemsCache:
+    '''
+    The last StudentState of each (model version, uid), so a request only runs the interactions after it.
+    The least recently used states are evicted beyond max_bytes, to spill_dir/{version}/{uid}.npz if spill_dir is set,
+    and read back from there on the next request of the student. A state is used only if the history of the request
+    starts with the same pos interactions.
+    '''
+    def __init__(self, max_bytes=1 << 30, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, uid, question_list, concepts_list, responses_list):
+        with self._lock:
+            state = self._states.get((version, uid))
+            if state is not None:
+                self._states.move_to_end((version, uid))
+        spilled = False
+        if state is None:
+            state = self._load_spilled(version, uid)
+            spilled = state is not None
+        hit = state is not None and state.pos <= len(responses_list) and \
+            state.digest == history_digest(question_list, concepts_list, responses_list, state.pos)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit and spilled:
+            # back in memory, the next request of the student does not read the npz again
+            self._insert(version, uid, state)
+        return state if hit else None
+
+    def put(self, version, uid, question_list, concepts_list, responses_list, pos, mems, predictions):
+        state = StudentState(pos, np.asarray(mems), list(predictions[:pos]),
+                             history_digest(question_list, concepts_list, responses_list, pos))
+        self._insert(version, uid, state)
+
+    def _insert(self, version, uid, state):
+        evicted = []
+        with self._lock:
+            previous = self._states.pop((version, uid), None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._states[(version, uid)] = state
+            self._bytes += state.nbytes
+            while self._bytes > self.max_bytes and len(self._states) > 1:
+                key, old = self._states.popitem(last=False)
+                self._bytes -= old.nbytes
+                evicted.append((key, old))
+        if self.spill_dir is not None:
+            for (old_version, old_uid), old in evicted:
+                self._spill(old_version, old_uid, old)
+
+    def drop_version(self, version):
+        '''
+        Forget the states of a model version, they are not valid for another checkpoint
+        '''
+        with self._lock:
+            for key in [key for key in self._states if key[0] == version]:
+                self._bytes -= self._states.pop(key).nbytes
+        if self.spill_dir is not None:
+            shutil.rmtree(self._version_dir(version), ignore_errors=True)
+
+    def __len__(self):
+        return len(self._states)
+
+    def _version_dir(self, version):
+        # the symlinks and .. are resolved, a version never points outside spill_dir
+        spill_dir = os.path.realpath(self.spill_dir)
+        path = os.path.realpath(os.path.join(spill_dir, str(version)))
+        if path == spill_dir or os.path.commonpath([path, spill_dir]) != spill_dir:
+            raise ValueError(f"model version {version!r} is not a directory name under the spill dir")
+        return path
+
+    def _spill_path(self, version, uid):
+        return os.path.join(self._version_dir(version), "{}.npz".format(int(uid)))
+
+    def _spill(self, version, uid, state):
+        # written to a temp file of the same dir and renamed, so a reader never sees a partial npz
+        path = self._spill_path(version, uid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                np.savez(fout, pos=state.pos, mems=state.mems, predictions=np.asarray(state.predictions, dtype=np.int64),
+                         digest=np.frombuffer(state.digest, dtype=np.uint8))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _load_spilled(self, version, uid):
+        if self.spill_dir is None:
+            return None
+        try:
+            with np.load(self._spill_path(version, uid)) as f:
+                return StudentState(int(f["pos"]), f["mems"], f["predictions"].tolist(), f["digest"].tobytes())
+        except FileNotFoundError:
+            # never spilled, or removed by drop_version
+            return None
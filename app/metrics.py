@@ -0,0 +1,42 @@
+import threading
+from collections import deque
+import numpy as np
+
+
+class StageMetrics:
+    '''
+    Time of each stage of the last `window` requests (seconds in, ms out) and the count of the rejected ones
+    '''
+    def __init__(self, window=1024):
+        self._lock = threading.Lock()
+        self._window = window
+        self._stages = {}
+        self.requests = 0
+        self.rejected = {}
+
+    def record(self, timings : dict):
+        with self._lock:
+            self.requests += 1
+            for stage, seconds in timings.items():
+                self._stages.setdefault(stage, deque(maxlen=self._window)).append(seconds)
+
+    def reject(self, status_code : int):
+        with self._lock:
+            self.rejected[status_code] = self.rejected.get(status_code, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {stage: np.asarray(values) * 1e3 for stage, values in self._stages.items()}
+            res = {"requests": self.requests, "rejected": dict(self.rejected), "stages": {}}
+        for stage, values in stages.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            res["stages"][stage] = {"count": len(values), "mean_ms": float(values.mean()), "p50_ms": float(p50),
+                                    "p95_ms": float(p95), "p99_ms": float(p99)}
+        return res
+
+
+def server_timing(timings : dict) -> str:
+    '''
+    Server-Timing header value of the stage timings of one request
+    '''
+    return ", ".join("{};dur={:.1f}".format(stage, seconds * 1e3) for stage, seconds in timings.items())
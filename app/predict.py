@@ -4,92 +4,186 @@ current_directory = os.path.dirname(os.path.abspath(__file__))
 parent_directory = os.path.dirname(current_directory)
 sys.path.append(parent_directory)
 from fastapi import HTTPException
+import logging
+import numpy as np
 import pandas as pd
 import tensorflow as tf
-from preprocess.data_utils import get_evalmask_token
-from models.model_for_kt import TFTransfoXLMLMHeadModel
+from preprocess.data_utils import get_evalmask_token, extend_multi_concepts, Vocabulary
+from app.registry import registry, LoadedModel
+from app.student_logs import student_logs
 from pathlib import Path
-from transformers import TransfoXLConfig
 import argparse
+from functools import lru_cache
 
 
 __version__="0.1.0"
 BASE_DIR = Path(__file__).resolve(strict=True).parent.parent
-
-def predict_pipline(path,uid,devices):
-
-    device = "/cpu:0" if device == "cpu" else "/gpu:0"
+DEFAULT_CKPT_DIR = '{}/save_model/5ep_400mem_concepts.ckpt'.format(BASE_DIR)
+
+
+@lru_cache(maxsize=None)
+def load_vocabulary(vocab_path):
+    # vocab.npz made by make_Tf_data.py, copied next to the checkpoint
+    return Vocabulary.load(vocab_path)
+
+
+def map_raw_ids(user_df, vocab):
+    '''
+    q123 questions and 12_24 concepts of the raw txt format => idx of the training vocabulary
+    '''
+    user_df = user_df.astype(str)
+    arrays, _ = extend_multi_concepts(user_df, set(user_df.columns), return_arrays=True)
+    question_list = vocab.lookup("questions", arrays["questions"]).tolist()
+    concepts_list = vocab.lookup("concepts", arrays["concepts"]).tolist()
+    return question_list, concepts_list, arrays["responses"].tolist()
+
+
+def read_student(path, uid, raw_ids=False, vocab_path=None):
+    '''
+    questions, concepts and responses of one student of the log csv.
+    The idx csv is read from its uid index (app.student_logs), the raw ids one is scanned with pandas
+    '''
+    if not raw_ids:
+        return student_logs.student(path, uid)
+
+    df= pd.read_csv(path)
+    vocab = load_vocabulary(vocab_path)
+    return map_raw_ids(df.loc[df['uid'] == uid, ['uid', 'questions', 'concepts', 'responses']], vocab)
+
+
+def predict_student(model, config_xl, question_list, concepts_list, responses_list):
+    '''
+    Predicted responses of every interaction, tgt_len steps per call with the mems of the previous steps
+    '''
+    masked_R, labels = get_evalmask_token(responses_list,config_xl.mask_token, config_xl.eos_token)
+
+    # 여기서 읽어온 데이터를 딕셔너리키 가지고 변환해서 ip mapping 하고
+
+    new_shape = (-1, 1)  # 나머지 차원은 자동으로 계산됨
+
+    qseq_reshaped = tf.reshape(question_list, new_shape)
+    cseq_reshaped = tf.reshape(concepts_list, new_shape)
+    masked_R_reshaped = tf.reshape(masked_R, new_shape)
+    labels_reshaped = tf.reshape(labels, new_shape)
+
+    if config_xl.mode == 'concepts':
+        predict_dataset = tf.data.Dataset.from_tensor_slices(
+        (cseq_reshaped, masked_R_reshaped,labels_reshaped))
+    else:
+        predict_dataset = tf.data.Dataset.from_tensor_slices(
+        (qseq_reshaped, masked_R_reshaped,labels_reshaped))
+
+    predict_dataset =predict_dataset.batch(config_xl.tgt_len)
+    # predict_dataset =predict_dataset.batch(140)
+
+    mems =None
+    predictions = []
+    for input_data, input_data2, input_target in predict_dataset:
+
+            outputs = model(concepts=tf.transpose(input_data), responses=tf.transpose(input_data2), labels=tf.transpose(input_target), mems=mems)
+            logit = outputs.logit
+            mems = outputs.mems
+
+            reshape = tf.reshape(logit, [-1, config_xl.R_vocab_size])
+            predicted_labels = tf.argmax(reshape, axis=1)
+            predictions.append(predicted_labels.numpy().tolist())
+
+    return [item for sublist in predictions for item in sublist]
+
+
+def predict_students(model, config_xl, students, states=None, return_states=False):
+    '''
+    predict_student of several (question_list, concepts_list, responses_list) students in one batch, a lane each.
+    Every round runs the next tgt_len steps of all the lanes, the lanes with the same number of steps left in one call.
+    A lane starts from the zero mems of init_mems and its mems stay mem_len steps, as in predict_student, so a lane
+    gets the predictions of predict_student.
+    states: None or a (pos, mems, predictions) per student (app.mems_cache.StudentState), pos a multiple of tgt_len.
+    The lane goes on from these mems and only runs the interactions after pos. The mems hold the responses with the eval
+    mask the earlier request drew over its history, and the mask of this call is drawn over the interactions after pos
+    only. So a lane with a state is not predict_student of the whole history: it gets the same predictions only when
+    the masks of both runs are the same.
+    return_states: also return the (pos, mems, predictions) of each lane after its last full tgt_len segment
+    '''
+    n_layer, mem_len, d_model = config_xl.n_layer, config_xl.mem_len, config_xl.d_model
+    states = states if states is not None else [None] * len(students)
+    lanes = []
+    for (question_list, concepts_list, responses_list), state in zip(students, states):
+        pos = state.pos if state is not None else 0
+        masked_R, labels = get_evalmask_token(responses_list[pos:],config_xl.mask_token, config_xl.eos_token)
+        tokens = concepts_list if config_xl.mode == 'concepts' else question_list
+        mems = tf.convert_to_tensor(state.mems, dtype=model.compute_dtype) if state is not None else \
+            tf.zeros([n_layer, mem_len, 1, d_model], dtype=model.compute_dtype)
+        predictions = list(state.predictions) if state is not None else []
+        lanes.append({"tokens": np.asarray(tokens[pos:], dtype=np.int32), "masked_R": np.asarray(masked_R, dtype=np.int32),
+                      "labels": np.asarray(labels, dtype=np.int32), "start": pos, "pos": 0, "predictions": predictions,
+                      "mems": mems, "state": (pos, mems, len(predictions))})
+
+    while True:
+        groups = {}
+        for lane in lanes:
+            qlen = min(config_xl.tgt_len, len(lane["tokens"]) - lane["pos"])
+            if qlen > 0:
+                groups.setdefault(qlen, []).append(lane)
+        if not groups:
+            break
+        for qlen, group in groups.items():
+            steps = [slice(lane["pos"], lane["pos"] + qlen) for lane in group]
+            outputs = model(concepts=np.stack([lane["tokens"][step] for lane, step in zip(group, steps)]),
+                            responses=np.stack([lane["masked_R"][step] for lane, step in zip(group, steps)]),
+                            labels=np.stack([lane["labels"][step] for lane, step in zip(group, steps)]),
+                            mems=tf.concat([lane["mems"] for lane in group], axis=2))
+            predicted_labels = tf.argmax(outputs.logit, axis=-1).numpy()
+            mems = tf.split(tf.stack(outputs.mems, axis=0), len(group), axis=2)
+            for i, lane in enumerate(group):
+                lane["predictions"].extend(predicted_labels[i].tolist())
+                lane["mems"] = mems[i]
+                lane["pos"] += qlen
+                if qlen == config_xl.tgt_len:
+                    lane["state"] = (lane["start"] + lane["pos"], mems[i], len(lane["predictions"]))
+
+    predictions = [lane["predictions"] for lane in lanes]
+    if return_states:
+        states = []
+        for lane in lanes:
+            pos, mems, n = lane["state"]
+            states.append((pos, mems.numpy(), lane["predictions"][:n]))
+        return predictions, states
+    return predictions
+
+
+def write_predictions(uid, question_list, concepts_list, predictions):
+    df = pd.DataFrame({'Question':question_list,'Concepts':concepts_list,'Responses':predictions})
+    save_dir = '{}/{}.csv'.format(BASE_DIR, uid)
+
+    df.to_csv(save_dir, index=False)
+    return save_dir
+
+
+def predict_pipline(path,uid,devices,raw_ids=False,entry : LoadedModel = None):
+    '''
+    entry: the LoadedModel of app.registry, the active one by default. The model is loaded and warmed once, not per request
+    '''
+    device = "/cpu:0" if devices == "cpu" else "/gpu:0"
     try:
-        with tf.device(device):
+        if entry is None:
+            if registry.active_version is None:
+                registry.load(__version__, DEFAULT_CKPT_DIR, device)
+            entry = registry.get()
 
-            config_xl = TransfoXLConfig.from_pretrained('{}/save_model/5ep_400mem_concepts.ckpt/config.json'.format(BASE_DIR))
-
-            model = TFTransfoXLMLMHeadModel(config=config_xl)
-            model.load_weights('{}/save_model/5ep_400mem_concepts.ckpt/my_checkpoint'.format(BASE_DIR))
+        with tf.device(device):
 
             csv_file_path = path # 이 값을 사용자가 넣을 수 있도록 하자
 
-            df= pd.read_csv(csv_file_path)
-
-            question_list = df.loc[df['uid'] == uid, 'questions']
-            concepts_list = df.loc[df['uid'] == uid, 'concepts']
-            responses_list = df.loc[df['uid'] == uid, 'responses']
-
-            question_list = [int(x) for x in question_list.values[0].split(',')]
-            concepts_list = [int(x) for x in concepts_list.values[0].split(',')]
-            responses_list = [int(x) for x in responses_list.values[0].split(',')]
-
-            masked_R, labels = get_evalmask_token(responses_list,config_xl.mask_token, config_xl.eos_token)
-
-
-
-            # 여기서 읽어온 데이터를 딕셔너리키 가지고 변환해서 ip mapping 하고 
-
-
-            new_shape = (-1, 1)  # 나머지 차원은 자동으로 계산됨
-
-            qseq_reshaped = tf.reshape(question_list, new_shape)
-            cseq_reshaped = tf.reshape(concepts_list, new_shape)
-            masked_R_reshaped = tf.reshape(masked_R, new_shape)
-            labels_reshaped = tf.reshape(labels, new_shape)
-            
-
-            # qseq_transposed = tf.transpose(qseq_reshaped)
-            # cseq_transposed = tf.transpose(cseq_reshaped)
-            # masked_R_transposed = tf.transpose(masked_R_reshaped)
-            # labels_transposed = tf.transpose(labels_reshaped)
-
-            
-
-            if config_xl.mode == 'concepts':
-                predict_dataset = tf.data.Dataset.from_tensor_slices(
-                (cseq_reshaped, masked_R_reshaped,labels_reshaped))
-            else:
-                predict_dataset = tf.data.Dataset.from_tensor_slices(
-                (qseq_reshaped, masked_R_reshaped,labels_reshaped))
-
-            predict_dataset =predict_dataset.batch(config_xl.tgt_len)
-            # predict_dataset =predict_dataset.batch(140)
-
-            mems =None
-            predictions = []
-            for input_data, input_data2, input_target in predict_dataset:
-            
-                    outputs = model(concepts=tf.transpose(input_data), responses=tf.transpose(input_data2), labels=tf.transpose(input_target), mems=mems)
-                    logit = outputs.logit
-                    mems = outputs.mems
-                    
-                    reshape = tf.reshape(logit, [-1, config_xl.R_vocab_size])
-                    predicted_labels = tf.argmax(reshape, axis=1)
-                    predictions.append(predicted_labels.numpy().tolist())
-
-            flattened_list = [item for sublist in predictions for item in sublist]
+            question_list, concepts_list, responses_list = read_student(csv_file_path, uid, raw_ids, entry.vocab_path)
 
-            df = pd.DataFrame({'Question':question_list,'Concepts':concepts_list,'Responses':flattened_list})
-            save_dir = '{}/{}.csv'.format(BASE_DIR, uid)
+            flattened_list = predict_student(entry.model, entry.config, question_list, concepts_list, responses_list)
 
-            df.to_csv(save_dir, index=False)
+            save_dir = write_predictions(uid, question_list, concepts_list, flattened_list)
         return save_dir
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    except KeyError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception:
+        # the error stays in the server log, the client only gets the status
+        logging.exception("predict of uid %s failed", uid)
+        raise HTTPException(status_code=500, detail="internal error")
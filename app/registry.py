@@ -0,0 +1,98 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import threading
+from dataclasses import dataclass
+import tensorflow as tf
+from models.model_for_kt import TFTransfoXLMLMHeadModel
+from transformers import TransfoXLConfig
+
+
+@dataclass
+class LoadedModel:
+    '''
+    A model loaded from a checkpoint dir (config.json, my_checkpoint and optionally vocab.npz)
+    '''
+    version : str
+    ckpt_dir : str
+    device : str
+    config : TransfoXLConfig
+    model : TFTransfoXLMLMHeadModel
+
+    @property
+    def vocab_path(self) -> str:
+        return os.path.join(self.ckpt_dir, "vocab.npz")
+
+
+def load_model(ckpt_dir : str, device="/cpu:0") -> (TransfoXLConfig, TFTransfoXLMLMHeadModel):
+    '''
+    Build the model of a checkpoint dir and warm it: a dummy tgt_len forward without and with mems traces both eager
+    paths, so the first request does not pay for it
+    '''
+    with tf.device(device):
+        config_xl = TransfoXLConfig.from_pretrained(os.path.join(ckpt_dir, "config.json"))
+        model = TFTransfoXLMLMHeadModel(config=config_xl)
+        model.load_weights(os.path.join(ckpt_dir, "my_checkpoint"))
+        dummy = tf.fill([1, config_xl.tgt_len], config_xl.mask_token)
+        outputs = model(concepts=dummy, responses=dummy)
+        model(concepts=dummy, responses=dummy, mems=outputs.mems)
+    return config_xl, model
+
+
+class ModelRegistry:
+    '''
+    Loaded models by version and the active one. A request takes the LoadedModel once (get) and keeps it to the end,
+    so activating another version never changes the model under an in-flight request.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._active = None
+
+    def load(self, version : str, ckpt_dir : str, device="/cpu:0", activate=True) -> LoadedModel:
+        '''
+        Load and warm a checkpoint outside of the lock, the active model keeps serving meanwhile
+        '''
+        config_xl, model = load_model(ckpt_dir, device)
+        entry = LoadedModel(version, ckpt_dir, device, config_xl, model)
+        with self._lock:
+            self._models[version] = entry
+            if activate or self._active is None:
+                self._active = version
+        return entry
+
+    def activate(self, version : str) -> LoadedModel:
+        with self._lock:
+            if version not in self._models:
+                raise KeyError(f"model version {version} is not loaded")
+            self._active = version
+            return self._models[version]
+
+    def unload(self, version : str):
+        '''
+        Forget a version, its requests in flight still hold the LoadedModel until they finish
+        '''
+        with self._lock:
+            if version == self._active:
+                raise ValueError(f"model version {version} is active")
+            self._models.pop(version, None)
+
+    def get(self, version=None) -> LoadedModel:
+        with self._lock:
+            version = self._active if version is None else version
+            if version not in self._models:
+                raise KeyError(f"model version {version} is not loaded")
+            return self._models[version]
+
+    @property
+    def active_version(self):
+        return self._active
+
+    def versions(self) -> list:
+        with self._lock:
+            return list(self._models)
+
+
+registry = ModelRegistry()
@@ -0,0 +1,150 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from preprocess.interaction_store import InteractionStore, InteractionStoreWriter, encode_lines, INTERACTION_COLUMNS, \
+    CONCEPT_DTYPE, OFFSET_DTYPE
+
+
+class UnknownStudent(KeyError):
+    pass
+
+
+def encode_log_csv(path : str) -> dict:
+    '''
+    The log csv of predict (uid and comma separated questions, concepts and responses idx per row) as the flat arrays
+    of encode_lines, one concept per interaction and no timestamps/usetimes (-1). Every column is parsed with one
+    np.fromstring call. The rows with an empty field are dropped, their students are not in the index
+    '''
+    df = pd.read_csv(path, dtype={"questions": str, "concepts": str, "responses": str})
+    df = df.dropna(subset=["uid", "questions", "concepts", "responses"])
+    if len(df) == 0:
+        return encode_lines([], [], [], [], [], [], question_prefix="")
+    seq_lens = df["responses"].str.count(",").to_numpy() + 1
+    for key in ["questions", "concepts"]:
+        bad = df["uid"][(df[key].str.count(",").to_numpy() + 1) != seq_lens]
+        if len(bad) > 0:
+            raise ValueError(f"{key} and responses of uid {bad.iloc[0]} do not have the same length in {path}")
+    total = int(seq_lens.sum())
+
+    def parse(key, dtype):
+        values = np.fromstring(",".join(df[key]), dtype=np.int64, sep=",")
+        if len(values) != total:
+            raise ValueError(f"{key} has {len(values)} values but the users have {total} interactions in {path}")
+        return values.astype(dtype)
+
+    return {
+        "uid": df["uid"].to_numpy().astype(np.int64),
+        "seq_lens": seq_lens.astype(OFFSET_DTYPE),
+        "questions": parse("questions", INTERACTION_COLUMNS["questions"]),
+        "concept_lens": np.ones(total, dtype=OFFSET_DTYPE),
+        "concepts": parse("concepts", CONCEPT_DTYPE),
+        "responses": parse("responses", INTERACTION_COLUMNS["responses"]),
+        "timestamps": np.full(total, -1, dtype=INTERACTION_COLUMNS["timestamps"]),
+        "usetimes": np.full(total, -1, dtype=INTERACTION_COLUMNS["usetimes"]),
+    }
+
+
+class StudentLogIndex:
+    '''
+    One log csv indexed by uid. The csv is parsed once into an InteractionStore directory which is then
+    memory mapped, so a student is read in O(its history) and not by scanning the csv. The index is kept for the
+    (mtime, size) of the csv it was built from, and built again when the csv changes. It is written to
+    index_root/{hash of the csv realpath}, never next to the csv.
+    '''
+    def __init__(self, path : str, index_root : str):
+        self.path = path
+        key = hashlib.blake2b(os.path.realpath(path).encode(), digest_size=16).hexdigest()
+        self.index_dir = os.path.join(index_root, key)
+        self._lock = threading.Lock()
+        self._source = None
+        # (store, sorted uids, their row), replaced at once so a reader never mixes two versions of the csv
+        self._index = None
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def refresh(self):
+        source = self._stat()
+        if source == self._source:
+            return
+        with self._lock:
+            if source == self._source:
+                return
+            store = self._load_index(source)
+            if store is None:
+                store = self._build_index(source)
+            # first row of a uid, like the df.loc[...].values[0] of the csv read
+            uids, rows = np.unique(np.asarray(store.uid), return_index=True)
+            self._index, self._source = (store, uids, rows), source
+
+    def _load_index(self, source):
+        meta_path = os.path.join(self.index_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as fin:
+            if json.loads(fin.read()).get("source") != source:
+                return None
+        return InteractionStore.load(self.index_dir)
+
+    def _build_index(self, source):
+        arrays = encode_log_csv(self.path)
+        try:
+            shutil.rmtree(self.index_dir, ignore_errors=True)
+            with InteractionStoreWriter(self.index_dir, question_prefix="") as writer:
+                writer.append_arrays(arrays)
+            meta_path = os.path.join(self.index_dir, "meta.json")
+            with open(meta_path, "r") as fin:
+                meta = json.loads(fin.read())
+            meta["source"] = source
+            with open(meta_path, "w") as fout:
+                fout.write(json.dumps(meta))
+            return InteractionStore.load(self.index_dir)
+        except OSError:
+            # no write access to index_root: keep the index in memory
+            return InteractionStore.from_arrays(arrays, question_prefix="")
+
+    def student(self, uid : int):
+        '''
+        question_list, concepts_list, responses_list of one student, UnknownStudent (a KeyError) if the uid is not in the csv
+        '''
+        self.refresh()
+        store, uids, rows = self._index
+        i = np.searchsorted(uids, uid)
+        if i == len(uids) or uids[i] != uid:
+            raise UnknownStudent(f"uid {uid} is not in {self.path}")
+        user = store.user(rows[i])
+        return user["questions"].tolist(), user["concepts"].tolist(), user["responses"].tolist()
+
+
+class StudentLogs:
+    '''
+    The StudentLogIndex of every log csv read by the server, made on the first request of the csv
+    '''
+    def __init__(self, index_root : str):
+        self.index_root = index_root
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def get(self, path : str) -> StudentLogIndex:
+        path = os.path.abspath(path)
+        with self._lock:
+            if path not in self._indexes:
+                self._indexes[path] = StudentLogIndex(path, self.index_root)
+            return self._indexes[path]
+
+    def student(self, path : str, uid : int):
+        return self.get(path).student(uid)
+
+
+# STUDENT_INDEX_DIR holds the indexes of the log csv files, the server owns everything under it
+student_logs = StudentLogs(os.environ.get("STUDENT_INDEX_DIR", os.path.join(tempfile.gettempdir(), "kt_student_index")))
@@ -0,0 +1,77 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import asyncio
+import threading
+import pytest
+from app.batching import MicroBatcher, BatcherFull, BatcherStopped
+from app.predict import predict_student
+
+
+def test_micro_batches_predict_like_one_student_at_a_time(entry, students, seeded_eval_mask):
+    batched = []
+
+    class RecordingBatcher(MicroBatcher):
+        def _predict(self, entry, students):
+            batched.append(len(students))
+            return super()._predict(entry, students)
+
+    async def run():
+        batcher = RecordingBatcher(max_students=4, window_ms=50)
+        batcher.start()
+        # uid 0 twice: its second request waits for the first one
+        uids = list(students) + [0]
+        try:
+            return uids, await asyncio.gather(*[batcher.submit(entry, uid, *students[uid]) for uid in uids])
+        finally:
+            await batcher.stop()
+
+    uids, predictions = asyncio.run(run())
+    for uid, prediction in zip(uids, predictions):
+        assert prediction == predict_student(entry.model, entry.config, *students[uid])
+    assert max(batched) == 4 and sum(batched) == len(uids)
+
+
+def test_requests_waiting_for_their_student_count_in_max_queue(entry, students):
+    release = threading.Event()
+
+    class BlockedBatcher(MicroBatcher):
+        def _predict(self, entry, students):
+            release.wait()
+            return [[0] * len(student[3]) for student in students]
+
+    async def run():
+        batcher = BlockedBatcher(max_students=1, window_ms=1, max_queue=2)
+        batcher.start()
+        try:
+            # the first request is predicted, the second waits for the lock of uid 0, the third is one too many
+            requests = [asyncio.ensure_future(batcher.submit(entry, 0, *students[0])) for _ in range(3)]
+            await asyncio.sleep(0.2)
+            with pytest.raises(BatcherFull):
+                await requests[2]
+            release.set()
+            return await asyncio.gather(*requests[:2])
+        finally:
+            release.set()
+            await batcher.stop()
+
+    assert len(asyncio.run(run())) == 2
+
+
+def test_stop_fails_the_collected_requests(entry, students):
+    async def run():
+        # a long window: the request is taken from the queue and waits for more students when stop cancels the batcher
+        batcher = MicroBatcher(max_students=8, window_ms=10000)
+        batcher.start()
+        request = asyncio.ensure_future(batcher.submit(entry, 0, *students[0]))
+        await asyncio.sleep(0.1)
+        assert batcher.qsize() == 0
+        await batcher.stop()
+        with pytest.raises(BatcherStopped):
+            await asyncio.wait_for(request, 5)
+        with pytest.raises(BatcherStopped):
+            await batcher.submit(entry, 1, *students[1])
+
+    asyncio.run(run())
@@ -0,0 +1,110 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+from app import main
+from app.batching import MicroBatcher
+import app.predict
+
+
+@pytest.fixture
+def serving(model_root, monkeypatch, tmp_path):
+    monkeypatch.setenv("MODEL_CKPT_DIR", os.path.join(model_root, "ckpt_a"))
+    monkeypatch.setenv("MODEL_VERSION", "a")
+    monkeypatch.setattr(main, "model_root", os.path.realpath(model_root))
+    # the shutdown of a client stops these, every test gets its own
+    monkeypatch.setattr(main, "batcher", MicroBatcher(max_students=1, window_ms=1, max_queue=2, cache=main.mems_cache))
+    monkeypatch.setattr(main, "io_executor", ThreadPoolExecutor(max_workers=8))
+    monkeypatch.setattr(app.predict, "BASE_DIR", str(tmp_path))
+
+
+@pytest.fixture
+def client(serving):
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_predict(client, log_csv, students, tmp_path):
+    response = client.post("/predict", json={"Path": log_csv, "uid": 3, "devices": "cpu"})
+    assert response.status_code == 200
+    assert response.json() == {"output_path": os.path.join(str(tmp_path), "3.csv"), "model_version": "a"}
+    assert "total;dur=" in response.headers["Server-Timing"]
+    assert os.path.exists(os.path.join(str(tmp_path), "3.csv"))
+
+
+def test_predict_errors(client, log_csv, tmp_path, monkeypatch):
+    response = client.post("/predict", json={"Path": log_csv, "uid": 10 ** 6, "devices": "cpu"})
+    assert response.status_code == 422
+    response = client.post("/predict", json={"Path": str(tmp_path / "nope.csv"), "uid": 1, "devices": "cpu"})
+    assert response.status_code == 422
+    response = client.post("/predict", json={"Path": log_csv, "uid": 1, "devices": "cpu", "version": "zzz"})
+    assert response.status_code == 404
+
+    def fail(entry, students):
+        raise RuntimeError("secret detail")
+    monkeypatch.setattr(main.batcher, "_predict", fail)
+    response = client.post("/predict", json={"Path": log_csv, "uid": 1, "devices": "cpu"})
+    assert response.status_code == 500 and response.json()["detail"] == "internal error"
+
+
+def test_full_queue_answers_429(client, log_csv, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    predict = main.batcher._predict
+
+    def blocked(entry, students):
+        started.set()
+        release.wait()
+        return predict(entry, students)
+    monkeypatch.setattr(main.batcher, "_predict", blocked)
+
+    def post(uid):
+        return client.post("/predict", json={"Path": log_csv, "uid": uid, "devices": "cpu"})
+
+    # one student predicted and max_queue=2 waiting, the other requests are answered at once
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        futures = [pool.submit(post, 0)]
+        assert started.wait(30)
+        futures += [pool.submit(post, uid) for uid in range(1, 6)]
+        deadline = time.time() + 30
+        while sum(f.done() for f in futures) < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        rejected = [f.result() for f in futures if f.done()]
+        release.set()
+        responses = [f.result() for f in futures]
+    assert len(rejected) == 3
+    assert all(r.status_code == 429 and r.headers["Retry-After"] == "1" for r in rejected)
+    assert sorted(r.status_code for r in responses) == [200, 200, 200, 429, 429, 429]
+    assert client.get("/metrics").json()["rejected"] == {"429": 3}
+
+
+def test_stopped_server_answers_503(serving, log_csv):
+    with TestClient(main.app) as client:
+        pass
+    response = client.post("/predict", json={"Path": log_csv, "uid": 1, "devices": "cpu"})
+    assert response.status_code == 503 and response.headers["Retry-After"] == "5"
+
+
+def test_load_model(client, model_root):
+    for version in ["..", "../x", "a/b", "a b", ""]:
+        response = client.post("/models", json={"version": version, "ckpt_dir": "ckpt_b"})
+        assert response.status_code == 422, version
+    for ckpt_dir in ["..", "../..", "/etc", os.path.join(model_root, "ckpt_b", "..", "..")]:
+        response = client.post("/models", json={"version": "b", "ckpt_dir": ckpt_dir})
+        assert response.status_code == 403, ckpt_dir
+    response = client.post("/models", json={"version": "b", "ckpt_dir": "missing"})
+    assert response.status_code == 422
+    assert client.get("/").json()["model_version"] == "a"
+
+    response = client.post("/models", json={"version": "b.1", "ckpt_dir": "ckpt_b"})
+    assert response.status_code == 200
+    assert response.json() == {"model_version": "b.1", "previous_version": "a"}
+    assert client.get("/").json()["loaded_versions"] == ["b.1"]
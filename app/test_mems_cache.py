@@ -0,0 +1,72 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import asyncio
+import numpy as np
+import pytest
+from app.batching import MicroBatcher
+from app.mems_cache import MemsCache
+from app.predict import predict_student
+
+
+def submit_in_turn(entry, cache, requests):
+    async def run():
+        batcher = MicroBatcher(max_students=4, window_ms=1, cache=cache)
+        batcher.start()
+        try:
+            return [await batcher.submit(entry, uid, *history) for uid, history in requests]
+        finally:
+            await batcher.stop()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_cached_mems_predict_like_the_whole_history(entry, students, no_eval_mask, tmp_path, spill):
+    # max_bytes=0 keeps only the last student in memory, the others are read back from spill_dir
+    cache = MemsCache(max_bytes=0, spill_dir=str(tmp_path)) if spill else MemsCache()
+    uids = [uid for uid in students if len(students[uid][2]) > 20][:3]
+    first = [(uid, tuple(values[:20] for values in students[uid])) for uid in uids]
+    second = [(uid, students[uid]) for uid in uids]
+    submit_in_turn(entry, cache, first)
+    predictions = submit_in_turn(entry, cache, second)
+    for (uid, history), prediction in zip(second, predictions):
+        assert prediction == predict_student(entry.model, entry.config, *history)
+    assert cache.hits == len(uids)
+    if spill:
+        assert sorted(os.listdir(os.path.join(str(tmp_path), "a"))) == sorted(f"{uid}.npz" for uid in uids)
+
+
+def test_a_changed_history_is_a_miss(tmp_path):
+    cache = MemsCache(max_bytes=1, spill_dir=str(tmp_path))
+    history = [list(range(20))] * 3
+    mems = np.ones((2, 16, 1, 32), np.float32)
+    cache.put("a", 1, *history, 16, mems, list(range(20)))
+    cache.put("a", 2, *history, 16, mems, list(range(20)))
+    changed = [list(range(20)), list(range(20)), [1] + list(range(1, 20))]
+    assert cache.get("a", 1, *changed) is None
+    # a spilled hit goes back in memory
+    state = cache.get("a", 1, *history)
+    assert state.pos == 16 and np.array_equal(state.mems, mems) and ("a", 1) in cache._states
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_versions_stay_in_the_spill_dir(tmp_path):
+    spill_dir = tmp_path / "spill"
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "keep").write_text("")
+    cache = MemsCache(max_bytes=0, spill_dir=str(spill_dir))
+    for version in ["..", "../outside", str(outside), ""]:
+        with pytest.raises(ValueError):
+            cache.drop_version(version)
+        with pytest.raises(ValueError):
+            cache._spill_path(version, 1)
+    assert (outside / "keep").exists()
+    history = [list(range(20))] * 3
+    cache.put("a", 1, *history, 16, np.ones((2, 16, 1, 32), np.float32), [])
+    cache.put("a", 2, *history, 16, np.ones((2, 16, 1, 32), np.float32), [])
+    assert os.listdir(spill_dir / "a") == ["1.npz"]
+    cache.drop_version("a")
+    assert not (spill_dir / "a").exists() and (outside / "keep").exists()
@@ -0,0 +1,42 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import pytest
+from app.registry import ModelRegistry
+from app.predict import predict_student
+
+
+def test_registry_versions(model_root, students, seeded_eval_mask):
+    registry = ModelRegistry()
+    with pytest.raises(KeyError):
+        registry.get()
+    a = registry.load("a", os.path.join(model_root, "ckpt_a"))
+    assert registry.active_version == "a" and registry.get() is a
+
+    # loading another version activates it, a request that took "a" keeps it
+    b = registry.load("b", os.path.join(model_root, "ckpt_b"))
+    assert registry.get() is b and registry.get("a") is a
+    assert registry.versions() == ["a", "b"]
+    student = students[0]
+    assert predict_student(a.model, a.config, *student) != predict_student(b.model, b.config, *student)
+
+    registry.load("c", os.path.join(model_root, "ckpt_a"), activate=False)
+    assert registry.active_version == "b"
+    with pytest.raises(ValueError):
+        registry.unload("b")
+    assert registry.activate("a") is a
+    registry.unload("b")
+    with pytest.raises(KeyError):
+        registry.get("b")
+    with pytest.raises(KeyError):
+        registry.activate("b")
+
+
+def test_loaded_model_predicts_like_a_fresh_load(model_root, students, seeded_eval_mask):
+    registry = ModelRegistry()
+    entry = registry.load("a", os.path.join(model_root, "ckpt_a"))
+    again = ModelRegistry().load("a", os.path.join(model_root, "ckpt_a"))
+    for student in list(students.values())[:3]:
+        assert predict_student(entry.model, entry.config, *student) == predict_student(again.model, again.config, *student)
@@ -0,0 +1,41 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import time
+import pytest
+from app.student_logs import StudentLogIndex, UnknownStudent
+
+
+def test_index_reads_the_students_of_the_csv(log_csv, students, tmp_path):
+    index = StudentLogIndex(log_csv, str(tmp_path / "index"))
+    for uid, history in students.items():
+        assert index.student(uid) == tuple(history)
+    with pytest.raises(UnknownStudent):
+        index.student(10 ** 6)
+    # the index is written under index_root only, and a new StudentLogIndex reuses it
+    assert os.listdir(tmp_path / "index") == [os.path.basename(index.index_dir)]
+    assert sorted(os.listdir(os.path.dirname(log_csv))) == ["students.csv"]
+    assert StudentLogIndex(log_csv, str(tmp_path / "index"))._load_index(index._stat()) is not None
+
+
+def test_index_is_built_again_when_the_csv_changes(tmp_path):
+    path = tmp_path / "log.csv"
+    path.write_text('uid,questions,concepts,responses\n1,"4,5","6,7","0,1"\n')
+    index = StudentLogIndex(str(path), str(tmp_path / "index"))
+    assert index.student(1) == ([4, 5], [6, 7], [0, 1])
+    time.sleep(0.01)
+    path.write_text('uid,questions,concepts,responses\n1,"4,5,8","6,7,9","0,1,1"\n2,"4","6","1"\n')
+    assert index.student(1) == ([4, 5, 8], [6, 7, 9], [0, 1, 1])
+    assert index.student(2) == ([4], [6], [1])
+
+
+def test_rows_with_an_empty_field_are_left_out(tmp_path):
+    path = tmp_path / "log.csv"
+    path.write_text('uid,questions,concepts,responses\n1,"4,5","6,7","0,1"\n2,,"6",\n3,"8","9","1"\n')
+    index = StudentLogIndex(str(path), str(tmp_path / "index"))
+    assert index.student(1) == ([4, 5], [6, 7], [0, 1])
+    assert index.student(3) == ([8], [9], [1])
+    with pytest.raises(UnknownStudent):
+        index.student(2)
@@ -6,7 +6,7 @@ import json
 import copy
 import itertools
 import tensorflow as tf
-from KT.preprocess.data_utils import read_data,get_max_concepts,calStatistics,extend_multi_concepts,id_mapping,save_id2idx,train_test_split,save_dcur,generate_sequences, get_mask_tokens
+from KT.preprocess.data_utils import read_data,get_max_concepts,calStatistics,extend_multi_concepts,id_mapping,save_id2idx,train_test_split,save_dcur,generate_sequences, get_mask_tokens, get_evalmask_token_batch
 import pickle
 import glob
 import matplotlib.pyplot as plt
@@ -131,46 +131,6 @@ config_xl = TransfoXLConfig(
 #     R = tf.where(extended_mask, mask_token, R)
 
 #     return R, labels
-def get_evalmask_token(R, mask_token,eos_token, mlm_probability=0.15):
-    labels = tf.identity(R)
-    
-    # 확률 행렬 생성
-    probability_matrix = tf.fill(tf.shape(labels), mlm_probability)
-    
-    # 특별 토큰에 대한 마스크 생성
-    special_token_mask = tf.equal(R, eos_token)
-    
-    # 확률 행렬에 특별 토큰 마스크 적용
-    probability_matrix = tf.where(special_token_mask, 0.0, probability_matrix)
-    
-    # 마스킹할 인덱스 생성
-    masked_indices = tf.cast(tf.random.uniform(tf.shape(labels)) < probability_matrix, tf.bool)
-    
-    # 모든 마스킹된 인덱스 찾기
-    all_masked_indices = tf.where(masked_indices)
-    all_masked_indices = all_masked_indices[:, 0]
-    
-    # 마스킹할 인덱스가 없는 경우, 원래의 R 및 labels 반환
-    if tf.size(all_masked_indices) == 0:
-        return R, tf.fill(tf.shape(labels), -100)
-    
-    # 랜덤으로 선택된 마스킹된 인덱스
-    random_index = tf.random.uniform(shape=(), minval=0, maxval=tf.size(all_masked_indices), dtype=tf.int32)
-    selected_masked_index = tf.cast(tf.gather(all_masked_indices, random_index), dtype=tf.int32)
-    
-    # 랜덤으로 선택된 마스킹된 인덱스 이후의 모든 요소에 대한 마스크 생성
-    extended_mask = tf.range(tf.size(labels)) > selected_masked_index
-    extended_mask = tf.logical_and(extended_mask, ~special_token_mask)
-    
-    # 확장된 마스크 적용
-    labels = tf.where(~extended_mask, -100, labels)
-    R = tf.where(extended_mask, mask_token, R)
-
-    return R, labels
-
-
-
-
 # class TrainDataGenerator:
 #     def __init__(self, train_path, bsz, bptt, eos_token, mask_token, ext_len=None):
 #         self.train_path = train_path.decode('utf-8') if isinstance(train_path, bytes) else train_path
@@ -404,10 +364,7 @@ def test_gen(data,eos_token,bsz,bptt,mask_token):
 
         rseq_list=[(int(_)) for _ in row["responses"].split(",")]
         rseq_list.append(eos_token)
-        masked_R, labels = get_evalmask_token(rseq_list, mask_token, eos_token)
-        
-        dori["r_mask_seqs"].append(masked_R)
-        dori["labels"].append(labels)
+        dori["r_mask_seqs"].append(rseq_list)
 
         # c_shift_list=[int(_) for _ in row["concepts"].split(",")]
         # c_shift_list.append(eos_token)
@@ -418,6 +375,11 @@ def test_gen(data,eos_token,bsz,bptt,mask_token):
         # r_shift_list.append(eos_token)
         # dori["r_shift"].append(r_shift_list)
 
+    # the evaluation masks of every test user in one call
+    r_offsets = np.concatenate([[0], np.cumsum([len(r) for r in dori["r_mask_seqs"]])])
+    r_masked, r_labels = get_evalmask_token_batch(np.concatenate(dori["r_mask_seqs"]), mask_token, eos_token, offsets=r_offsets)
+    dori["r_mask_seqs"], dori["labels"] = [r_masked], [r_labels]
+
     '''
     딕셔너리의 각 값마다 끝에 eos 토큰 삽입
     rseqs에는 num_c 곱하여 cseqs 더할 값 만들기
@@ -252,34 +252,68 @@ def input_processing_MLM(func , config, **kwargs :dict):
 
 
 
-class TFPositionalEmbedding(tf.keras.layers.Layer):
-    def __init__(self, demb, **kwargs):
-        super().__init__(**kwargs)
+def sinusoid_positions(pos_seq, inv_freq):
+    '''
+    (len(pos_seq), 1, demb) sinusoid embedding of the distances pos_seq
+    '''
+    inv_freq = tf.cast(inv_freq, dtype=pos_seq.dtype)
+    sinusoid_inp = tf.einsum("i,j->ij", pos_seq, inv_freq)
 
-        self.inv_freq = 1 / (10000 ** (tf.range(0, demb, 2.0) / demb))
+    '''
+    두 벡터 A = [1, 2, 3]와 B = [4, 5, 6]를 가정할 때, tf.einsum('i,j->ij', A, B)는 다음과 같은 행렬을 생성합니다:
 
-    def call(self, pos_seq, bsz=None):
-        self.inv_freq = tf.cast(self.inv_freq, dtype=pos_seq.dtype)
-        sinusoid_inp = tf.einsum("i,j->ij", pos_seq, self.inv_freq)
+    A의 각 요소 (i 인덱스)와 B의 각 요소 (j 인덱스)를 곱합니다.
+    이 곱셈의 결과는 2차원 행렬에 저장됩니다, 여기서 i는 행 인덱스, j는 열 인덱스입니다.
+    행렬의 각 원소는 다음과 같이 계산됩니다:
 
-        '''
-        두 벡터 A = [1, 2, 3]와 B = [4, 5, 6]를 가정할 때, tf.einsum('i,j->ij', A, B)는 다음과 같은 행렬을 생성합니다:
+    (1, 4), (1, 5), (1, 6)
+    (2, 4), (2, 5), (2, 6)
+    (3, 4), (3, 5), (3, 6)
+    
+    '''
+    pos_emb = tf.concat([tf.sin(sinusoid_inp), tf.cos(sinusoid_inp)], -1)
+    return pos_emb[:, None, :]
 
-        A의 각 요소 (i 인덱스)와 B의 각 요소 (j 인덱스)를 곱합니다.
-        이 곱셈의 결과는 2차원 행렬에 저장됩니다, 여기서 i는 행 인덱스, j는 열 인덱스입니다.
-        행렬의 각 원소는 다음과 같이 계산됩니다:
 
-        (1, 4), (1, 5), (1, 6)
-        (2, 4), (2, 5), (2, 6)
-        (3, 4), (3, 5), (3, 6)
-        
+class TFPositionalEmbedding(tf.keras.layers.Layer):
+    def __init__(self, demb, max_len=0, clamp_len=0, **kwargs):
+        super().__init__(**kwargs)
+
+        self.inv_freq = 1 / (10000 ** (tf.range(0, demb, 2.0) / demb))
+        self.clamp_len = clamp_len
+        # pos_emb of the distances max_len-1 ~ 0 built once, the pos_emb of klen keys are its last klen rows
+        self.max_len = max_len
+        self.table = sinusoid_positions(self._pos_seq(max_len), self.inv_freq) if max_len > 0 else None
+
+    def _pos_seq(self, klen):
+        pos_seq = tf.range(tf.cast(klen, tf.float32) - 1, -1, -1.0)
+        if self.clamp_len > 0:
+            pos_seq = tf.minimum(pos_seq, self.clamp_len)
+        return pos_seq
+
+    def positions(self, klen):
         '''
-        pos_emb = tf.concat([tf.sin(sinusoid_inp), tf.cos(sinusoid_inp)], -1)
+        pos_emb (klen, 1, demb) of the distances klen-1 ~ 0, a slice of the table when klen fits in it
+        '''
+        if self.table is None:
+            return sinusoid_positions(self._pos_seq(klen), self.inv_freq)
+        if isinstance(klen, int):
+            if klen <= self.max_len:
+                return self.table[self.max_len - klen :]
+            return sinusoid_positions(self._pos_seq(klen), self.inv_freq)
+        return tf.cond(
+            klen <= self.max_len,
+            lambda: self.table[self.max_len - klen :],
+            lambda: sinusoid_positions(self._pos_seq(klen), self.inv_freq),
+        )
+
+    def call(self, pos_seq, bsz=None):
+        pos_emb = sinusoid_positions(pos_seq, self.inv_freq)
 
         if bsz is not None:
-            return tf.tile(pos_emb[:, None, :], [1, bsz, 1]) # 2차원 pos_emb 가운데 차원 추가 후 bsz만큼 복사
+            return tf.tile(pos_emb, [1, bsz, 1]) # 2차원 pos_emb 가운데 차원 추가 후 bsz만큼 복사
         else:
-            return pos_emb[:, None, :]
+            return pos_emb
         
 
 class TFPositionwiseFF(tf.keras.layers.Layer):
@@ -341,6 +375,8 @@ class TFRelPartialLearnableMultiHeadAttn(tf.keras.layers.Layer):
         layer_norm_epsilon=1e-5,
         init_std=0.02,
         output_attentions=False,
+        attn_impl="rel_shift",
+        attn_chunk_size=128,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -350,6 +386,11 @@ class TFRelPartialLearnableMultiHeadAttn(tf.keras.layers.Layer):
         self.d_head = d_head
         self.dropout = dropout
         self.output_attentions = output_attentions
+        # rel_shift: the qlen x klen scores of the original code, chunked: _chunked_attn over key blocks
+        if attn_impl not in ("rel_shift", "chunked"):
+            raise ValueError(f"unknown attn_impl {attn_impl}, rel_shift or chunked")
+        self.attn_impl = attn_impl
+        self.attn_chunk_size = attn_chunk_size
 
 
         self.qkv_net = tf.keras.layers.Dense(
@@ -399,14 +440,138 @@ class TFRelPartialLearnableMultiHeadAttn(tf.keras.layers.Layer):
 
         return x
 
+    def _block_scores(self, rw_head_q, rr_head_q, k, r, mask, offset):
+        '''
+        Masked float32 scores of the queries and a block of keys.
+        BD of query i and key t of the block is the flat element offset + i * (W - 1) + t of rr_head_q x r (W rows of r).
+        '''
+        qlen, bsz = shape_list(rr_head_q)[0], shape_list(rr_head_q)[1]
+        width = shape_list(k)[0]
+
+        AC = tf.einsum("ibnd,jbnd->ijbn", rw_head_q, k)  # qlen x width x bsz x n_head
+        G = tf.einsum("ibnd,jnd->ijbn", rr_head_q, r)  # qlen x W x bsz x n_head
+        W = shape_list(G)[1]
+        G = tf.reshape(G, (-1, bsz, self.n_head))
+        G = tf.pad(G, [[0, tf.maximum(offset - qlen, 0)], [0, 0], [0, 0]])
+        BD = tf.reshape(G[offset : offset + qlen * (W - 1)], (qlen, W - 1, bsz, self.n_head))[:, :width]
+
+        # the online softmax runs in float32 under the mixed bfloat16 policy
+        attn_score = tf.cast(AC + BD, tf.float32)
+        return attn_score * (1.0 - mask) - 1e30 * mask
+
+    def _block_dropout(self, p, seed):
+        # stateless, so the backward pass draws the same mask again from the seed of the block
+        if self.dropatt.rate == 0:
+            return p
+        return tf.cond(seed[0] >= 0, lambda: tf.nn.experimental.stateless_dropout(p, self.dropatt.rate, seed), lambda: p)
+
+    def _chunked_attn(self, w_head_q, w_head_k, w_head_v, r_head_k, attn_mask, training=False):
+        '''
+        Softmax attention over blocks of attn_chunk_size keys with a running max and sum (online softmax),
+        no qlen x klen score is built. The mems are split into blocks, the qlen keys of w are the last block.
+        The scores are the ones of _rel_shift.
+        The gradient is custom: the forward keeps only the output and the log-sum-exp of every query, and the backward
+        loop computes the scores of each block again, so neither pass keeps anything per block (also in tf.function,
+        where the gradient of a tf.while_loop would keep the intermediates of every iteration).
+        '''
+        qlen, klen, bsz = shape_list(w_head_q)[0], shape_list(w_head_k)[0], shape_list(w_head_q)[1]
+        mlen = klen - qlen
+        chunk = self.attn_chunk_size
+
+        if attn_mask is None:
+            attn_mask = tf.zeros([qlen, klen])
+        # qlen x klen x (1 or bsz) x 1
+        attn_mask = tf.cast(attn_mask[:, :, None, None] if attn_mask.shape.rank == 2 else attn_mask[:, :, :, None], tf.float32)
+        if training and self.dropatt.rate > 0:
+            seed = tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+        else:
+            seed = tf.constant([-1, -1])
+
+        # mems: keys [s, e) read r[s:e+qlen] at offset qlen-1, they never reach the wrapped part of _rel_shift.
+        # keys of w: past the diagonal _rel_shift reads the next query row, so r[:qlen-1] + r[mlen:] + the pad zero at offset 2qlen-2
+        def mem_block(s):
+            e = tf.minimum(s + chunk, mlen)
+            return s, e, (lambda r: r[s : e + qlen]), qlen - 1, seed + [0, s + 1]
+
+        def w_block(r):
+            return tf.concat([r[: qlen - 1], r[mlen:], tf.zeros_like(r[:1])], 0)
+
+        @tf.custom_gradient
+        def attend(rw_head_q, rr_head_q, k, v, r):
+            # in eager mode an outer tape would still record the forward loop, grad below is the only gradient
+            rw_head_q, rr_head_q, k, v, r = [tf.stop_gradient(x) for x in (rw_head_q, rr_head_q, k, v, r)]
+            def forward_block(k_blk, v_blk, r_blk, mask, offset, blk_seed, m, l, acc):
+                attn_score = self._block_scores(rw_head_q, rr_head_q, k_blk, r_blk, mask, offset)
+                m_new = tf.maximum(m, tf.reduce_max(attn_score, axis=1))
+                p = tf.exp(attn_score - m_new[:, None])
+                alpha = tf.exp(m - m_new)
+                l = l * alpha + tf.reduce_sum(p, axis=1)
+                p = self._block_dropout(p, blk_seed)
+                acc = acc * alpha[..., None] + tf.cast(tf.einsum("ijbn,jbnd->ibnd", tf.cast(p, v.dtype), v_blk), tf.float32)
+                return m_new, l, acc
+
+            def body(s, m, l, acc):
+                s, e, r_fn, offset, blk_seed = mem_block(s)
+                m, l, acc = forward_block(k[s:e], v[s:e], r_fn(r), attn_mask[:, s:e], offset, blk_seed, m, l, acc)
+                return s + chunk, m, l, acc
+
+            m = tf.fill([qlen, bsz, self.n_head], -1e30)
+            l = tf.zeros([qlen, bsz, self.n_head])
+            acc = tf.zeros([qlen, bsz, self.n_head, self.d_head])
+            _, m, l, acc = tf.while_loop(lambda s, *_: s < mlen, body, (tf.constant(0), m, l, acc))
+            m, l, acc = forward_block(k[mlen:], v[mlen:], w_block(r), attn_mask[:, mlen:], 2 * qlen - 2, seed, m, l, acc)
+            out = acc / l[..., None]
+            lse = m + tf.math.log(l)
+
+            def grad(d_out):
+                d_out = tf.cast(d_out, tf.float32)
+                # sum_j p_j dp_j of the softmax gradient, the same with the dropout of the probabilities
+                delta = tf.reduce_sum(d_out * out, axis=-1)
+
+                def backward_block(k_blk, v_blk, r_fn, mask, offset, blk_seed):
+                    with tf.GradientTape() as tape:
+                        tape.watch([rw_head_q, rr_head_q, k_blk, r])
+                        attn_score = self._block_scores(rw_head_q, rr_head_q, k_blk, r_fn(r), mask, offset)
+                    p = tf.exp(attn_score - lse[:, None])
+                    d_v = tf.einsum("ijbn,ibnd->jbnd", self._block_dropout(p, blk_seed), d_out)
+                    d_p = self._block_dropout(tf.einsum("ibnd,jbnd->ijbn", d_out, tf.cast(v_blk, tf.float32)), blk_seed)
+                    d_score = p * (d_p - delta[:, None])
+                    d_rw, d_rr, d_k, d_r = tape.gradient(attn_score, [rw_head_q, rr_head_q, k_blk, r], output_gradients=d_score)
+                    return [tf.cast(g, tf.float32) for g in (d_rw, d_rr, d_r)], d_k, tf.cast(d_v, v.dtype)
+
+                def grad_body(i, s, d_rw, d_rr, d_r, d_ks, d_vs):
+                    s, e, r_fn, offset, blk_seed = mem_block(s)
+                    (g_rw, g_rr, g_r), d_k, d_v = backward_block(k[s:e], v[s:e], r_fn, attn_mask[:, s:e], offset, blk_seed)
+                    return i + 1, s + chunk, d_rw + g_rw, d_rr + g_rr, d_r + g_r, d_ks.write(i, d_k), d_vs.write(i, d_v)
+
+                block_shape = tf.TensorShape([None]).concatenate(k.shape[1:])
+                d_ks = tf.TensorArray(k.dtype, size=0, dynamic_size=True, infer_shape=False, element_shape=block_shape)
+                d_vs = tf.TensorArray(v.dtype, size=0, dynamic_size=True, infer_shape=False, element_shape=block_shape)
+                zeros = [tf.zeros(shape_list(x), tf.float32) for x in (rw_head_q, rr_head_q, r)]
+                i, _, d_rw, d_rr, d_r, d_ks, d_vs = tf.while_loop(
+                    lambda i, s, *_: s < mlen, grad_body, (tf.constant(0), tf.constant(0), *zeros, d_ks, d_vs))
+                (g_rw, g_rr, g_r), d_k, d_v = backward_block(k[mlen:], v[mlen:], w_block, attn_mask[:, mlen:], 2 * qlen - 2, seed)
+                d_k = d_ks.write(i, d_k).concat()
+                d_v = d_vs.write(i, d_v).concat()
+                return (tf.cast(d_rw + g_rw, rw_head_q.dtype), tf.cast(d_rr + g_rr, rr_head_q.dtype), d_k, d_v,
+                        tf.cast(d_r + g_r, r.dtype))
+
+            return out, grad
+
+        # scale the queries instead of the scores
+        rw_head_q = (w_head_q + self.r_w_bias) * self.scale
+        rr_head_q = (w_head_q + self.r_r_bias) * self.scale
+        return tf.cast(attend(rw_head_q, rr_head_q, w_head_k, w_head_v, r_head_k), w_head_q.dtype)
+
     def call(self, w, r, attn_mask, mems, head_mask, output_attentions, training=False):
         qlen, rlen, bsz = shape_list(w)[0], shape_list(r)[0], shape_list(w)[1]
        
       
         if mems is not None:
             
-            mems = tf.cast(mems, dtype=w.dtype) #데이터 타입 변환
-            cat = tf.concat([mems, w], 0)  # => (2,3) (2,3) concat => (4,3) 배치 인풋은 어떻게 할것인가 #어차피 메모리를 붙여줘야 하기에 굳이 별도로 3개로 분리하지 않은건가???? 3개다 메모리를 붙여줘야하니깐?
+            # the ring buffer mems come as (newer part, older part) slices, joined in order with w by the same concat
+            mems = [tf.cast(m, dtype=w.dtype) for m in mems] if isinstance(mems, (tuple, list)) else [tf.cast(mems, dtype=w.dtype)] #데이터 타입 변환
+            cat = tf.concat(mems + [w], 0)  # => (2,3) (2,3) concat => (4,3) 배치 인풋은 어떻게 할것인가 #어차피 메모리를 붙여줘야 하기에 굳이 별도로 3개로 분리하지 않은건가???? 3개다 메모리를 붙여줘야하니깐?
                                                                             # 
             if self.pre_lnorm:
                 w_heads = self.qkv_net(self.layer_norm(cat))
@@ -432,38 +597,47 @@ class TFRelPartialLearnableMultiHeadAttn(tf.keras.layers.Layer):
 
         r_head_k = tf.reshape(r_head_k, (rlen, self.n_head, self.d_head))  # qlen x n_head x d_head
 
-        # compute attention score
-        rw_head_q = w_head_q + self.r_w_bias  # qlen x bsz x n_head x d_head
+        if self.attn_impl == "chunked":
+            if output_attentions:
+                raise ValueError("attn_impl chunked does not build the attention probabilities, output_attentions is not supported")
+            if head_mask is not None:
+                raise ValueError("attn_impl chunked does not apply a head_mask")
+            attn_vec = self._chunked_attn(w_head_q, w_head_k, w_head_v, r_head_k, attn_mask, training=training)
+        else:
+            # compute attention score
+            rw_head_q = w_head_q + self.r_w_bias  # qlen x bsz x n_head x d_head
      
-        AC = tf.einsum("ibnd,jbnd->ijbn", rw_head_q, w_head_k)  # qlen x klen x bsz x n_head
+            AC = tf.einsum("ibnd,jbnd->ijbn", rw_head_q, w_head_k)  # qlen x klen x bsz x n_head
 
-        rr_head_q = w_head_q + self.r_r_bias
-        BD = tf.einsum("ibnd,jnd->ijbn", rr_head_q, r_head_k)  # qlen x klen x bsz x n_head
+            rr_head_q = w_head_q + self.r_r_bias
+            BD = tf.einsum("ibnd,jnd->ijbn", rr_head_q, r_head_k)  # qlen x klen x bsz x n_head
 
 
-        BD = self._rel_shift(BD)
+            BD = self._rel_shift(BD)
         
 
-        # [qlen x klen x bsz x n_head]
-        attn_score = AC + BD
-        attn_score = attn_score * self.scale
+            # [qlen x klen x bsz x n_head]
+            attn_score = AC + BD
+            attn_score = attn_score * self.scale
 
-        # compute attention probability
-        if attn_mask is not None:
-            attn_mask_t = attn_mask[:, :, None, None]
-            attn_mask_t = tf.cast(attn_mask_t, dtype=attn_score.dtype)
-            attn_score = attn_score * (1.0 - attn_mask_t) - 1e30 * attn_mask_t
+            # compute attention probability, in float32 under the mixed bfloat16 policy
+            attn_score = tf.cast(attn_score, tf.float32)
+            if attn_mask is not None:
+                # (qlen, klen) mask of every lane or (qlen, klen, bsz) mask per lane
+                attn_mask_t = attn_mask[:, :, None, None] if attn_mask.shape.rank == 2 else attn_mask[:, :, :, None]
+                attn_mask_t = tf.cast(attn_mask_t, dtype=attn_score.dtype)
+                attn_score = attn_score * (1.0 - attn_mask_t) - 1e30 * attn_mask_t
 
-        # [qlen x klen x bsz x n_head]
-        attn_prob = tf.nn.softmax(attn_score, axis=1)
-        attn_prob = self.dropatt(attn_prob, training=training)
+            # [qlen x klen x bsz x n_head]
+            attn_prob = tf.cast(tf.nn.softmax(attn_score, axis=1), w_head_v.dtype)
+            attn_prob = self.dropatt(attn_prob, training=training)
 
-        # Mask heads if we want to
-        if head_mask is not None:
-            attn_prob = attn_prob * head_mask
+            # Mask heads if we want to
+            if head_mask is not None:
+                attn_prob = attn_prob * head_mask
 
-        # compute attention vector
-        attn_vec = tf.einsum("ijbn,jbnd->ibnd", attn_prob, w_head_v)
+            # compute attention vector
+            attn_vec = tf.einsum("ijbn,jbnd->ibnd", attn_prob, w_head_v)
 
         # [qlen x bsz x n_head x d_head]
         attn_vec_sizes = shape_list(attn_vec)
@@ -502,6 +676,8 @@ class TFRelPartialLearnableDecoderLayer(tf.keras.layers.Layer):
         layer_norm_epsilon=1e-5,
         init_std=0.02,
         output_attentions=False,
+        attn_impl="rel_shift",
+        attn_chunk_size=128,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -518,6 +694,8 @@ class TFRelPartialLearnableDecoderLayer(tf.keras.layers.Layer):
             init_std=init_std,
             layer_norm_epsilon=layer_norm_epsilon,
             output_attentions=output_attentions,
+            attn_impl=attn_impl,
+            attn_chunk_size=attn_chunk_size,
             name="dec_attn",
         )
         self.pos_ff = TFPositionwiseFF(
@@ -998,7 +1176,8 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
         self.linear = tf.keras.layers.Dense(self.config.hidden_size)
         self.activation = tf.keras.layers.Activation('gelu')
         self.layer_norm = tf.keras.layers.LayerNormalization(epsilon=self.config.layer_norm_epsilon)
-        self.decoder = tf.keras.layers.Dense(self.config.R_vocab_size, use_bias=False)  # No bias in this layer
+        # float32 logits for the softmax and the loss under the mixed bfloat16 policy
+        self.decoder = tf.keras.layers.Dense(self.config.R_vocab_size, use_bias=False, dtype="float32")  # No bias in this layer
     
         
 
@@ -1006,6 +1185,8 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
 
         self.n_layer = config.n_layer
         self.mem_len = config.mem_len
+        # mems as one (n_layer, mem_len, bsz, d_model) ring buffer, only the new steps are written each call
+        self.mem_ring = getattr(config, "mem_ring", False) and config.mem_len > 0
         self.attn_type = config.attn_type
 
         self.layers = []
@@ -1025,6 +1206,8 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
                         layer_norm_epsilon=config.layer_norm_epsilon,
                         init_std=config.init_std,
                         output_attentions=self.output_attentions,
+                        attn_impl=getattr(config, "attn_impl", "rel_shift"),
+                        attn_chunk_size=getattr(config, "attn_chunk_size", 128),
                         name=f"layers_._{i}",
                     )
                 )
@@ -1035,7 +1218,9 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
         self.clamp_len = config.clamp_len
 
         if self.attn_type == 0:  # default attention
-            self.pos_emb = TFPositionalEmbedding(self.d_model, name="pos_emb")
+            self.pos_emb = TFPositionalEmbedding(
+                self.d_model, max_len=config.mem_len + getattr(config, "tgt_len", 0), clamp_len=self.clamp_len, name="pos_emb"
+            )
         else:  # learnable embeddings and absolute embeddings
             raise NotImplementedError  # Removed these to avoid maintaining dead code - They are not used in our pretrained checkpoint
 
@@ -1094,11 +1279,46 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
         for i in range(len(hids)):
             mems[i] = tf.cast(mems[i], dtype=hids[i].dtype)
             cat = tf.concat([mems[i], hids[i]], axis=0)
-            tf.stop_gradient(cat)
+            cat = tf.stop_gradient(cat)
             new_mems.append(cat[beg_idx:end_idx]) # 항상 메모리의 길이가 400이 되도록 유지
 
         return new_mems
 
+    def _update_ring_mems(self, hids, mems, mem_pos, qlen):
+        '''
+        _update_mems of the ring buffer: the last min(qlen, mem_len) hids are written over the oldest steps of the
+        stacked mems (n_layer, mem_len, bsz, d_model), whose oldest step is at mem_pos % mem_len.
+        A tf.Variable buffer is updated in place and only those steps are copied, a tensor buffer is copied to a new one.
+        '''
+        n = tf.minimum(qlen, self.mem_len)
+        new = tf.stop_gradient(tf.stack([h[qlen - n:] for h in hids], axis=0))  # n_layer x n x bsz x d_model
+        slots = (mem_pos + tf.range(qlen - n, qlen)) % self.mem_len
+        indices = tf.stack(tf.meshgrid(tf.range(self.n_layer), slots, indexing="ij"), axis=-1)  # n_layer x n x 2
+        if isinstance(mems, tf.Variable):
+            mems.scatter_nd_update(indices, tf.cast(new, dtype=mems.dtype))
+        else:
+            mems = tf.tensor_scatter_nd_update(mems, indices, tf.cast(new, dtype=mems.dtype))
+        return mems, mem_pos + qlen
+
+    def _user_attn_mask(self, user_pos, mlen, qlen):
+        '''
+        user_pos (qlen, bsz): tokens since the start of the user of every query.
+        Returns the (qlen, klen, bsz) mask, 1 on the keys (mems or inputs) of the other users of a lane: the previous
+        ones and the next ones of the same segment. Also the first key any query attends to, the keys before it can be
+        dropped from the mems.
+        '''
+        # key index of the first token of the user of every query, the mems are keys 0 ~ mlen-1
+        user_start = mlen + tf.range(qlen)[:, None] - user_pos
+        # key index of the first token of the next user (user_pos 0 after the query), mlen + qlen if none in the segment
+        steps = tf.range(qlen)
+        is_next_start = (steps[None, :, None] > steps[:, None, None]) & tf.equal(user_pos, 0)[None, :, :]
+        next_start = tf.reduce_min(tf.where(is_next_start, steps[None, :, None], qlen), axis=1)
+        user_end = mlen + next_start
+        keys = tf.range(mlen + qlen)[None, :, None]
+        mask = (keys < user_start[:, None, :]) | (keys >= user_end[:, None, :])
+        kbeg = tf.clip_by_value(tf.reduce_min(user_start), 0, mlen)
+        return tf.cast(mask, tf.float32), kbeg
+
     def call(
         self,
         concepts=None,
@@ -1110,6 +1330,8 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
         output_hidden_states=None,
         return_dict=None,
         labels=None,
+        user_pos=None,
+        mem_pos=None,
         training=False,
         **kwargs,
     ):
@@ -1125,6 +1347,8 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            user_pos=user_pos,
+            mem_pos=mem_pos,
             training=training,
             kwargs_call=kwargs,
         )
@@ -1153,6 +1377,13 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
             raise ValueError("You have to specify either input_ids or inputs_embeds")
         if inputs["mems"] is None:
             inputs["mems"] = self.init_mems(bsz)
+        if self.mem_ring:
+            if isinstance(inputs["mems"], (list, tuple)):
+                inputs["mems"] = tf.stack(inputs["mems"], axis=0)
+            inputs["mem_pos"] = 0 if inputs["mem_pos"] is None else inputs["mem_pos"]
+        elif tf.is_tensor(inputs["mems"]):
+            # stacked (n_layer, mem_len, bsz, d_model) mems, as a tf.function with a fixed signature passes them
+            inputs["mems"] = tf.unstack(inputs["mems"], num=self.n_layer)
 
         # Prepare head mask if needed
         # 1.0 in head_mask indicate we keep the head
@@ -1180,6 +1411,19 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
 
         klen = mlen + qlen
 
+        # mask the mems and inputs of the previous users of every lane, the mems no query attends to are not computed
+        dec_attn_mask = None
+        kbeg = 0
+        if inputs["user_pos"] is not None:
+            dec_attn_mask, kbeg = self._user_attn_mask(tf.transpose(inputs["user_pos"], perm=(1, 0)), mlen, qlen)
+            dec_attn_mask = dec_attn_mask[:, kbeg:]
+            klen = klen - kbeg
+        if self.mem_ring:
+            # the logical mems [kbeg:] are the ring steps [mem_lo:] + [mem_hi:mem_ptr]
+            mem_ptr = inputs["mem_pos"] % mlen
+            mem_lo = tf.minimum(mem_ptr + kbeg, mlen)
+            mem_hi = tf.maximum(mem_ptr + kbeg - mlen, 0)
+
         # attn_mask = tf.ones([qlen, qlen])
         # mask_u = tf.linalg.band_part(attn_mask, 0, -1)
         # mask_dia = tf.linalg.band_part(attn_mask, 0, 0)
@@ -1207,8 +1451,6 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
 
         
         if self.attn_type == 0:  # default
-            pos_seq = tf.range(klen - 1, -1, -1.0)
-
             '''
             pos_seq = tf.Tensor(
             [119. 118. 117. 116. 115. 114. 113. 112. 111. 110. 109. 108. 107. 106. 105.
@@ -1223,16 +1465,20 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
             
             
             '''
-            if self.clamp_len > 0:
-                pos_seq = tf.minimum(pos_seq, self.clamp_len)
-            pos_emb = self.pos_emb(pos_seq) # (pos_seq.len,배치크기, 임베딩 차원)
+            # the klen rows of the table built with the layer, no tf.range/sin/cos per step
+            pos_emb = self.pos_emb.positions(klen) # (klen, 1, 임베딩 차원)
 
             core_out = self.drop(word_emb, training=inputs["training"])
             pos_emb = self.drop(pos_emb, training=inputs["training"])
 
             for i, layer in enumerate(self.layers):
                 hids.append(core_out) #레이어의 결과물들이 여기에 저장 된다. 리스트 형태로 
-                mems_i = None if inputs["mems"] is None else inputs["mems"][i] # 레이어별로 만들어진 것을 레이어에 맞게 가져옴
+                if inputs["mems"] is None:
+                    mems_i = None
+                elif self.mem_ring:
+                    mems_i = (inputs["mems"][i][mem_lo:], inputs["mems"][i][mem_hi:mem_ptr])
+                else:
+                    mems_i = inputs["mems"][i][kbeg:] # 레이어별로 만들어진 것을 레이어에 맞게 가져옴
                 layer_outputs = layer(
                     core_out,
                     pos_emb,
@@ -1240,7 +1486,7 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
                     inputs["head_mask"][i],
                     inputs["output_attentions"],
                     training=inputs["training"],
-                    dec_attn_mask = None,
+                    dec_attn_mask = dec_attn_mask,
                 )
                 core_out = layer_outputs[0] # 리스트에 담겨서 나오니깐 0으로 그냥 값 꺼낸 준거고 (3, 36, 128) 인풋과 같은 사이즈 
                 
@@ -1253,7 +1499,11 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
 
         core_out = self.drop(core_out, training=inputs["training"]) #마지막 레이어의 아웃풋  드랍아웃 후에도 shape=(10, 36, 128)
         
-        new_mems = self._update_mems(hids, inputs["mems"], mlen, qlen)  # 각 레이어의 아웃풋과 레이어의 수에 맞게 생성된 메모리가 결합된다. 
+        new_mem_pos = None
+        if self.mem_ring:
+            new_mems, new_mem_pos = self._update_ring_mems(hids, inputs["mems"], inputs["mem_pos"], qlen)
+        else:
+            new_mems = self._update_mems(hids, inputs["mems"], mlen, qlen)  # 각 레이어의 아웃풋과 레이어의 수에 맞게 생성된 메모리가 결합된다. 
         core_out = tf.transpose(core_out, perm=(1, 0, 2)) # bsz,tgt 인풋일 떄 
 
         x = self.linear(core_out) 
@@ -1286,6 +1536,7 @@ class TFTransfoXLMLMMainLayer(tf.keras.layers.Layer):
             mems=new_mems,
             hidden_states=hids,
             attentions=attentions,
+            mem_pos=new_mem_pos,
         )
         
 
@@ -1335,12 +1586,15 @@ class TFTransfoXLModelOutput(ModelOutput):
 
             Attentions weights after the attention softmax, used to compute the weighted average in the self-attention
             heads.
+        mem_pos (`tf.Tensor`, *optional*, returned when `config.mem_ring=True`):
+            Number of steps written to the ring buffer `mems`, pass it back with them.
     """
 
     last_hidden_state: tf.Tensor = None
     mems: List[tf.Tensor] = None
     hidden_states: Optional[Tuple[tf.Tensor]] = None
     attentions: Optional[Tuple[tf.Tensor]] = None
+    mem_pos: Optional[tf.Tensor] = None
 
 
 @dataclass
@@ -1367,6 +1621,8 @@ class TFTransfoXLLMHeadModelOutput(ModelOutput):
 
             Attentions weights after the attention softmax, used to compute the weighted average in the self-attention
             heads.
+        mem_pos (`tf.Tensor`, *optional*, returned when `config.mem_ring=True`):
+            Number of steps written to the ring buffer `mems`, pass it back with them.
     """
     logit: Optional[tf.Tensor] = None
     prediction_scores: tf.Tensor = None
@@ -1374,6 +1630,7 @@ class TFTransfoXLLMHeadModelOutput(ModelOutput):
     hidden_states: Optional[Tuple[tf.Tensor]] = None
     attentions: Optional[Tuple[tf.Tensor]] = None
     labels: Optional[tf.Tensor] = None
+    mem_pos: Optional[tf.Tensor] = None
 
 
 
@@ -1749,6 +2006,8 @@ class TFTransfoXLMLMHeadModel(TFTransfoXLPreTrainedModel):
         output_hidden_states=None,
         return_dict=None,
         labels=None,
+        user_pos=None,
+        mem_pos=None,
         training=False,
         **kwargs,
     ):
@@ -1765,6 +2024,8 @@ class TFTransfoXLMLMHeadModel(TFTransfoXLPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            user_pos=user_pos,
+            mem_pos=mem_pos,
             training=training,
             kwargs_call=kwargs,
         )
@@ -1788,6 +2049,8 @@ class TFTransfoXLMLMHeadModel(TFTransfoXLPreTrainedModel):
             inputs["output_attentions"],
             inputs["output_hidden_states"],
             inputs["return_dict"],
+            user_pos=inputs["user_pos"],
+            mem_pos=inputs["mem_pos"],
             training=inputs["training"],
 
         )
@@ -1835,7 +2098,8 @@ class TFTransfoXLMLMHeadModel(TFTransfoXLPreTrainedModel):
             hidden_states=transformer_outputs.hidden_states,
             attentions=transformer_outputs.attentions,
             prediction_scores=None,#prediction_scores,
-            labels =labels
+            labels =labels,
+            mem_pos=transformer_outputs.mem_pos,
 
         )
 
@@ -0,0 +1,111 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+import numpy as np
+import pytest
+import tensorflow as tf
+from transformers import TransfoXLConfig
+from models.model_for_kt import TFTransfoXLMLMHeadModel, TFRelPartialLearnableMultiHeadAttn, TFPositionalEmbedding
+
+
+def make_model(**kwargs):
+    config = dict(d_embed=32, d_head=8, d_model=32, d_inner=64, mem_len=12, tgt_len=8, n_head=4, n_layer=2,
+                  C_vocab_size=20, Q_vocab_size=20, R_vocab_size=2, mode="concepts", dropout=0.0, dropatt=0.0)
+    config.update(kwargs)
+    return TFTransfoXLMLMHeadModel(TransfoXLConfig(**config))
+
+
+def test_user_pos_isolates_the_students():
+    model = make_model(mem_len=16)
+    rng = np.random.default_rng(0)
+    # one lane: student A (5 tokens) then student B (11 tokens), over two segments of 8
+    concepts = rng.integers(4, 20, 16).astype(np.int32)
+    responses = rng.integers(0, 2, 16).astype(np.int32)
+    user_pos = np.array([0, 1, 2, 3, 4] + list(range(11)), np.int32)
+
+    def run(concepts):
+        mems, logits = None, []
+        for s in range(0, 16, 8):
+            out = model(concepts=concepts[None, s:s + 8], responses=responses[None, s:s + 8], mems=mems,
+                        user_pos=user_pos[None, s:s + 8])
+            mems = out.mems
+            logits.append(out.logit.numpy()[0])
+        return np.concatenate(logits)
+
+    logits = run(concepts)
+    other_b = concepts.copy()
+    other_b[5:] = rng.integers(4, 20, 11)
+    np.testing.assert_allclose(run(other_b)[:5], logits[:5], atol=1e-5)
+    other_a = concepts.copy()
+    other_a[:5] = rng.integers(4, 20, 5)
+    np.testing.assert_allclose(run(other_a)[5:], logits[5:], atol=1e-5)
+
+
+def test_ring_mems_match_the_concat_mems():
+    rng = np.random.default_rng(0)
+    for mem_len, qlen in [(12, 5), (4, 5), (10, 5)]:
+        concat, ring = make_model(mem_len=mem_len), make_model(mem_len=mem_len, mem_ring=True)
+        concepts = tf.constant(rng.integers(4, 20, (3, qlen)), tf.int32)
+        responses = tf.constant(rng.integers(0, 2, (3, qlen)), tf.int32)
+        concat(concepts=concepts, responses=responses)
+        ring(concepts=concepts, responses=responses)
+        ring.set_weights(concat.get_weights())
+
+        mems, ring_mems, mem_pos = None, None, None
+        for step in range(6):
+            concepts = tf.constant(rng.integers(4, 20, (3, qlen)), tf.int32)
+            responses = tf.constant(rng.integers(0, 2, (3, qlen)), tf.int32)
+            user_pos = tf.constant((np.arange(qlen) + step * qlen)[None, :] % np.array([[7], [11], [4]]), tf.int32) \
+                if step % 2 else None
+            out = concat(concepts=concepts, responses=responses, mems=mems, user_pos=user_pos)
+            ring_out = ring(concepts=concepts, responses=responses, mems=ring_mems, mem_pos=mem_pos, user_pos=user_pos)
+            mems, ring_mems, mem_pos = out.mems, ring_out.mems, ring_out.mem_pos
+            np.testing.assert_allclose(ring_out.logit.numpy(), out.logit.numpy(), atol=1e-5)
+
+
+def attention_and_gradients(layer, w, r, mems, attn_mask, graph):
+    def run(w, r, mems):
+        with tf.GradientTape() as tape:
+            tape.watch([w, r] + ([mems] if mems is not None else []))
+            out = layer(w, r, attn_mask, mems, None, False)[0]
+            loss = tf.reduce_sum(out * tf.cos(out))
+        inputs = [w, r] + ([mems] if mems is not None else [])
+        return [out] + tape.gradient(loss, inputs + layer.trainable_variables)
+    return [x.numpy() for x in (tf.function(run) if graph else run)(w, r, mems)]
+
+
+@pytest.mark.parametrize("graph", [False, True])
+@pytest.mark.parametrize("with_mask", [False, True])
+@pytest.mark.parametrize("mlen", [0, 13])
+def test_chunked_attention_matches_rel_shift(graph, with_mask, mlen):
+    rng = np.random.default_rng(0)
+    qlen, bsz = 6, 3
+    w = tf.constant(rng.normal(size=(qlen, bsz, 32)), tf.float32)
+    r = tf.constant(rng.normal(size=(mlen + qlen, 1, 32)), tf.float32)
+    mems = tf.constant(rng.normal(size=(mlen, bsz, 32)), tf.float32) if mlen else None
+    attn_mask = tf.constant((rng.random((qlen, mlen + qlen, bsz)) < 0.3).astype(np.float32)) if with_mask else None
+
+    rel_shift = TFRelPartialLearnableMultiHeadAttn(4, 32, 8, 0.0, attn_impl="rel_shift")
+    # a chunk size that does not divide klen, so the last key block is partial
+    chunked = TFRelPartialLearnableMultiHeadAttn(4, 32, 8, 0.0, attn_impl="chunked", attn_chunk_size=5)
+    rel_shift(w, r, None, mems, None, False)
+    chunked(w, r, None, mems, None, False)
+    chunked.set_weights(rel_shift.get_weights())
+
+    expected = attention_and_gradients(rel_shift, w, r, mems, attn_mask, graph)
+    result = attention_and_gradients(chunked, w, r, mems, attn_mask, graph)
+    assert len(result) == len(expected)
+    for x, y in zip(result, expected):
+        np.testing.assert_allclose(x, y, atol=1e-4)
+
+
+@pytest.mark.parametrize("clamp_len", [0, 9])
+def test_positional_table_slices_match_the_layer(clamp_len):
+    pos_emb = TFPositionalEmbedding(32, max_len=19, clamp_len=clamp_len)
+    positions = tf.function(pos_emb.positions)
+    for klen in [1, 7, 19, 25]:
+        expected = pos_emb(pos_emb._pos_seq(klen)).numpy()
+        np.testing.assert_array_equal(pos_emb.positions(klen).numpy(), expected)
+        np.testing.assert_allclose(positions(tf.constant(klen)).numpy(), expected, atol=1e-6)
@@ -105,13 +105,7 @@ def read_data(fname : str, min_seq_len=3, response_set=[0, 1]) -> (pd.DataFrame,
 
 def get_max_concepts(df: pd.DataFrame) -> int:
 
-    max_concepts = 1
-    for i, row in df.iterrows():
-        cs = row["concepts"].split(",")
-        num_concepts = max([len(c.split("_")) for c in cs])
-        if num_concepts >= max_concepts:
-            max_concepts = num_concepts
-    return max_concepts
+    return dataframe_statistics(df)["max_concepts"]
 
 
 
@@ -119,110 +113,306 @@ def calStatistics(df:pd.DataFrame, stares: list, key: str) ->(int,int,int,int,in
     '''
     check and print data status
     '''
-    allin, allselect = 0, 0
-    allqs, allcs = set(), set()
-    for i, row in df.iterrows():
-        rs = row["responses"].split(",")
-        curlen = len(rs) - rs.count("-1")
-        allin += curlen
-        if "selectmasks" in row:
-            ss = row["selectmasks"].split(",")
-            slen = ss.count("1")
-            allselect += slen
-        if "concepts" in row:
-            cs = row["concepts"].split(",")
-            fc = list()
-            for c in cs:
-                cc = c.split("_")
-                fc.extend(cc)
-            curcs = set(fc) - {"-1"}
-            allcs |= curcs
-        if "questions" in row:
-            qs = row["questions"].split(",")
-            curqs = set(qs) - {"-1"}
-            allqs |= curqs
-    stares.append(",".join([str(s)
-                  for s in [key, allin, df.shape[0], allselect]]))
-    return allin, allselect, len(allqs), len(allcs), df.shape[0]
-
-
-
-
-def extend_multi_concepts(df : pd.DataFrame, effective_keys:set) -> (pd.DataFrame, set):
+    stats = dataframe_statistics(df)
+    stares.append(",".join([str(s) for s in [key, stats["interactions"], stats["users"], stats["selected"]]]))
+    return stats["interactions"], stats["selected"], stats["questions"] or 0, stats["concepts"] or 0, stats["users"]
+
+
+def _present(values : np.ndarray, na_value) -> np.ndarray:
+    # NaN is missing as in pd.notna, and na_value (the -1 padding) when it is given
+    if values.dtype.kind in "iu":
+        return values != int(na_value) if na_value is not None else np.ones(len(values), dtype=bool)
+    present = pd.notna(values)
+    if na_value is not None:
+        present &= values != str(na_value)
+    return present
+
+
+def compute_statistics(n_users : int, questions=None, concepts=None, responses=None, selectmasks=None,
+                       na_value="-1", split_str="_") -> dict:
+    '''
+    Statistics of flat per-interaction arrays in one pass with unique operations.
+    interactions (responses that are not na_value), users, selected (1 of selectmasks), questions and concepts (unique,
+    na_value excluded), max_concepts (of one interaction), avg_concepts_per_question (unique concepts per question of the
+    questions that have one) and na (questions without concept). The ones of a column that is not given are None.
+
+    concepts are the raw 12_24 values of every interaction, only the unique concept values and the unique
+    (question, concept) pairs are split, not every interaction.
+    '''
+    n = len(responses) if responses is not None else len(questions if questions is not None else concepts)
+    stats = {"interactions": int(_present(np.asarray(responses), na_value).sum()) if responses is not None else n,
+             "users": int(n_users), "selected": 0, "questions": None, "concepts": None, "max_concepts": None,
+             "avg_concepts_per_question": None, "na": None}
+    if selectmasks is not None:
+        stats["selected"] = int((np.asarray(selectmasks).astype(str) == "1").sum())
+    if questions is not None:
+        qcodes, quniques = pd.factorize(np.asarray(questions))
+        stats["questions"] = int(_present(np.asarray(quniques), na_value).sum())
+    if concepts is None:
+        return stats
+
+    # NaN concepts (no tag) get the code -1 and no concept
+    rcodes, runiques = pd.factorize(np.asarray(concepts))
+    runiques = np.asarray(runiques)
+    if runiques.dtype.kind in "iu":
+        ulens = np.ones(len(runiques), dtype=np.int64)
+        flat_tokens = runiques
+    else:
+        tokens = [str(c).split(split_str) for c in runiques]
+        ulens = np.array([len(t) for t in tokens], dtype=np.int64)
+        flat_tokens = np.array([t for ts in tokens for t in ts], dtype=object)
+    stats["max_concepts"] = int(max(1, ulens.max(initial=1)))
+    valid = _present(flat_tokens, na_value)
+    tcodes, tuniques = pd.factorize(flat_tokens[valid])
+    stats["concepts"] = len(tuniques)
+    if questions is None:
+        return stats
+
+    # unique (question, raw concept) pairs => their split concepts => number of unique concepts of every question
+    keep = (qcodes >= 0) & (rcodes >= 0)
+    pairs = np.unique(qcodes[keep].astype(np.int64) * len(runiques) + rcodes[keep])
+    pq, pr = pairs // max(len(runiques), 1), pairs % max(len(runiques), 1)
+    reps = ulens[pr]
+    token_starts = np.cumsum(ulens) - ulens
+    token_idx = np.repeat(token_starts[pr] - (np.cumsum(reps) - reps), reps) + np.arange(reps.sum())
+    token_codes = np.full(len(flat_tokens), -1, dtype=np.int64)
+    token_codes[valid] = tcodes
+    pair_q, pair_t = np.repeat(pq, reps), token_codes[token_idx]
+    qc = np.unique(pair_q[pair_t >= 0] * max(len(tuniques), 1) + pair_t[pair_t >= 0])
+    per_question = np.bincount(qc // max(len(tuniques), 1), minlength=len(quniques))
+    qtotal = int((per_question > 0).sum())
+    stats["na"] = len(quniques) - qtotal
+    stats["avg_concepts_per_question"] = round(int(per_question.sum()) / qtotal, 4) if qtotal else None
+    return stats
+
+
+def dataframe_statistics(df : pd.DataFrame) -> dict:
+    '''
+    compute_statistics of a DataFrame with one comma joined row per user (read_data, extend_multi_concepts, id_mapping)
+    '''
+    flat = dict()
+    for col in ["questions", "concepts", "responses", "selectmasks"]:
+        if col in df.columns:
+            flat[col] = flatten_column(df[col].astype(str))[0]
+    return compute_statistics(df.shape[0], **flat)
+
+
+
+
+def flatten_column(col : pd.Series) -> (np.ndarray, np.ndarray):
+    '''
+    Comma joined rows => one flat array of every token + number of tokens of each row.
+    The whole column is joined and split once instead of row by row.
+    '''
+    lens = col.str.count(",").to_numpy(dtype=np.int64) + 1
+    flat = np.array(",".join(col).split(","), dtype=object)
+    return flat, lens
+
+
+def join_rows(flat : np.ndarray, lens : np.ndarray) -> list:
+    '''
+    Inverse of flatten_column, the rows are comma joined again
+    '''
+    ends = np.cumsum(lens)
+    flat = [str(v) for v in flat] if flat.dtype != object else flat.tolist()
+    return [",".join(flat[e - l:e]) for e, l in zip(ends.tolist(), lens.tolist())]
+
+
+def extend_multi_concepts(df : pd.DataFrame, effective_keys:set, return_arrays=False) -> (pd.DataFrame, set):
     '''
     When importing a tag according to the question from the file of kt1.content.csv, several concepts are included in one question as shown in 12_24.
 
     At this time, 12_24 is separated, 12,24 individual concepts are created, and the same responses are given
+
+    The whole dataset is done at once: every column is flattened, the other columns are np.repeat-ed by the number of concepts
+    of each interaction and is_repeat is 0 at the first concept of an interaction and 1 after it.
+
+    return_arrays=True skips joining the rows again and returns the flat arrays of every user instead of a DataFrame:
+    {"uid": (n_users,), "offsets": (n_users + 1,), "questions": (n,), "concepts": (n,), "is_repeat": (n,), other keys: (n,)}
+    questions and concepts stay the raw ids (they are mapped by id_mapping), the other columns are int64.
     '''
     if "questions" not in effective_keys or "concepts" not in effective_keys:
         print("has no questions or concepts! return original.")
         return df, effective_keys
-    extend_keys = set(df.columns) - {"uid"}
+    extend_keys = [key for key in df.columns if key != "uid"]
+
+    concepts, lens = flatten_column(df["concepts"])
+    # number of concepts of every interaction and of every row after the split: one more than the "_" of its field
+    joined = ",".join(concepts)
+    chars = np.frombuffer(joined.encode(), dtype=np.uint8)
+    field = np.cumsum(chars == ord(","))
+    reps = np.bincount(field[chars == ord("_")], minlength=len(concepts)).astype(np.int64) + 1
+    cum_reps = np.concatenate([[0], np.cumsum(reps)])
+    row_ends = np.cumsum(lens)
+    new_lens = cum_reps[row_ends] - cum_reps[row_ends - lens]
+
+    is_repeat = np.ones(cum_reps[-1], dtype=np.int8)  # 1: repeat, 0: original
+    is_repeat[cum_reps[:-1]] = 0
+
+    dextend = {"is_repeat": is_repeat}
+    for key in extend_keys:
+        if key == "concepts":
+            dextend[key] = np.array(joined.replace("_", ",").split(","), dtype=object)
+            continue
+        if return_arrays and key != "questions":
+            flat = np.fromstring(",".join(df[key]), dtype=np.int64, sep=",")
+            key_lens = df[key].str.count(",").to_numpy(dtype=np.int64) + 1
+        else:
+            flat, key_lens = flatten_column(df[key])
+        if not np.array_equal(key_lens, lens) or len(flat) != len(concepts):
+            raise ValueError(f"{key} and concepts have a different number of interactions")
+        dextend[key] = np.repeat(flat, reps)
+    effective_keys.add("is_repeat")
 
-    dres = {"uid": df["uid"]}
-    for _, row in df.iterrows():
-        dextend_infos = dict()
-        for key in extend_keys:
-            dextend_infos[key] = row[key].split(",")
-        dextend_res = dict()
-        for i in range(len(dextend_infos["questions"])):
-            dextend_res.setdefault("is_repeat", [])
-            if dextend_infos["concepts"][i].find("_") != -1:
-                ids = dextend_infos["concepts"][i].split("_")
-                dextend_res.setdefault("concepts", [])
-                dextend_res["concepts"].extend(ids)
-                for key in extend_keys:
-                    if key != "concepts":
-                        dextend_res.setdefault(key, [])
-                        dextend_res[key].extend(
-                            [dextend_infos[key][i]] * len(ids))
-                dextend_res["is_repeat"].extend(
-                    ["0"] + ["1"] * (len(ids) - 1))  # 1: repeat, 0: original
-            else:
-                for key in extend_keys:
-                    dextend_res.setdefault(key, [])
-                    dextend_res[key].append(dextend_infos[key][i])
-                dextend_res["is_repeat"].append("0")
-        for key in dextend_res:
-            dres.setdefault(key, [])
-            dres[key].append(",".join(dextend_res[key]))
+    if return_arrays:
+        dres = {"uid": df["uid"].to_numpy(), "offsets": np.concatenate([[0], np.cumsum(new_lens)])}
+        dres.update(dextend)
+        return dres, effective_keys
 
+    dres = {"uid": df["uid"]}
+    for key in dextend:
+        dres[key] = join_rows(dextend[key], new_lens)
     finaldf = pd.DataFrame(dres)
-    effective_keys.add("is_repeat")
     return finaldf, effective_keys
 
 
 
-def id_mapping(df:pd.DataFrame) ->(pd.DataFrame, dict):
+class Vocabulary:
+    '''
+    id => idx tables of questions, concepts and uid.
+
+    The ids of each key are kept in an array in the order they were added, so the idx of an id is its position + ID_OFFSETS[key]
+    (0~3 of questions and concepts are reserved for the special tokens like eos_token 2 and mask_token 3).
+    An existing vocabulary can be loaded and updated with new data: only the unseen ids are appended at the end,
+    so the idx of every known question/concept (and the trained embeddings) does not change.
+    '''
+    ID_KEYS = ["questions", "concepts", "uid"]
+    ID_OFFSETS = {"questions": 4, "concepts": 4, "uid": 0}
+
+    def __init__(self, ids=None, max_concepts=-1):
+        self.ids = {key: np.array([], dtype=str) for key in self.ID_KEYS}
+        if ids is not None:
+            self.ids.update({key: np.asarray(value).astype(str) for key, value in ids.items()})
+        self.max_concepts = max_concepts
+        self._index = dict()
+
+    def __len__(self):
+        return sum(len(value) for value in self.ids.values())
+
+    def size(self, key : str) -> int:
+        # embedding input_dim of the key, the reserved idx included
+        return len(self.ids[key]) + self.ID_OFFSETS[key]
+
+    def index(self, key : str) -> pd.Index:
+        if key not in self._index:
+            self._index[key] = pd.Index(self.ids[key])
+        return self._index[key]
+
+    def _lookup_unique(self, key : str, values : np.ndarray, prefix : str, add : bool) -> (np.ndarray, np.ndarray):
+        # only the unique values are turned into strings and looked up
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques).astype(str)
+        if prefix:
+            uniques = np.char.add(prefix, uniques)
+        idx = self.index(key).get_indexer(uniques)
+        unseen = idx == -1
+        if unseen.any() and add:
+            # factorize keeps the order of first appearance, the same order id_mapping gave the ids before
+            idx[unseen] = np.arange(len(self.ids[key]), len(self.ids[key]) + unseen.sum())
+            self.ids[key] = np.concatenate([self.ids[key], uniques[unseen]])
+            self._index.pop(key, None)
+        return codes, idx
+
+    def update_map(self, key : str, values : np.ndarray, prefix="") -> np.ndarray:
+        '''
+        Map values (raw ids, str or int) of key to idx, the unseen ids are added to the vocabulary.
+        prefix is put before int ids that lost it, e.g. the questions of the npy store are 123 for q123.
+        '''
+        codes, idx = self._lookup_unique(key, values, prefix, add=True)
+        return (idx + self.ID_OFFSETS[key]).astype(np.int32)[codes]
+
+    def lookup(self, key : str, values : np.ndarray, prefix="") -> np.ndarray:
+        '''
+        Map values of key to idx without changing the vocabulary, KeyError if an id is not in it
+        '''
+        codes, idx = self._lookup_unique(key, values, prefix, add=False)
+        if (idx == -1).any():
+            unknown = pd.unique(np.asarray(values).astype(str)[idx[codes] == -1])
+            raise KeyError(f"unknown {key}: {list(unknown[:10])}")
+        return (idx + self.ID_OFFSETS[key]).astype(np.int32)[codes]
+
+    def to_dict(self) -> dict:
+        '''
+        dkeyid2idx of id_mapping: {"questions": {"q123": 4, ...}, "concepts": {...}, "uid": {...}, "max_concepts": n}
+        '''
+        dkeyid2idx = dict()
+        for key in self.ID_KEYS:
+            if len(self.ids[key]) > 0:
+                dkeyid2idx[key] = dict(zip(self.ids[key].tolist(), range(self.ID_OFFSETS[key], self.size(key))))
+        dkeyid2idx["max_concepts"] = self.max_concepts
+        return dkeyid2idx
+
+    @classmethod
+    def from_dict(cls, dkeyid2idx : dict):
+        ids = dict()
+        for key in cls.ID_KEYS:
+            if key in dkeyid2idx:
+                items = sorted(dkeyid2idx[key].items(), key=lambda item: item[1])
+                ids[key] = np.array([str(id) for id, _ in items])
+        return cls(ids, dkeyid2idx.get("max_concepts", -1))
+
+    def save(self, save_path : str):
+        # npz of fixed width string arrays, np.load reads it without pickle
+        np.savez(save_path, max_concepts=np.array(self.max_concepts),
+                 **{key: self.ids[key] for key in self.ID_KEYS})
+
+    @classmethod
+    def load(cls, load_path : str):
+        '''
+        vocab.npz saved by save, or dkeyid2idx.pkl of the previous versions
+        '''
+        if load_path.endswith(".pkl"):
+            import pickle
+            with open(load_path, "rb") as fin:
+                return cls.from_dict(pickle.load(fin))
+        with np.load(load_path, allow_pickle=False) as data:
+            return cls({key: data[key] for key in cls.ID_KEYS}, int(data["max_concepts"]))
+
+
+def id_mapping(df:pd.DataFrame, vocab=None) ->(pd.DataFrame, dict):
     '''
     The question consisting of q123, q245, etc. is mapped from integer 0, The same goes for concepts
+
+    The ids are mapped column by column with the Vocabulary, so the idx are the same as the first seen order of the rows.
+    Pass the vocab of a previous run to keep its idx and only add the new ids.
     '''
-    id_keys = ["questions", "concepts", "uid"]
+    id_keys = Vocabulary.ID_KEYS
+    vocab = Vocabulary() if vocab is None else vocab
     dres = dict()
-    dkeyid2idx = dict()
     print(f"df.columns: {df.columns}")
     for key in df.columns:
         if key not in id_keys:
             dres[key] = df[key]
-    for i, row in df.iterrows():
-        for key in id_keys:
-            if key not in df.columns:
-                continue
-            dkeyid2idx.setdefault(key, dict()) # {'questions': {}, 'concepts': {}, 'uid': {}}
-            dres.setdefault(key, []) # {'questions': [], 'concepts': [], 'uid': []}
-            curids = []
-            for id in row[key].split(","):
-                if id not in dkeyid2idx[key]:
-                    if key == "concepts":
-                        dkeyid2idx[key][id] = len(dkeyid2idx[key])+4
-                    elif key == "questions":
-                        dkeyid2idx[key][id] = len(dkeyid2idx[key])+4
-                    else :
-                        dkeyid2idx[key][id] = len(dkeyid2idx[key])
-                curids.append(str(dkeyid2idx[key][id]))
-            dres[key].append(",".join(curids))
+    for key in id_keys:
+        if key not in df.columns:
+            continue
+        flat, lens = flatten_column(df[key].astype(str))
+        dres[key] = join_rows(vocab.update_map(key, flat), lens)
     finaldf = pd.DataFrame(dres)
-    return finaldf, dkeyid2idx
+    return finaldf, vocab.to_dict()
+
+
+def id_mapping_arrays(dres : dict, vocab=None, question_prefix="") -> (dict, "Vocabulary"):
+    '''
+    id_mapping of the arrays returned by extend_multi_concepts(return_arrays=True) (or InteractionStore.extend_multi_concepts).
+    questions, concepts and uid are replaced by their int32 idx, the other arrays are kept as they are.
+    '''
+    vocab = Vocabulary() if vocab is None else vocab
+    dres = dict(dres)
+    for key in Vocabulary.ID_KEYS:
+        if key in dres:
+            dres[key] = vocab.update_map(key, dres[key], prefix=question_prefix if key == "questions" else "")
+    return dres, vocab
 
 
 def save_id2idx(dkeyid2idx, save_path):
@@ -355,94 +545,201 @@ def get_mask_tokens(R:list,mask_token:int , eos_token:int):
 
     return R, labels
 
-def get_evalmask_token(R :list, mask_token : int, eos_token : int):
+def insert_eos(flat : np.ndarray, offsets : np.ndarray, eos_token : int) -> (np.ndarray, np.ndarray):
+    '''
+    Flat values of every user (users split by offsets) => int32 stream with eos_token after each user, and the offsets of the users in it
+    '''
+    lens = np.diff(offsets)
+    eos_offsets = np.concatenate([[0], np.cumsum(lens + 1)]).astype(np.int64)
+    stream = np.full(eos_offsets[-1], eos_token, dtype=np.int32)
+    # every value moves right by the number of eos_token before it
+    stream[np.arange(len(flat)) + np.repeat(np.arange(len(lens)), lens)] = flat
+    return stream, eos_offsets
+
+
+def user_positions(offsets : np.ndarray) -> np.ndarray:
+    '''
+    Offsets of the users in a stream => int32 stream of the number of tokens since the start of the user (0 at the first token of every user).
+    The xl model uses it to mask the mems of the previous users.
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lens = np.diff(offsets)
+    return (np.arange(offsets[-1]) - np.repeat(offsets[:-1], lens)).astype(np.int32)
+
+
+def dataframe_eos_streams(df : pd.DataFrame, keys : list, eos_token : int) -> dict:
+    '''
+    Comma joined int rows of every user => {key: int32 stream with eos_token after each user, "offsets": offsets of the users}
+    '''
+    streams = dict()
+    for key in keys:
+        flat = np.fromstring(",".join(df[key]), dtype=np.int64, sep=",")
+        offsets = np.concatenate([[0], np.cumsum(df[key].str.count(",").to_numpy() + 1)])
+        if len(flat) != offsets[-1]:
+            raise ValueError(f"{key} has an empty or not int value")
+        streams[key], streams["offsets"] = insert_eos(flat, offsets, eos_token)
+    return streams
+
+
+def build_segments(streams : dict, batch_size : int, tgt_len : int, layout="rows") -> (dict, int):
+    '''
+    Flat int32 streams of the same length => (n_step * batch_size, tgt_len) rows of every stream for the xl model,
+    to be batched with .batch(batch_size). n_step is the number of full batch_size x tgt_len blocks, the tail after them is dropped.
+
+    layout="rows": the stream is cut into tgt_len rows in order, so a batch is batch_size consecutive rows.
+    The rows are reshaped views of the streams, nothing is copied.
+    layout="lanes": the stream is cut into batch_size contiguous lanes of n_step * tgt_len tokens and batch i holds the i-th tgt_len window
+    of every lane, so row b of a batch continues row b of the previous batch, like the mems of Transformer-XL expect.
+
+    Returns the segments and the number of tokens of each stream that were dropped.
+    '''
+    if layout not in ("rows", "lanes"):
+        raise ValueError(f"unknown layout {layout}, rows or lanes")
+    lengths = {len(stream) for stream in streams.values()}
+    if len(lengths) != 1:
+        raise ValueError(f"the streams have different lengths: {sorted(lengths)}")
+    total = lengths.pop()
+    n_step = total // (batch_size * tgt_len)
+    keep = n_step * batch_size * tgt_len
+    segments = dict()
+    for key, stream in streams.items():
+        stream = np.asarray(stream)[:keep]
+        if layout == "lanes":
+            # (batch_size, n_step, tgt_len) lanes => (n_step, batch_size, tgt_len) batches
+            stream = np.ascontiguousarray(stream.reshape(batch_size, n_step, tgt_len).transpose(1, 0, 2))
+        segments[key] = stream.reshape(-1, tgt_len)
+    return segments, total - keep
+
+
+def get_mask_tokens_batch(R : np.ndarray, mask_token : int, eos_token : int, mlm_probability=0.15, seed=None) -> (np.ndarray, np.ndarray):
+    '''
+    get_mask_tokens of a whole response stream (every user concatenated) at once with numpy.
+    15% of the tokens that are not eos_token are changed to mask_token, labels is the original value there and -100 elsewhere.
+    seed is an int or a np.random.Generator, the same seed gives the same masks.
+    Returns int32 numpy arrays of the shape of R.
+    '''
+    rng = np.random.default_rng(seed)
+    R = np.asarray(R, dtype=np.int32)
+    masked_indices = (rng.random(R.shape) < mlm_probability) & (R != eos_token)
+    labels = np.where(masked_indices, R, -100).astype(np.int32)
+    return np.where(masked_indices, mask_token, R).astype(np.int32), labels
+
+def get_mask_tokens_tf(R : tf.Tensor, mask_token : int, eos_token : int, mlm_probability=0.15, seed=None) -> (tf.Tensor, tf.Tensor):
+    '''
+    get_mask_tokens_batch with tf ops, to draw the masks inside a tf.data map.
+    seed is the shape [2] seed of tf.random.stateless_uniform.
+    '''
+    masked_indices = tf.logical_and(tf.random.stateless_uniform(tf.shape(R), seed=seed) < mlm_probability,
+                                    tf.not_equal(R, eos_token))
+    labels = tf.where(masked_indices, R, -100)
+    return tf.where(masked_indices, tf.cast(mask_token, R.dtype), R), labels
+
+
+def dynamic_mask_dataset(dataset : tf.data.Dataset, mask_token : int, eos_token : int, mlm_probability=0.15, seed=0, epoch=0) -> tf.data.Dataset:
+    '''
+    (tokens, responses) batches saved by make_Tf_data.py --dynamic_mask => (tokens, masked_R, labels) batches.
+    The elements after responses (user_pos of --user_pos) are passed through.
+    The masks only depend on seed, epoch and the index of the batch: every epoch gets new masks and a run can be reproduced.
+    '''
+    epoch_seed = tf.constant(seed, tf.int64) * 1000003 + epoch
+
+    def mask(i, batch):
+        tokens, responses = batch[0], batch[1]
+        masked_R, labels = get_mask_tokens_tf(responses, mask_token, eos_token, mlm_probability, seed=tf.stack([epoch_seed, i]))
+        return (tokens, masked_R, labels) + tuple(batch[2:])
+
+    return dataset.enumerate().map(mask, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+def get_evalmask_token_batch(R : np.ndarray, mask_token=3, eos_token=2, *, offsets=None, mlm_probability=0.15, seed=None) -> (np.ndarray, np.ndarray):
+    '''
+    get_evalmask_token of every user at once with numpy.
+    R is the response stream of every user concatenated with offsets (n_users + 1) of the users in it,
+    or a (n_users, seq_len) batch with one user per row when offsets is None (a 1-D R without offsets is one user).
+
+    For every user, 15% of the tokens that are not eos_token are selected, one of them is chosen at random
+    and every token after it (eos_token excluded) is masked. A user without a selected token is not masked.
+    seed is an int or a np.random.Generator, the same seed gives the same masks.
+    Returns int32 numpy arrays of the shape of R.
+    '''
+    rng = np.random.default_rng(seed)
+    R = np.asarray(R, dtype=np.int32)
+    shape = R.shape
+    if offsets is None:
+        if R.ndim == 1:
+            offsets = np.array([0, len(R)], dtype=np.int64)
+        elif R.ndim == 2:
+            offsets = np.arange(shape[0] + 1, dtype=np.int64) * shape[1]
+            R = R.reshape(-1)
+        else:
+            raise ValueError(f"R has to be a 1-D stream or a (n_users, seq_len) batch, got shape {shape}")
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lens = np.diff(offsets)
+    user = np.repeat(np.arange(len(lens)), lens)
+
+    special_token_mask = R == eos_token
+    masked_indices = (rng.random(R.shape) < mlm_probability) & ~special_token_mask
+    counts = np.bincount(user[masked_indices], minlength=len(lens))
+
+    # one of the selected tokens of every user, chosen uniformly
+    masked_positions = np.flatnonzero(masked_indices)
+    choice = np.floor(rng.random(len(lens)) * counts).astype(np.int64)
+    first = np.cumsum(counts) - counts
+    selected = np.full(len(lens), np.iinfo(np.int64).max)
+    has_mask = counts > 0
+    selected[has_mask] = masked_positions[first[has_mask] + choice[has_mask]]
+
+    extended_mask = (np.arange(len(R)) > selected[user]) & ~special_token_mask
+    labels = np.where(extended_mask, R, -100).astype(np.int32)
+    R = np.where(extended_mask, mask_token, R).astype(np.int32)
+    return R.reshape(shape), labels.reshape(shape)
+
+
+def get_evalmask_token(R :list, mask_token : int, eos_token : int, seed=None):
     '''
     Select a particular element with a 15% probability => 1, mask_a, 2, 3, 4, mask_b
     After randomly selecting one of the above particular element again, all the rear parts are masked based on the corresponding elements. =>  randomly select mask_a, mask_b and then all elements are masked
     behind mask_a or mask_b
-    '''
-    mlm_probability=0.15
-    labels = tf.identity(R)
-    
-    # 확률 행렬 생성
-    probability_matrix = tf.fill(tf.shape(labels), mlm_probability)
-    
-    # 특별 토큰에 대한 마스크 생성
-    special_token_mask = tf.equal(R, eos_token)
-    
-    # 확률 행렬에 특별 토큰 마스크 적용
-    probability_matrix = tf.where(special_token_mask, 0.0, probability_matrix)
-    
-    # 마스킹할 인덱스 생성
-    masked_indices = tf.cast(tf.random.uniform(tf.shape(labels)) < probability_matrix, tf.bool)
-    
-    # 모든 마스킹된 인덱스 찾기
-    all_masked_indices = tf.where(masked_indices)
-    all_masked_indices = all_masked_indices[:, 0]
-    
-    # 마스킹할 인덱스가 없는 경우, 원래의 R 및 labels 반환
-    if tf.size(all_masked_indices) == 0:
-        return R, tf.fill(tf.shape(labels), -100)
-    
-    # 랜덤으로 선택된 마스킹된 인덱스
-    random_index = tf.random.uniform(shape=(), minval=0, maxval=tf.size(all_masked_indices), dtype=tf.int32)
-    selected_masked_index = tf.cast(tf.gather(all_masked_indices, random_index), dtype=tf.int32)
-    
-    # 랜덤으로 선택된 마스킹된 인덱스 이후의 모든 요소에 대한 마스크 생성
-    extended_mask = tf.range(tf.size(labels)) > selected_masked_index
-    extended_mask = tf.logical_and(extended_mask, ~special_token_mask)
-    
-    # 확장된 마스크 적용
-    labels = tf.where(~extended_mask, -100, labels)
-    R = tf.where(extended_mask, mask_token, R)
 
-    return R, labels
+    One user of get_evalmask_token_batch, use that one for many users.
+    Returns int32 numpy arrays, not the tf tensors of the tf version; tf ops (tf.concat, tf.reshape) take them as they are.
+    '''
+    R = np.asarray(R, dtype=np.int32)
+    return get_evalmask_token_batch(R, mask_token, eos_token, seed=seed)
 
 
 
 def sta_infos(df, keys, stares, split_str="_"):
     # keys: 0: uid , 1: concept, 2: question
-    uids = df[keys[0]].unique()
-    if len(keys) == 2:
-        cids = df[keys[1]].unique()
-    elif len(keys) > 2:
-        qids = df[keys[2]].unique()
-        ctotal = 0
-        cq = df.drop_duplicates([keys[2], keys[1]])[[keys[2], keys[1]]]
-        cq[keys[1]] = cq[keys[1]].fillna("NANA")
-        cids, dq2c = set(), dict()
-        for i, row in cq.iterrows():
-            q = row[keys[2]]
-            ks = row[keys[1]]
-            dq2c.setdefault(q, set())
-            if ks == "NANA":
-                continue
-            for k in str(ks).split(split_str):
-                dq2c[q].add(k)
-                cids.add(k)
-        ctotal, na, qtotal = 0, 0, 0
-        for q in dq2c:
-            if len(dq2c[q]) == 0:
-                na += 1 # questions has no concept
-                continue
-            qtotal += 1
-            ctotal += len(dq2c[q])
-        
-        avgcq = round(ctotal / qtotal, 4)
-    avgins = round(df.shape[0] / len(uids), 4)
-    ins, us, qs, cs = df.shape[0], len(uids), "NA", len(cids)
-    avgcqf, naf = "NA", "NA"
+    # one row per interaction, like the merged csv of make_txt.py
+    us = df[keys[0]].nunique()
     if len(keys) > 2:
-        qs, avgcqf, naf = len(qids), avgcq, na
-    curr = [ins, us, qs, cs, avgins, avgcqf, naf]
+        cq = df.drop_duplicates([keys[2], keys[1]])
+        return sta_infos_of_pairs(df.shape[0], us, cq[keys[2]].to_numpy(), cq[keys[1]].to_numpy(), stares, split_str)
+    curr = [df.shape[0], us, "NA", df[keys[1]].nunique(dropna=False), round(df.shape[0] / us, 4), "NA", "NA"]
     stares.append(",".join([str(s) for s in curr]))
-    return ins, us, qs, cs, avgins, avgcqf, naf
+    return tuple(curr)
+
+
+def sta_infos_of_pairs(ins : int, us : int, questions : np.ndarray, concepts : np.ndarray, stares : list, split_str="_") -> tuple:
+    '''
+    sta_infos from the interaction and user counts and the unique (question, concept) pairs, so the pairs of several
+    parts of the data (the shards of make_txt.py) can be joined first
+    '''
+    # only NaN is a missing tag here, as in the fillna("NANA") of the row loop this replaces
+    stats = compute_statistics(us, questions, concepts, na_value=None, split_str=split_str)
+    curr = [ins, us, stats["questions"], stats["concepts"], round(ins / us, 4), stats["avg_concepts_per_question"], stats["na"]]
+    stares.append(",".join([str(s) for s in curr]))
+    return tuple(curr)
 
 def write_txt(file, data):
     with open(file, "w") as f:
-        for dd in data:
-            for d in dd:
-                f.write(",".join(d) + "\n")
+        write_txt_lines(f, data)
+
+def write_txt_lines(f, data):
+    # append the 6 lines of each user to an already opened file
+    for dd in data:
+        for d in dd:
+            f.write(",".join(d) + "\n")
 
 from datetime import datetime
 def change2timestamp(t, hasf=True):
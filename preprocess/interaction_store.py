@@ -0,0 +1,417 @@
+import os
+import json
+import shutil
+import itertools
+import numpy as np
+
+
+STORE_VERSION = 1
+
+# per interaction columns and their dtype. timestamps are unix ms, so they do not fit in int32
+INTERACTION_COLUMNS = {
+    "questions": np.int32,
+    "responses": np.int32,
+    "timestamps": np.int64,
+    "usetimes": np.int32,
+}
+# concepts are stored as a flat int32 array + concept_offsets (n_interactions + 1), because one question can have several tags (12_24)
+CONCEPT_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+
+
+def encode_lines(uid_lines : list, question_lines : list, concept_lines : list, response_lines : list,
+                 timestamp_lines : list, usetime_lines : list, question_prefix="q") -> dict:
+    '''
+    Turn the 6 txt lines of a batch of users (uid,len / questions / concepts / responses / timestamps / usetimes)
+    into flat int arrays. The lines of one field are joined and parsed with one np.fromstring call.
+
+    q4970 => 4970, 30_24_48 => concepts [30, 24, 48] with concept_lens 3
+    '''
+    if len(uid_lines) == 0:
+        return {"uid": np.zeros(0, dtype=np.int64), "seq_lens": np.zeros(0, dtype=OFFSET_DTYPE),
+                "concept_lens": np.zeros(0, dtype=OFFSET_DTYPE), "concepts": np.zeros(0, dtype=CONCEPT_DTYPE),
+                **{key: np.zeros(0, dtype=dtype) for key, dtype in INTERACTION_COLUMNS.items()}}
+
+    def parse(lines, dtype):
+        return np.fromstring(",".join(lines), dtype=np.int64, sep=",").astype(dtype)
+
+    header = parse(uid_lines, np.int64).reshape(-1, 2)
+    questions = ",".join(question_lines)
+    if question_prefix:
+        questions = questions.replace(question_prefix, "")
+    concepts = ",".join(concept_lines)
+    # the concepts of an interaction are one more than its "_"
+    is_sep = np.frombuffer(concepts.encode(), dtype=np.uint8)
+    field = np.cumsum(is_sep == ord(","))
+    concept_lens = 1 + np.bincount(field[is_sep == ord("_")], minlength=field[-1] + 1 if len(field) else 0)
+
+    res = {
+        "uid": header[:, 0],
+        "seq_lens": header[:, 1].astype(OFFSET_DTYPE),
+        "questions": np.fromstring(questions, dtype=np.int64, sep=",").astype(INTERACTION_COLUMNS["questions"]),
+        "concept_lens": concept_lens.astype(OFFSET_DTYPE),
+        "concepts": np.fromstring(concepts.replace("_", ","), dtype=np.int64, sep=",").astype(CONCEPT_DTYPE),
+        "responses": parse(response_lines, INTERACTION_COLUMNS["responses"]),
+        "timestamps": parse(timestamp_lines, INTERACTION_COLUMNS["timestamps"]),
+        "usetimes": parse(usetime_lines, INTERACTION_COLUMNS["usetimes"]),
+    }
+    total = int(res["seq_lens"].sum())
+    for key in ["questions", "concept_lens", "responses", "timestamps", "usetimes"]:
+        if len(res[key]) != total:
+            raise ValueError(f"{key} has {len(res[key])} values but the users have {total} interactions")
+    if int(res["concept_lens"].sum()) != len(res["concepts"]):
+        raise ValueError(f"concepts has {len(res['concepts'])} values but the tags have {int(res['concept_lens'].sum())}")
+    return res
+
+
+def encode_user_inters(user_inters : list, question_prefix="q") -> dict:
+    '''
+    encode_lines for the user_inters list made by make_txt ([[uid, len], questions, concepts, responses, timestamps, usetimes] of each user)
+    '''
+    return encode_lines(*[[",".join(u[k]) for u in user_inters] for k in range(6)], question_prefix=question_prefix)
+
+
+def _finalize_npy(part_path : str, npy_path : str, dtype, length : int):
+    '''
+    Put a .npy header in front of a raw column written with ndarray.tofile, copying it in blocks so the column is never loaded
+    '''
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": (length,)}
+    with open(npy_path, "wb") as fout:
+        np.lib.format.write_array_header_1_0(fout, header)
+        with open(part_path, "rb") as fin:
+            shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+    os.remove(part_path)
+
+
+class InteractionStoreWriter:
+    '''
+    Write users to a store directory as they come, so the whole dataset never has to be held in memory.
+
+    store_dir/
+        uid.npy              (n_users,)           int64
+        offsets.npy          (n_users + 1,)       int64  interactions of user i are [offsets[i], offsets[i+1])
+        questions.npy        (n_interactions,)    int32
+        responses.npy        (n_interactions,)    int32
+        timestamps.npy       (n_interactions,)    int64
+        usetimes.npy         (n_interactions,)    int32
+        concept_offsets.npy  (n_interactions + 1,) int64 concepts of interaction j are [concept_offsets[j], concept_offsets[j+1])
+        concepts.npy         (n_concepts,)        int32
+        meta.json
+    '''
+    def __init__(self, store_dir : str, question_prefix="q"):
+        self.store_dir = store_dir
+        self.question_prefix = question_prefix
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.uid = []
+        self.seq_lens = []
+        self.concept_lens = []
+        self.lengths = {key: 0 for key in list(INTERACTION_COLUMNS) + ["concepts"]}
+        self.dtypes = dict(INTERACTION_COLUMNS, concepts=CONCEPT_DTYPE)
+        self.parts = {key: open(self._part_path(key), "wb") for key in self.dtypes}
+
+    def _part_path(self, key):
+        return os.path.join(self.store_dir, f"{key}.npy.part")
+
+    def append_users(self, user_inters : list):
+        self.append_arrays(encode_user_inters(user_inters, self.question_prefix))
+
+    def append_arrays(self, arrays : dict):
+        '''
+        arrays is the dict returned by encode_lines / encode_user_inters
+        '''
+        self.uid.append(np.asarray(arrays["uid"], dtype=np.int64))
+        self.seq_lens.append(np.asarray(arrays["seq_lens"], dtype=OFFSET_DTYPE))
+        self.concept_lens.append(np.asarray(arrays["concept_lens"], dtype=OFFSET_DTYPE))
+        for key, dtype in self.dtypes.items():
+            values = np.ascontiguousarray(arrays[key], dtype=dtype)
+            values.tofile(self.parts[key])
+            self.lengths[key] += len(values)
+
+    def close(self) -> str:
+        for key, fpart in self.parts.items():
+            fpart.close()
+            _finalize_npy(self._part_path(key), os.path.join(self.store_dir, f"{key}.npy"), self.dtypes[key], self.lengths[key])
+
+        seq_lens = np.concatenate(self.seq_lens) if self.seq_lens else np.zeros(0, dtype=OFFSET_DTYPE)
+        concept_lens = np.concatenate(self.concept_lens) if self.concept_lens else np.zeros(0, dtype=OFFSET_DTYPE)
+        np.save(os.path.join(self.store_dir, "uid.npy"), np.concatenate(self.uid) if self.uid else np.zeros(0, dtype=np.int64))
+        np.save(os.path.join(self.store_dir, "offsets.npy"), np.concatenate([[0], np.cumsum(seq_lens)]).astype(OFFSET_DTYPE))
+        np.save(os.path.join(self.store_dir, "concept_offsets.npy"), np.concatenate([[0], np.cumsum(concept_lens)]).astype(OFFSET_DTYPE))
+
+        meta = {
+            "version": STORE_VERSION,
+            "question_prefix": self.question_prefix,
+            "n_users": int(len(seq_lens)),
+            "n_interactions": int(seq_lens.sum()),
+            "n_concepts": int(self.lengths["concepts"]),
+        }
+        with open(os.path.join(self.store_dir, "meta.json"), "w") as fout:
+            fout.write(json.dumps(meta))
+        return self.store_dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for fpart in self.parts.values():
+                fpart.close()
+
+
+def _gather_ranges(values : np.ndarray, starts : np.ndarray, lens : np.ndarray) -> np.ndarray:
+    '''
+    values[starts[0]:starts[0]+lens[0]] + values[starts[1]:...] + ... without a python loop
+    '''
+    total = int(lens.sum())
+    if total == 0:
+        return values[:0]
+    shift = np.repeat(starts - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens)
+    return values[np.arange(total) + shift]
+
+
+class InteractionStore:
+    '''
+    Read side of the store made by InteractionStoreWriter. The columns are memory mapped,
+    so user(i) and flat(key) of a full store are views on the files and no python object is made per interaction.
+
+    users is the index of the users selected by read_store (for example the ones with seq_len >= min_seq_len).
+    '''
+    def __init__(self, columns : dict, uid : np.ndarray, offsets : np.ndarray, concept_offsets : np.ndarray, meta : dict, users=None):
+        self.columns = columns
+        self.uid = uid
+        self.offsets = offsets
+        self.concept_offsets = concept_offsets
+        self.meta = meta
+        self.users = np.arange(len(uid)) if users is None else users
+
+    @classmethod
+    def load(cls, store_dir : str, mmap_mode="r"):
+        with open(os.path.join(store_dir, "meta.json"), "r") as fin:
+            meta = json.loads(fin.read())
+        if meta.get("version") != STORE_VERSION:
+            raise ValueError(f"store version {meta.get('version')} of {store_dir} is not supported (expected {STORE_VERSION})")
+
+        def load_npy(name):
+            return np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        columns = {key: load_npy(key) for key in list(INTERACTION_COLUMNS) + ["concepts"]}
+        return cls(columns, load_npy("uid"), load_npy("offsets"), load_npy("concept_offsets"), meta)
+
+    @classmethod
+    def from_arrays(cls, arrays : dict, question_prefix="q"):
+        '''
+        In-memory store from the dict returned by encode_lines
+        '''
+        columns = {key: arrays[key] for key in list(INTERACTION_COLUMNS) + ["concepts"]}
+        offsets = np.concatenate([[0], np.cumsum(arrays["seq_lens"])]).astype(OFFSET_DTYPE)
+        concept_offsets = np.concatenate([[0], np.cumsum(arrays["concept_lens"])]).astype(OFFSET_DTYPE)
+        meta = {"version": STORE_VERSION, "question_prefix": question_prefix, "n_users": int(len(arrays["uid"])),
+                "n_interactions": int(offsets[-1]), "n_concepts": int(concept_offsets[-1])}
+        return cls(columns, arrays["uid"], offsets, concept_offsets, meta)
+
+    def __len__(self):
+        return len(self.users)
+
+    @property
+    def all_users(self) -> bool:
+        return len(self.users) == len(self.uid)
+
+    @property
+    def seq_lens(self) -> np.ndarray:
+        return (self.offsets[1:] - self.offsets[:-1])[self.users]
+
+    @property
+    def num_interactions(self) -> int:
+        return int(self.seq_lens.sum())
+
+    def select(self, mask : np.ndarray):
+        '''
+        Keep the users where mask is True. Only the user index changes, the columns are shared.
+        '''
+        return InteractionStore(self.columns, self.uid, self.offsets, self.concept_offsets, self.meta, users=self.users[mask])
+
+    def user(self, i : int) -> dict:
+        u = self.users[i]
+        beg, end = self.offsets[u], self.offsets[u + 1]
+        res = {"uid": self.uid[u]}
+        for key in INTERACTION_COLUMNS:
+            res[key] = self.columns[key][beg:end]
+        res["concept_offsets"] = self.concept_offsets[beg:end + 1] - self.concept_offsets[beg]
+        res["concepts"] = self.columns["concepts"][self.concept_offsets[beg]:self.concept_offsets[end]]
+        return res
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.user(i)
+
+    def flat_offsets(self) -> np.ndarray:
+        '''
+        offsets of the selected users in the arrays returned by flat
+        '''
+        return np.concatenate([[0], np.cumsum(self.seq_lens)]).astype(OFFSET_DTYPE)
+
+    def flat(self, key : str) -> np.ndarray:
+        '''
+        One column of the selected users as one flat array.
+        A view on the file when every user is selected, otherwise the selected ranges are gathered.
+        concepts returns the concepts of every interaction, use flat("concept_lens") to split them again.
+        '''
+        if key == "concept_lens":
+            if self.all_users:
+                return np.diff(self.concept_offsets)
+            starts, lens = self.offsets[self.users], self.seq_lens
+            inter = _gather_ranges(np.arange(len(self.concept_offsets) - 1), starts, lens)
+            return self.concept_offsets[inter + 1] - self.concept_offsets[inter]
+        if key == "concepts":
+            if self.all_users:
+                return self.columns["concepts"]
+            starts, ends = self.offsets[self.users], self.offsets[self.users + 1]
+            cstarts = self.concept_offsets[starts]
+            return _gather_ranges(self.columns["concepts"], cstarts, self.concept_offsets[ends] - cstarts)
+        if self.all_users:
+            return self.columns[key]
+        return _gather_ranges(self.columns[key], self.offsets[self.users], self.seq_lens)
+
+    def extend_multi_concepts(self) -> dict:
+        '''
+        Array form of data_utils.extend_multi_concepts(df, keys, return_arrays=True) for the selected users.
+        The concepts are already split in the store, so the other columns are only np.repeat-ed by concept_lens.
+        questions are the int ids without the question prefix.
+        '''
+        reps = self.flat("concept_lens")
+        cum_reps = np.concatenate([[0], np.cumsum(reps)]).astype(OFFSET_DTYPE)
+        is_repeat = np.ones(cum_reps[-1], dtype=np.int8)  # 1: repeat, 0: original
+        is_repeat[cum_reps[:-1]] = 0
+
+        dres = {"uid": self.uid[self.users], "offsets": cum_reps[self.flat_offsets()], "is_repeat": is_repeat,
+                "concepts": np.asarray(self.flat("concepts"))}
+        for key in INTERACTION_COLUMNS:
+            dres[key] = np.repeat(self.flat(key), reps)
+        return dres
+
+
+def read_store(store_dir : str, min_seq_len=3, response_set=[0, 1], mmap_mode="r") -> (InteractionStore, set):
+    '''
+    read_data for a store directory. The users with seq_len < min_seq_len or with a response out of response_set are dropped
+    and the same statistics are printed, but nothing is parsed: the result is a memory mapped InteractionStore.
+    '''
+    store = InteractionStore.load(store_dir, mmap_mode=mmap_mode)
+    effective_keys = {"uid", "questions", "concepts", "responses", "timestamps", "usetimes"}
+
+    seq_lens = store.seq_lens
+    short = seq_lens < min_seq_len
+    delstu, delnum = int(short.sum()), int(seq_lens[short].sum())
+    goodnum = int(seq_lens[~short].sum())
+
+    # number of bad responses of each user, from the cumulative sum over the whole column
+    bad = ~np.isin(store.columns["responses"], response_set)
+    cum_bad = np.concatenate([[0], np.cumsum(bad)])
+    bad_users = (cum_bad[store.offsets[1:]] - cum_bad[store.offsets[:-1]]) > 0
+    badr = int((bad_users & ~short).sum())
+
+    keep = ~short & ~bad_users
+    if not keep.all():
+        store = store.select(keep)
+    print(
+        f"delete bad stu num of len: {delstu}, delete interactions: {delnum}, of r: {badr}, good num: {goodnum}")
+    return store, effective_keys
+
+
+def read_data_chunked(fname : str, min_seq_len=3, response_set=[0, 1], chunk_users=4096, store_dir=None, question_prefix="q") -> (InteractionStore, set):
+    '''
+    Streaming, vectorized read_data for the 6-line txt file.
+
+    The file is read chunk_users users (6 * chunk_users lines) at a time. The python work is per line
+    (length / NA / response checks), the numbers of a whole chunk are parsed with np.fromstring by encode_lines,
+    so the result is int arrays instead of joined strings. The same delstu/delnum/badr/goodnum statistics are printed.
+
+    With store_dir every chunk is appended to an InteractionStoreWriter and the result is memory mapped from disk,
+    so the peak memory depends on chunk_users and not on the file size.
+    Without it the chunks are concatenated into an in-memory InteractionStore.
+    A field written as NA is filled with -1. A file ending inside a user (not a multiple of 6 lines) raises ValueError.
+    '''
+    effective_keys = set()
+    delstu, delnum, badr = 0, 0, 0
+    goodnum = 0
+    response_set = np.asarray(response_set)
+    # a response line may only contain these characters, anything else is a bad response like in read_data
+    not_number = str.maketrans("", "", "0123456789,-")
+
+    writer = InteractionStoreWriter(store_dir, question_prefix) if store_dir is not None else None
+    chunks = []
+    user_i = 0
+    with open(fname, "r", encoding="utf8") as fin:
+        while True:
+            lines = list(itertools.islice(fin, 6 * chunk_users))
+            n_users = len(lines) // 6
+            # only the last chunk can end inside a user, empty lines at the end of the file are fine
+            if any(line.strip() for line in lines[6 * n_users:]):
+                raise ValueError(f"{fname}: the last user (line {6 * (user_i + n_users)}) has {len(lines) - 6 * n_users} of its 6 lines")
+            if n_users == 0:
+                break
+
+            kept = []
+            for u in range(n_users):
+                block = [line.strip() for line in lines[6 * u: 6 * u + 6]]
+                effective_keys.add("uid")
+                seq_len = int(block[0].split(",")[1])
+                if seq_len < min_seq_len:  # delete use seq len less than min_seq_len
+                    delstu += 1
+                    delnum += seq_len
+                    continue
+                goodnum += seq_len
+                if block[1].find("NA") == -1:
+                    effective_keys.add("questions")
+                if block[2].find("NA") == -1:
+                    effective_keys.add("concepts")
+                effective_keys.add("responses")
+                if block[3].find("NA") == -1 and block[3].translate(not_number) != "":
+                    print(f"error response in line: {6 * (user_i + u) + 3}")
+                    badr += 1
+                    continue
+                kept.append((u, seq_len, block))
+
+            # response set check of the whole chunk at once
+            if len(kept) > 0:
+                responses = [b[3] if b[3].find("NA") == -1 else ",".join(["-1"] * l) for _, l, b in kept]
+                values = np.fromstring(",".join(responses), dtype=np.int64, sep=",")
+                lens = np.array([l for _, l, _ in kept])
+                cum_bad = np.concatenate([[0], np.cumsum(~np.isin(values, response_set))])
+                ends = np.cumsum(lens)
+                bad_users = (cum_bad[ends] - cum_bad[ends - lens]) > 0
+                # NA responses are kept like in read_data
+                bad_users &= np.array([b[3].find("NA") == -1 for _, _, b in kept])
+                for k in np.nonzero(bad_users)[0]:
+                    print(f"error response in line: {6 * (user_i + kept[k][0]) + 3}")
+                badr += int(bad_users.sum())
+                kept = [k for k, bad in zip(kept, bad_users) if not bad]
+
+            fields = [[] for _ in range(6)]
+            for _, seq_len, block in kept:
+                if block[4].find("NA") == -1:
+                    effective_keys.add("timestamps")
+                if block[5].find("NA") == -1:
+                    effective_keys.add("usetimes")
+                for k in range(6):
+                    fields[k].append(block[k] if k == 0 or block[k].find("NA") == -1 else ",".join(["-1"] * seq_len))
+            arrays = encode_lines(*fields, question_prefix=question_prefix)
+
+            if writer is not None:
+                writer.append_arrays(arrays)
+            else:
+                chunks.append(arrays)
+            user_i += n_users
+
+    if writer is not None:
+        store = InteractionStore.load(writer.close())
+    elif len(chunks) > 0:
+        store = InteractionStore.from_arrays({key: np.concatenate([c[key] for c in chunks]) for key in chunks[0]}, question_prefix)
+    else:
+        store = InteractionStore.from_arrays(encode_lines([], [], [], [], [], []), question_prefix)
+    print(
+        f"delete bad stu num of len: {delstu}, delete interactions: {delnum}, of r: {badr}, good num: {goodnum}")
+    return store, effective_keys
@@ -1,12 +1,11 @@
 
 import tensorflow as tf
-from data_utils import read_data,get_max_concepts,calStatistics,extend_multi_concepts,id_mapping,save_id2idx,train_test_split,save_dcur,get_evalmask_token, get_mask_tokens
-import itertools
+from data_utils import read_data,extend_multi_concepts,id_mapping,train_test_split, Vocabulary, dataframe_statistics, dataframe_eos_streams, get_mask_tokens_batch, get_evalmask_token_batch, build_segments, user_positions
 import pickle
+import json
 import os
 import argparse
 import logging
-from tqdm import tqdm
 import pandas as pd
 
 
@@ -17,122 +16,40 @@ logging.basicConfig(level=logging.INFO)
 
 
 def make_dataframe_with_eos_mask(train_df :pd.DataFrame,test_df:pd.DataFrame,args) -> (dict,dict):
-
-    train = {"qseqs": [], "cseqs": [], "masked_R": [], "labels": []} #"q_shift": [], "c_shift": [], "r_shift": []}
-    test = {"qseqs": [], "cseqs": [], "masked_R": [], "labels": []} #"q_shift": [], "c_shift": [], "r_shift": []}
+    '''
+    Train and test streams {"qseqs", "cseqs", "masked_R", "labels", "user_pos": int32 stream of every user, "offsets": offsets of the users}
+    '''
 
     # Make the value '12,52,1' to 12,52,1 and attach eos_token to concepts and questions by uid.
-    for i, row in tqdm(train_df.iterrows(),desc="Train_df"):
-        cseq_list=[int(_) for _ in row["concepts"].split(",")]
-        cseq_list.append(args.eos_token)
-        train["cseqs"].append(cseq_list)
-
-        qes_list=[int(_) for _ in row["questions"].split(",")]
-        qes_list.append(args.eos_token)
-        train["qseqs"].append(qes_list)
-
-
-        rseq_list=[(int(_)) for _ in row["responses"].split(",")]
-        rseq_list.append(args.eos_token)
-        masked_R, labels = get_mask_tokens(rseq_list,args.mask_token, args.eos_token)
-        train["masked_R"].append(masked_R)
-        train["labels"].append(labels)
-
-
-        
-    for i, row in tqdm(test_df.iterrows(),desc="Test_df"):
-        cseq_list=[int(_) for _ in row["concepts"].split(",")]
-        cseq_list.append(args.eos_token)   
-        test["cseqs"].append(cseq_list)
-
-        qes_list=[int(_) for _ in row["questions"].split(",")]
-        qes_list.append(args.eos_token)
-        test["qseqs"].append(qes_list)
+    # Every column is parsed once into one int32 stream of all the users.
+    train_streams = dataframe_eos_streams(train_df, ["concepts", "questions", "responses"], args.eos_token)
+    test_streams = dataframe_eos_streams(test_df, ["concepts", "questions", "responses"], args.eos_token)
 
-
-        rseq_list=[(int(_)) for _ in row["responses"].split(",")]
-        rseq_list.append(args.eos_token)
-        masked_R, labels = get_evalmask_token(rseq_list, args.mask_token, args.eos_token)
-        
-        test["masked_R"].append(masked_R)
-        test["labels"].append(labels)
+    if args.dynamic_mask:
+        # the trainer draws the masks every epoch, masked_R and labels hold the raw responses
+        masked_R = labels = train_streams["responses"]
+    else:
+        # the 15% MLM masks of the whole train stream are drawn in one call
+        masked_R, labels = get_mask_tokens_batch(train_streams["responses"], args.mask_token, args.eos_token, seed=args.seed)
+    train = {"qseqs": train_streams["questions"], "cseqs": train_streams["concepts"],
+             "masked_R": masked_R, "labels": labels, "user_pos": user_positions(train_streams["offsets"]), "offsets": train_streams["offsets"]}
+    # the evaluation masks of every test user in one call
+    test_masked_R, test_labels = get_evalmask_token_batch(test_streams["responses"], args.mask_token, args.eos_token, offsets=test_streams["offsets"], seed=args.seed)
+    test = {"qseqs": test_streams["questions"], "cseqs": test_streams["concepts"],
+            "masked_R": test_masked_R, "labels": test_labels, "user_pos": user_positions(test_streams["offsets"]), "offsets": test_streams["offsets"]}
 
     return train, test
 
-def Slice_the_train(train:dict, args)->():
-    #train data  
-    #Work out how cleanly we can divide the dataset into bsz,tgt_len parts
-    train_cseqs_list = list(itertools.chain(*train['cseqs']))
-    train_qseqs_list = list(itertools.chain(*train['qseqs']))
-    r_masked_list = tf.concat(train['masked_R'], axis=0)
-    labels = tf.concat(train['labels'], axis=0)
-
-    n_step = len(train_cseqs_list) // (args.batch_size*args.tgt_len)
-
-    train_sliced_cseqs = tf.slice(train_cseqs_list,[0],[n_step * args.batch_size*args.tgt_len])  
-    train_sliced_qseqs = tf.slice(train_qseqs_list,[0],[n_step * args.batch_size*args.tgt_len])  
-    sliced_r_mask = tf.slice(r_masked_list,[0],[n_step * args.batch_size*args.tgt_len]) 
-    sliced_labels = tf.slice(labels,[0],[n_step * args.batch_size*args.tgt_len])
-    return train_sliced_cseqs,train_sliced_qseqs,sliced_r_mask,sliced_labels
-
-def Slice_the_test(test:dict,args)->():
-
-    #test data  
-    #Work out how cleanly we can divide the dataset into bsz,tgt_len parts        
-    test_cseqs_list = list(itertools.chain(*test['cseqs']))
-    test_qseqs_list = list(itertools.chain(*test['qseqs']))
-    test_r_masked_list = tf.concat(test['masked_R'], axis=0)
-    test_labels = tf.concat(test['labels'], axis=0)
-    
-    test_n_step = len(test_cseqs_list) // (args.batch_size*args.tgt_len)
-
-    test_sliced_cseqs = tf.slice(test_cseqs_list,[0],[test_n_step * args.batch_size*args.tgt_len])  
-    test_sliced_qseqs = tf.slice(test_qseqs_list,[0],[test_n_step * args.batch_size*args.tgt_len])  
-    test_sliced_r_masked_seq = tf.slice(test_r_masked_list,[0],[test_n_step * args.batch_size*args.tgt_len]) 
-
-    test_sliced_labels = tf.slice(test_labels,[0],[test_n_step * args.batch_size*args.tgt_len])  
-
-    return test_sliced_cseqs,test_sliced_qseqs,test_sliced_r_masked_seq,test_sliced_labels
-
 
-
-def reshape_transpose_train_tensor(train_sliced_cseqs,train_sliced_qseqs,sliced_r_mask,sliced_labels,args):
-    new_shape = (-1,args.tgt_len)  # 나머지 차원은 자동으로 계산됨
-
-    train_qseq_reshaped = tf.reshape(train_sliced_qseqs, new_shape)
-    train_cseq_reshaped = tf.reshape(train_sliced_cseqs, new_shape)
-
-    train_r_mask_reshaped = tf.reshape(sliced_r_mask, new_shape)
-    train_labels_reshaped = tf.reshape(sliced_labels, new_shape)
-
-    # Because of the einsum calculation of the xl model dataset batch, tgt_len dimension changed
-    # train_cseq_transposed = tf.transpose(train_cseq_reshaped)
-    # train_qseq_transposed = tf.transpose(train_qseq_reshaped)
-    # train_r_mask_transposed = tf.transpose(train_r_mask_reshaped)
-    # train_labels_transposed = tf.transpose(train_labels_reshaped)
-
-    # return train_cseq_transposed,train_qseq_transposed,train_r_mask_transposed,train_labels_transposed
-    return train_qseq_reshaped,train_cseq_reshaped,train_r_mask_reshaped, train_labels_reshaped
-    
-    
-
-def reshape_transpose_test_tensor(test_sliced_cseqs,test_sliced_qseqs,test_sliced_r_masked_seq,test_sliced_labels,args):
-   
-    new_shape = (-1,args.tgt_len)  # 나머지 차원은 자동으로 계산됨
-
-    test_qseq_reshaped = tf.reshape(test_sliced_qseqs, new_shape)
-    test_cseq_reshaped = tf.reshape(test_sliced_cseqs, new_shape)
-    test_r_masked_seq_reshaped = tf.reshape(test_sliced_r_masked_seq, new_shape)
-    test_labels_reshaped = tf.reshape(test_sliced_labels, new_shape)
-
-
-    # test_qseq_transposed = tf.transpose(test_qseq_reshaped)
-    # test_cseq_transposed = tf.transpose(test_cseq_reshaped)
-    # test_r_masked_transposed = tf.transpose(test_r_masked_seq_reshaped)
-    # test_labels_transposed = tf.cast(tf.transpose(test_labels_reshaped),tf.int64)
-
-    # return test_qseq_transposed, test_cseq_transposed ,test_r_masked_transposed, test_labels_transposed
-    return test_qseq_reshaped, test_cseq_reshaped, test_r_masked_seq_reshaped, test_labels_reshaped
+def slice_segments(streams : dict, args, name : str) -> dict:
+    '''
+    Work out how cleanly we can divide the dataset into bsz,tgt_len parts and reshape the streams to (-1, tgt_len) rows
+    '''
+    keys = ["qseqs", "cseqs", "masked_R", "labels"] + (["user_pos"] if args.user_pos else [])
+    segments, dropped = build_segments({key: streams[key] for key in keys}, args.batch_size, args.tgt_len,
+                                       layout=args.batch_layout)
+    logging.info(f"{name}: {len(segments['qseqs'])} rows of tgt_len {args.tgt_len} in {args.batch_layout}, {dropped} of {len(streams['qseqs'])} tail tokens dropped")
+    return segments
 
 
 def main(args):
@@ -140,27 +57,30 @@ def main(args):
 
     stares = []
 
+    stats = dataframe_statistics(total_df)
+    stares.append(",".join([str(s) for s in ["original", stats["interactions"], stats["users"], stats["selected"]]]))
     if 'concepts' in effective_keys:
-        max_concepts = get_max_concepts(total_df)
+        max_concepts = stats["max_concepts"]
     else:
         max_concepts = -1
 
-    oris, _, qs, cs, seqnum = calStatistics(total_df, stares, "original") 
-
     logging.info(
-        f"original total interactions: {oris}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")   
+        f"original total interactions: {stats['interactions']}, qs: {stats['questions']}, cs: {stats['concepts']}, seqnum: {stats['users']}, "
+        f"max concepts: {stats['max_concepts']}, avg(c) per q: {stats['avg_concepts_per_question']}, na: {stats['na']}")
 
 
     # questions ,concepts 값들의 숫자를 재정의 하여 0~ 나오도록 만들 면서 is_repeat값 처리
     # 14_54_14 으로 된 concepts를 14,54,14 로 분리하고 기존의 response도 똑같이 확장처리
     total_df_ex, effective_keys = extend_multi_concepts(total_df, effective_keys)
-    total_df, dkeyid2idx = id_mapping(total_df_ex)
-    dkeyid2idx["max_concepts"] = max_concepts
+    # keep the idx of an existing vocabulary and only append the new questions/concepts/uid
+    vocab = Vocabulary.load(args.vocab) if args.vocab else Vocabulary()
+    vocab.max_concepts = max(vocab.max_concepts, max_concepts)
+    total_df, dkeyid2idx = id_mapping(total_df_ex, vocab)
 
-    extends, _, qs, cs, seqnum = calStatistics(
-        total_df, stares, "extend multi")
+    stats = dataframe_statistics(total_df)
+    stares.append(",".join([str(s) for s in ["extend multi", stats["interactions"], stats["users"], stats["selected"]]]))
     logging.info(
-        f"after extend multi, total interactions: {extends}, qs: {qs}, cs: {cs}, seqnum: {seqnum}")
+        f"after extend multi, total interactions: {stats['interactions']}, qs: {stats['questions']}, cs: {stats['concepts']}, seqnum: {stats['users']}")
 
 
     #train test 분리
@@ -168,26 +88,32 @@ def main(args):
 
     train,test = make_dataframe_with_eos_mask(train_df,test_df,args)
 
-    train_sliced_cseqs,train_sliced_qseqs,sliced_r_mask,sliced_labels = Slice_the_train(train,args)
-    test_sliced_cseqs,test_sliced_qseqs,test_sliced_r_masked_seq,test_sliced_labels=Slice_the_test(test,args)
-    logging.info('slice data complited')
-
-    # train_cseq_transposed,train_qseq_transposed,train_r_mask_transposed,train_labels_transposed=reshape_transpose_train_tensor(train_sliced_cseqs,train_sliced_qseqs,sliced_r_mask,sliced_labels,args)
-    # test_qseq_transposed, test_cseq_transposed ,test_r_masked_transposed, test_labels_transposed=reshape_transpose_test_tensor(test_sliced_cseqs,test_sliced_qseqs,test_sliced_r_masked_seq,test_sliced_labels,args)
-    train_qseq_reshaped,train_cseq_reshaped ,train_r_mask_reshaped, train_labels_reshaped=reshape_transpose_train_tensor(train_sliced_cseqs,train_sliced_qseqs,sliced_r_mask,sliced_labels,args)
-    test_qseq_reshaped, test_cseq_reshaped, test_r_masked_seq_reshaped, test_labels_reshaped=reshape_transpose_test_tensor(test_sliced_cseqs,test_sliced_qseqs,test_sliced_r_masked_seq,test_sliced_labels,args)
-    logging.info('reshape and transpose complited')
+    train_segments = slice_segments(train, args, "train")
+    test_segments = slice_segments(test, args, "test")
+    train_qseq_reshaped, train_cseq_reshaped = train_segments["qseqs"], train_segments["cseqs"]
+    train_r_mask_reshaped, train_labels_reshaped = train_segments["masked_R"], train_segments["labels"]
+    test_qseq_reshaped, test_cseq_reshaped = test_segments["qseqs"], test_segments["cseqs"]
+    test_r_masked_seq_reshaped, test_labels_reshaped = test_segments["masked_R"], test_segments["labels"]
+    # tokens since the start of the user as the last element, the model masks the mems of the previous users with it
+    train_extra = (train_segments["user_pos"],) if args.user_pos else ()
+    test_extra = (test_segments["user_pos"],) if args.user_pos else ()
+    logging.info('slice and reshape complited')
 
     #make tf.dataset
-    train_q_dataset = tf.data.Dataset.from_tensor_slices(
-    (train_qseq_reshaped, train_r_mask_reshaped, train_labels_reshaped))
+    if args.dynamic_mask:
+        # only (tokens, responses), data_utils.dynamic_mask_dataset makes (tokens, masked_R, labels) when training
+        train_q_dataset = tf.data.Dataset.from_tensor_slices((train_qseq_reshaped, train_r_mask_reshaped) + train_extra)
+        train_c_dataset = tf.data.Dataset.from_tensor_slices((train_cseq_reshaped, train_r_mask_reshaped) + train_extra)
+    else:
+        train_q_dataset = tf.data.Dataset.from_tensor_slices(
+        (train_qseq_reshaped, train_r_mask_reshaped, train_labels_reshaped) + train_extra)
+        train_c_dataset = tf.data.Dataset.from_tensor_slices(
+        (train_cseq_reshaped, train_r_mask_reshaped, train_labels_reshaped) + train_extra)
     test_q_dataset = tf.data.Dataset.from_tensor_slices(
-    (test_qseq_reshaped, test_r_masked_seq_reshaped, test_labels_reshaped))
+    (test_qseq_reshaped, test_r_masked_seq_reshaped, test_labels_reshaped) + test_extra)
 
-    train_c_dataset = tf.data.Dataset.from_tensor_slices(
-    (train_cseq_reshaped, train_r_mask_reshaped, train_labels_reshaped))
     test_c_dataset = tf.data.Dataset.from_tensor_slices(
-    (test_cseq_reshaped, test_r_masked_seq_reshaped, test_labels_reshaped))
+    (test_cseq_reshaped, test_r_masked_seq_reshaped, test_labels_reshaped) + test_extra)
 
 
 
@@ -206,6 +132,12 @@ def main(args):
     tf.data.experimental.save(test_c_dataset, args.tf_data_dir+'/concepts/test')
     with open(args.tf_data_dir+"/dkeyid2idx.pkl", "wb") as file:
         pickle.dump(dkeyid2idx, file)
+    vocab.save(args.tf_data_dir+"/vocab.npz")
+    # how the datasets were made, train_args.py checks it
+    with open(args.tf_data_dir+"/dataset_info.json", "w") as file:
+        file.write(json.dumps({"batch_size": args.batch_size, "tgt_len": args.tgt_len, "batch_layout": args.batch_layout,
+                               "dynamic_mask": args.dynamic_mask, "user_pos": args.user_pos, "eos_token": args.eos_token, "mask_token": args.mask_token}))
+    logging.info(f"vocab size questions: {vocab.size('questions')}, concepts: {vocab.size('concepts')}, uid: {vocab.size('uid')}")
     logging.info('Making Tf.dataset is complited')
 
     return args.tf_data_dir
@@ -221,8 +153,15 @@ if __name__ == "__main__":
     parser.add_argument('--mask_token', type=int, required=False, default=3)
     parser.add_argument('--test_ratio', type=float, required=False, default=0.2)
     parser.add_argument('--tf_data_dir', type=str, required=True, default='/home/jun/workspace/KT/data/ednet/TF_DATA')
+    parser.add_argument('--seed', type=int, required=False, default=None, help='Seed of the MLM masks, the same seed makes the same dataset')
+    parser.add_argument('--dynamic_mask', action='store_true', help='Save the train split without MLM masks, train_args.py draws new masks every epoch')
+    parser.add_argument('--batch_layout', type=str, required=False, default='rows', choices=['rows', 'lanes'], help='lanes: row b of every batch continues row b of the previous batch, so the mems carry the same stream')
+    parser.add_argument('--user_pos', action='store_true', help='Add the tokens since the start of the user to every element, train_args.py masks the other users of a lane with it. Needs --batch_layout lanes')
+    parser.add_argument('--vocab', type=str, required=False, default=None, help='vocab.npz (or dkeyid2idx.pkl) of a previous run, its ids keep their idx and only the unseen ones are added')
 
     args = parser.parse_args()
+    if args.user_pos and args.batch_layout != "lanes":
+        parser.error("--user_pos needs --batch_layout lanes: with rows the mems of a row come from another part of the stream")
 
     if not os.path.exists(args.tf_data_dir):
         logging.info('tf_data_dir : %s', args.tf_data_dir)
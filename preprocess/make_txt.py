@@ -1,24 +1,201 @@
+import numpy as np
 import pandas as pd
 import random
 import logging
 import os
-from data_utils import sta_infos, write_txt
+from functools import partial
+from multiprocessing import Pool
+from data_utils import sta_infos, sta_infos_of_pairs, write_txt, write_txt_lines
+from interaction_store import InteractionStoreWriter, encode_lines, INTERACTION_COLUMNS, CONCEPT_DTYPE, OFFSET_DTYPE
 from tqdm import tqdm
 import argparse
 
 
-parser = argparse.ArgumentParser(description='make_txt')
-parser.add_argument('--read_folder', type=str, required=True, default='/home/jun/workspace/KT/data/ednet/')
-parser.add_argument('--name_txt', type=str, required=True)
-parser.add_argument('--dataset_name', type=str, required=False, default='ednet')
-args = parser.parse_args()
-
 logging.basicConfig(level=logging.INFO)
 
+KEYS = ["user_id", "tags", "question_id"]
+UID_RANGE = 840473
+
+
+
+def load_question_df(question_path : str) -> pd.DataFrame:
+    '''
+    Load contents/questions.csv, turn the 15;2;182 tags into 15_2_182 and drop the questions without a tag
+    '''
+    question_df = pd.read_csv(question_path)
+    question_df['tags'] = question_df['tags'].apply(lambda x:x.replace(";","_"))
+    question_df = question_df[question_df['tags']!='-1']
+    return question_df
+
+
+def merge_user_interactions(user_df : pd.DataFrame, question_df : pd.DataFrame) -> pd.DataFrame:
+    '''
+    Attach the tags/correct_answer of each question to the user logs and make the correct(1)/wrong(0) column
+    '''
+    merged_df = user_df.merge(question_df, sort=False,how='left')
+    merged_df = merged_df.dropna(subset=["user_id", "question_id", "elapsed_time", "timestamp", "tags", "user_answer"])
+    # a column with a NaN is read as float, after dropna it is int again so the serial and sharded paths write the same lines
+    merged_df['timestamp'] = merged_df['timestamp'].astype('int64')
+    merged_df['elapsed_time'] = merged_df['elapsed_time'].astype('int64')
+    merged_df['correct'] = (merged_df['correct_answer']==merged_df['user_answer']).apply(int)
+    return merged_df
+
+
+def make_user_inters(merged_df : pd.DataFrame, progress=True) -> list:
+    '''
+    Group the merged logs by user and make the 6 lines (uid,len / questions / concepts / responses / timestamps / usetimes) of each user
+    '''
+    ui_df = merged_df.groupby('user_id', sort=False)
+
+    user_inters = []
+    for ui in tqdm(ui_df, disable=not progress):
+        user, tmp_inter = ui[0], ui[1]
+        tmp_inter = tmp_inter.sort_values(by=["timestamp", "index"])
+        seq_len = len(tmp_inter)
+        seq_skills = tmp_inter['tags'].astype(str).tolist()
+        seq_ans = tmp_inter['correct'].astype(str).tolist()
+        seq_problems = tmp_inter['question_id'].astype(str).tolist()
+        seq_start_time = tmp_inter['timestamp'].astype(str).tolist()
+        seq_response_cost = tmp_inter['elapsed_time'].astype(str).tolist()
+
+        assert seq_len == len(seq_problems) == len(seq_ans)
 
+        user_inters.append(
+            [[str(user), str(seq_len)], seq_problems, seq_skills, seq_ans, seq_start_time, seq_response_cost])
+    return user_inters
+
+
+def make_user_arrays(merged_df : pd.DataFrame, question_prefix="q") -> dict:
+    '''
+    The dict of encode_lines (flat int arrays per column, users in the order of make_user_inters) built from the columns
+    of the merged logs, without formatting the interactions as strings
+    '''
+    # users in the order of groupby(sort=False), the interactions of a user by timestamp, index
+    user_codes, users = pd.factorize(merged_df['user_id'])
+    order = np.lexsort((merged_df['index'].to_numpy(), merged_df['timestamp'].to_numpy(), user_codes))
+    df = merged_df.iloc[order]
+
+    tags = df['tags'].astype(str)
+    concept_lens = tags.str.count("_").to_numpy() + 1
+    concepts = np.fromstring(",".join(tags).replace("_", ","), dtype=np.int64, sep=",")
+    if len(concepts) != concept_lens.sum():
+        raise ValueError(f"concepts has {len(concepts)} values but the tags have {int(concept_lens.sum())}")
+    return {
+        "uid": np.asarray(users, dtype=np.int64),
+        "seq_lens": np.bincount(user_codes, minlength=len(users)).astype(OFFSET_DTYPE),
+        "questions": df['question_id'].astype(str).str[len(question_prefix):].astype(np.int64).to_numpy().astype(INTERACTION_COLUMNS["questions"]),
+        "concept_lens": concept_lens.astype(OFFSET_DTYPE),
+        "concepts": concepts.astype(CONCEPT_DTYPE),
+        "responses": df['correct'].to_numpy().astype(INTERACTION_COLUMNS["responses"]),
+        "timestamps": df['timestamp'].to_numpy().astype(INTERACTION_COLUMNS["timestamps"]),
+        "usetimes": df['elapsed_time'].to_numpy().astype(INTERACTION_COLUMNS["usetimes"]),
+    }
+
+
+def list_user_files(read_file : str, seed=2) -> list:
+    '''
+    List the KT1_sample folder once and return (uid, path) of the existing u{}.csv files in the seeded shuffle order of read_data_from_csv
+    '''
+    sample_dir = os.path.join(read_file, "KT1_sample")
+    existing = set(os.listdir(sample_dir))
+
+    random.seed(seed)
+    samp = [i for i in range(UID_RANGE)]
+    random.shuffle(samp)
+
+    return [(unum, os.path.join(sample_dir, f"u{unum}.csv")) for unum in samp if f"u{unum}.csv" in existing]
+
+
+def store_path(write_file : str) -> str:
+    # data.txt => data/ (directory of the npy store)
+    return os.path.splitext(write_file)[0]
+
+
+# questions.csv of each worker process, loaded once by the pool initializer
+_worker_question_df = None
+
+def _init_shard_worker(question_path : str):
+    global _worker_question_df
+    _worker_question_df = load_question_df(question_path)
+
+
+def _process_shard(shard : list, output_format="txt") -> (list, int, pd.DataFrame):
+    '''
+    Read, merge and format one shard of user files inside a worker process.
+    Only the formatted lines (or the int arrays of make_user_arrays for the npy store) of the shard are sent back, the global concatenated frame is never built.
+    The unique (question, tags) rows of the shard are sent back too, for the sta_infos of all the shards.
+    '''
+    file_list = list()
+    for unum, df_path in shard:
+        df = pd.read_csv(df_path)
+        df['user_id'] = unum
+        file_list.append(df)
+    if len(file_list) == 0:
+        return ([] if output_format == "txt" else encode_lines([], [], [], [], [], [])), 0, pd.DataFrame(columns=[KEYS[2], KEYS[1]])
+
+    user_df = pd.concat(file_list)
+    # the order inside a user is kept, so a shard-local index sorts the same as the global one
+    user_df["index"] = range(user_df.shape[0])
+    merged_df = merge_user_interactions(user_df, _worker_question_df)
 
-def read_data_from_csv(read_file : str, write_file :str,dataset_name :str) -> (str, str):
-    KEYS = ["user_id", "tags", "question_id"]
+    pairs = merged_df.drop_duplicates([KEYS[2], KEYS[1]])[[KEYS[2], KEYS[1]]]
+    if output_format == "npy":
+        return make_user_arrays(merged_df), len(merged_df), pairs
+    return make_user_inters(merged_df, progress=False), len(merged_df), pairs
+
+
+def read_data_from_csv_parallel(read_file : str, write_file :str, dataset_name :str, num_workers : int, shard_size=1000, output_format="txt") -> (str, str):
+    '''
+    Process-pool version of read_data_from_csv.
+
+    The user files are listed once and split into shards of shard_size users (in the seeded shuffle order).
+    Each worker reads its shard, merges it with questions.csv and formats the users,
+    and the shards are written to write_file in order as they come back, so the txt file is the same as the serial one.
+    With output_format="npy" the shards are appended to the columnar store at store_path(write_file) instead.
+    '''
+    stares = []
+    write_dir = None
+    if not dataset_name is None:
+        write_file = write_file.replace("/ednet/", f"/{dataset_name}/")
+        write_dir = read_file.replace("/ednet/", f"/{dataset_name}")
+        logging.info(f"write_dir is {write_dir}")
+        logging.info(f"write_file is {write_file}")
+
+    user_files = list_user_files(read_file)
+    logging.info(f"total user num: {len(user_files)}")
+    shards = [user_files[i:i + shard_size] for i in range(0, len(user_files), shard_size)]
+
+    question_path = os.path.join(read_file, 'contents', 'questions.csv')
+    ins, us, pairs = 0, 0, []
+    if output_format == "npy":
+        writer = InteractionStoreWriter(store_path(write_file))
+    else:
+        fout = open(write_file, "w")
+    with Pool(num_workers, initializer=_init_shard_worker, initargs=(question_path,)) as pool:
+        for user_inters, shard_ins, shard_pairs in tqdm(pool.imap(partial(_process_shard, output_format=output_format), shards), total=len(shards), desc="shards"):
+            if output_format == "npy":
+                writer.append_arrays(user_inters)
+            else:
+                write_txt_lines(fout, user_inters)
+            ins += shard_ins
+            us += len(user_inters["uid"]) if output_format == "npy" else len(user_inters)
+            pairs.append(shard_pairs)
+    if output_format == "npy":
+        write_file = writer.close()
+    else:
+        fout.close()
+
+    # a user is in one shard only, so the counts add up and only the (question, tags) pairs are joined
+    cq = pd.concat(pairs).drop_duplicates()
+    ins, us, qs, cs, avgins, avgcq, na = sta_infos_of_pairs(ins, us, cq[KEYS[2]].to_numpy(), cq[KEYS[1]].to_numpy(), stares)
+    logging.info(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+    stares.append(stares[-1])
+    logging.info(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
+    logging.info("\n".join(stares))
+    return write_dir, write_file
+
+
+def read_data_from_csv(read_file : str, write_file :str,dataset_name :str, output_format="txt") -> (str, str):
     stares = []
 
     if not dataset_name is None:
@@ -29,7 +206,7 @@ def read_data_from_csv(read_file : str, write_file :str,dataset_name :str) -> (s
 
     # uid range
     random.seed(2)
-    samp = [i for i in range(840473)]
+    samp = [i for i in range(UID_RANGE)]
     random.shuffle(samp)
 
 
@@ -46,59 +223,55 @@ def read_data_from_csv(read_file : str, write_file :str,dataset_name :str) -> (s
             file_list.append(df)
             count = count + 1
 
-        
+
     start_i =0
     logging.info(f"total user num: {count}")
     user_df = pd.concat(file_list[start_i:])
     logging.info(f"after sub user_df: {len(user_df)}")
     user_df["index"] = range(user_df.shape[0])
-    question_df = pd.read_csv(os.path.join(read_file, 'contents', 'questions.csv'))
-    
+    question_df = load_question_df(os.path.join(read_file, 'contents', 'questions.csv'))
+
     if not dataset_name is None:
-        read_file = write_dir 
+        read_file = write_dir
 
-    question_df['tags'] = question_df['tags'].apply(lambda x:x.replace(";","_"))
-    question_df = question_df[question_df['tags']!='-1']
-    merged_df = user_df.merge(question_df, sort=False,how='left')
-    merged_df = merged_df.dropna(subset=["user_id", "question_id", "elapsed_time", "timestamp", "tags", "user_answer"])
-    merged_df['correct'] = (merged_df['correct_answer']==merged_df['user_answer']).apply(int)
+    merged_df = merge_user_interactions(user_df, question_df)
 
 
+    # nothing is dropped between the original and after drop report, the statistics are computed once
     ins, us, qs, cs, avgins, avgcq, na = sta_infos(merged_df, KEYS, stares)
     logging.info(f"original interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
-
-
-    ins, us, qs, cs, avgins, avgcq, na = sta_infos(merged_df, KEYS, stares)
+    stares.append(stares[-1])
     logging.info(f"after drop interaction num: {ins}, user num: {us}, question num: {qs}, concept num: {cs}, avg(ins) per s: {avgins}, avg(c) per q: {avgcq}, na: {na}")
-    
-    
-    ui_df = merged_df.groupby('user_id', sort=False)
-
-    user_inters = []
-    for ui in tqdm(ui_df):
-        user, tmp_inter = ui[0], ui[1]
-        tmp_inter = tmp_inter.sort_values(by=["timestamp", "index"])
-        seq_len = len(tmp_inter)
-        seq_skills = tmp_inter['tags'].astype(str)
-        seq_ans = tmp_inter['correct'].astype(str)
-        seq_problems = tmp_inter['question_id'].astype(str)
-        seq_start_time = tmp_inter['timestamp'].astype(str)
-        seq_response_cost = tmp_inter['elapsed_time'].astype(str)
-
-        assert seq_len == len(seq_problems) == len(seq_ans)
 
-        user_inters.append(
-            [[str(user), str(seq_len)], seq_problems, seq_skills, seq_ans, seq_start_time, seq_response_cost])
 
-    write_txt(write_file, user_inters)
+    if output_format == "npy":
+        with InteractionStoreWriter(store_path(write_file)) as writer:
+            writer.append_arrays(make_user_arrays(merged_df))
+        write_file = writer.store_dir
+    else:
+        write_txt(write_file, make_user_inters(merged_df))
     logging.info("\n".join(stares))
     return write_dir, write_file
 
 
-# readf = '/home/jun/workspace/KT/data/ednet/'
-readf=args.read_folder
-dname = "/".join(args.read_folder.split("/")[0:-1])
-writef = os.path.join(dname, args.name_txt)
-dname, writef = read_data_from_csv(readf, writef, args.dataset_name)
-print('dname',type(dname))
-print('writef',type(writef))
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='make_txt')
+    parser.add_argument('--read_folder', type=str, required=True, default='/home/jun/workspace/KT/data/ednet/')
+    parser.add_argument('--name_txt', type=str, required=True)
+    parser.add_argument('--dataset_name', type=str, required=False, default='ednet')
+    parser.add_argument('--num_workers', type=int, required=False, default=0, help='Number of ingestion processes, 0 reads the user files serially')
+    parser.add_argument('--shard_size', type=int, required=False, default=1000, help='Number of user files a worker reads and merges at once')
+    parser.add_argument('--output_format', type=str, required=False, default='txt', choices=['txt', 'npy'], help='txt file or columnar npy store (a directory named after name_txt)')
+    args = parser.parse_args()
+
+    # readf = '/home/jun/workspace/KT/data/ednet/'
+    readf=args.read_folder
+    dname = "/".join(args.read_folder.split("/")[0:-1])
+    writef = os.path.join(dname, args.name_txt)
+    if args.num_workers > 0:
+        dname, writef = read_data_from_csv_parallel(readf, writef, args.dataset_name, args.num_workers, args.shard_size, args.output_format)
+    else:
+        dname, writef = read_data_from_csv(readf, writef, args.dataset_name, args.output_format)
+    print('dname',type(dname))
+    print('writef',type(writef))
@@ -0,0 +1,175 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_directory)
+import numpy as np
+import pandas as pd
+import pytest
+import tensorflow as tf
+from data_utils import extend_multi_concepts, join_rows, id_mapping, id_mapping_arrays, Vocabulary, \
+    get_mask_tokens_batch, get_mask_tokens_tf, dynamic_mask_dataset, get_evalmask_token_batch, get_evalmask_token
+from interaction_store import InteractionStore, encode_lines
+
+
+def interaction_df():
+    return pd.DataFrame({
+        "uid": ["800", "801"],
+        "questions": ["q1,q2,q3", "q2,q4"],
+        "concepts": ["12_24,7,5_6_9", "7,30"],
+        "responses": ["1,0,1", "0,0"],
+        "timestamps": ["100,200,300", "400,500"],
+        "usetimes": ["25000,32000,30000", "28000,37000"],
+    })
+
+
+def test_extend_multi_concepts_splits_the_tags():
+    df = interaction_df()
+    extended, keys = extend_multi_concepts(df, set(df.columns))
+    assert "is_repeat" in keys
+    assert extended["questions"].tolist() == ["q1,q1,q2,q3,q3,q3", "q2,q4"]
+    assert extended["concepts"].tolist() == ["12,24,7,5,6,9", "7,30"]
+    assert extended["responses"].tolist() == ["1,1,0,1,1,1", "0,0"]
+    assert extended["usetimes"].tolist() == ["25000,25000,32000,30000,30000,30000", "28000,37000"]
+    assert extended["is_repeat"].tolist() == ["0,1,0,0,1,1", "0,0"]
+
+
+def test_extend_multi_concepts_arrays_match_the_dataframe():
+    df = interaction_df()
+    extended, _ = extend_multi_concepts(df, set(df.columns))
+    arrays, _ = extend_multi_concepts(df, set(df.columns), return_arrays=True)
+    lens = np.diff(arrays["offsets"])
+    for key in extended.columns:
+        if key == "uid":
+            assert arrays[key].tolist() == extended[key].tolist()
+        else:
+            assert join_rows(arrays[key], lens) == extended[key].tolist(), key
+
+    # the store splits the same tags, its questions are the ids without the q prefix
+    lines = [[",".join([u, str(q.count(",") + 1)]) for u, q in zip(df["uid"], df["questions"])]] + \
+        [df[key].tolist() for key in ["questions", "concepts", "responses", "timestamps", "usetimes"]]
+    store_arrays = InteractionStore.from_arrays(encode_lines(*lines)).extend_multi_concepts()
+    np.testing.assert_array_equal(store_arrays["offsets"], arrays["offsets"])
+    np.testing.assert_array_equal(store_arrays["is_repeat"], arrays["is_repeat"])
+    assert store_arrays["concepts"].astype(str).tolist() == arrays["concepts"].tolist()
+    assert ["q{}".format(q) for q in store_arrays["questions"]] == arrays["questions"].tolist()
+    for key in ["responses", "timestamps", "usetimes"]:
+        np.testing.assert_array_equal(store_arrays[key], arrays[key], err_msg=key)
+
+
+def test_id_mapping_arrays_match_the_dataframe():
+    df = interaction_df()
+    extended, keys = extend_multi_concepts(df, set(df.columns))
+    mapped, dkeyid2idx = id_mapping(extended)
+    arrays, _ = extend_multi_concepts(df, set(df.columns), return_arrays=True)
+    mapped_arrays, vocab = id_mapping_arrays(arrays)
+    assert vocab.to_dict() == dkeyid2idx
+    # idx in the order the ids are first seen, after the 4 reserved tokens
+    assert dkeyid2idx["questions"] == {"q1": 4, "q2": 5, "q3": 6, "q4": 7}
+    lens = np.diff(mapped_arrays["offsets"])
+    for key in ["questions", "concepts"]:
+        assert join_rows(mapped_arrays[key], lens) == mapped[key].tolist(), key
+    assert mapped_arrays["uid"].tolist() == [int(u) for u in mapped["uid"]]
+
+
+def test_vocabulary_update_keeps_the_known_idx(tmp_path):
+    df = interaction_df()
+    arrays, _ = extend_multi_concepts(df.iloc[:1], set(df.columns), return_arrays=True)
+    first, vocab = id_mapping_arrays(arrays)
+    vocab.save(str(tmp_path / "vocab.npz"))
+
+    vocab = Vocabulary.load(str(tmp_path / "vocab.npz"))
+    arrays, _ = extend_multi_concepts(df, set(df.columns), return_arrays=True)
+    second, vocab = id_mapping_arrays(arrays, vocab)
+    n = len(first["questions"])
+    np.testing.assert_array_equal(second["questions"][:n], first["questions"])
+    np.testing.assert_array_equal(second["concepts"][:n], first["concepts"])
+    assert vocab.lookup("questions", np.array(["q4"])).tolist() == [7]
+    with pytest.raises(KeyError):
+        vocab.lookup("questions", np.array(["q99"]))
+
+
+def response_stream(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    R = rng.integers(0, 2, n).astype(np.int32)
+    R[rng.random(n) < 0.05] = 2  # eos_token
+    return R
+
+
+def check_masks(R, masked_R, labels, mask_token=3, eos_token=2):
+    masked = labels != -100
+    assert not masked[R == eos_token].any()
+    np.testing.assert_array_equal(labels[masked], R[masked])
+    assert (masked_R[masked] == mask_token).all()
+    np.testing.assert_array_equal(masked_R[~masked], R[~masked])
+    assert abs(masked.sum() / (R != eos_token).sum() - 0.15) < 0.02
+
+
+def test_mask_tokens_batch_and_tf():
+    R = response_stream()
+    masked_R, labels = get_mask_tokens_batch(R, 3, 2, seed=1)
+    check_masks(R, masked_R, labels)
+    masked_R_again, _ = get_mask_tokens_batch(R, 3, 2, seed=1)
+    np.testing.assert_array_equal(masked_R, masked_R_again)
+
+    masked_R, labels = get_mask_tokens_tf(tf.constant(R), 3, 2, seed=tf.constant([1, 2], tf.int64))
+    check_masks(R, masked_R.numpy(), labels.numpy())
+
+
+def test_dynamic_mask_dataset_draws_new_masks_every_epoch():
+    R = response_stream(n=8 * 50).reshape(8, 50)
+    tokens = np.arange(R.size, dtype=np.int32).reshape(8, 50)
+    dataset = tf.data.Dataset.from_tensor_slices((tokens, R, tokens + 1)).batch(4)
+
+    def epoch(seed, epoch):
+        return [tuple(t.numpy() for t in batch) for batch in dynamic_mask_dataset(dataset, 3, 2, seed=seed, epoch=epoch)]
+
+    first = epoch(0, 0)
+    assert len(first) == 2
+    for i, (batch_tokens, masked_R, labels, user_pos) in enumerate(first):
+        np.testing.assert_array_equal(batch_tokens, tokens[4 * i:4 * i + 4])
+        np.testing.assert_array_equal(user_pos, tokens[4 * i:4 * i + 4] + 1)
+        masked = labels != -100
+        np.testing.assert_array_equal(labels[masked], R[4 * i:4 * i + 4][masked])
+        assert (masked_R[masked] == 3).all()
+    assert all(np.array_equal(a[2], b[2]) for a, b in zip(first, epoch(0, 0)))
+    assert not all(np.array_equal(a[2], b[2]) for a, b in zip(first, epoch(0, 1)))
+    # two batches of one epoch do not repeat the same masks
+    assert not np.array_equal(first[0][2] != -100, first[1][2] != -100)
+
+
+def test_evalmask_masks_everything_after_one_position():
+    rng = np.random.default_rng(0)
+    lens = rng.integers(1, 40, 500)
+    offsets = np.concatenate([[0], np.cumsum(lens)])
+    R = rng.integers(0, 2, offsets[-1]).astype(np.int32)
+    R[offsets[1:] - 1] = 2  # every user ends with eos_token
+    masked_R, labels = get_evalmask_token_batch(R, 3, 2, offsets=offsets, seed=5)
+
+    n_masked_users = 0
+    for beg, end in zip(offsets[:-1], offsets[1:]):
+        r, m, l = R[beg:end], masked_R[beg:end], labels[beg:end]
+        masked = l != -100
+        assert not masked[r == 2].any()
+        np.testing.assert_array_equal(l[masked], r[masked])
+        assert (m[masked] == 3).all() and (m[~masked] == r[~masked]).all()
+        if masked.any():
+            n_masked_users += 1
+            # a suffix: every token after the first masked one is masked, except eos_token
+            first = np.flatnonzero(masked)[0]
+            assert first > 0 and masked[first:][r[first:] != 2].all()
+    assert 0 < n_masked_users < len(lens)
+
+
+def test_evalmask_batch_matches_one_user_at_a_time():
+    rng = np.random.default_rng(1)
+    R = rng.integers(0, 2, (6, 30)).astype(np.int32)
+    rows = get_evalmask_token_batch(R, 3, 2, seed=7)
+    stream = get_evalmask_token_batch(R.reshape(-1), 3, 2, offsets=np.arange(7) * 30, seed=7)
+    np.testing.assert_array_equal(rows[0], stream[0].reshape(6, 30))
+    np.testing.assert_array_equal(rows[1], stream[1].reshape(6, 30))
+
+    masked_R, labels = get_evalmask_token(R[0].tolist(), 3, 2, seed=3)
+    expected = get_evalmask_token_batch(R[:1], 3, 2, seed=3)
+    assert masked_R.dtype == np.int32
+    np.testing.assert_array_equal(masked_R, expected[0][0])
+    np.testing.assert_array_equal(labels, expected[1][0])
@@ -0,0 +1,104 @@
+import os
+import sys
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_directory)
+import numpy as np
+import pandas as pd
+import pytest
+from data_utils import read_data
+from make_txt import merge_user_interactions, make_user_inters, make_user_arrays
+from interaction_store import InteractionStore, InteractionStoreWriter, encode_user_inters, read_data_chunked
+
+
+def merged_logs(n_users=20, seed=0):
+    rng = np.random.default_rng(seed)
+    question_df = pd.DataFrame({"question_id": [f"q{i}" for i in range(1, 31)],
+                                "correct_answer": rng.choice(list("abcd"), 30),
+                                "tags": ["_".join(map(str, rng.integers(0, 50, rng.integers(1, 4)))) for _ in range(30)]})
+    rows = []
+    for user in rng.permutation(10000)[:n_users]:
+        n = int(rng.integers(1, 15))
+        rows.append(pd.DataFrame({"timestamp": 1565332027449 + rng.integers(0, 5, n) * 1000,
+                                  "question_id": [f"q{i}" for i in rng.integers(1, 31, n)],
+                                  "user_answer": rng.choice(list("abcd"), n),
+                                  "elapsed_time": rng.integers(1000, 50000, n),
+                                  "user_id": user}))
+    user_df = pd.concat(rows, ignore_index=True)
+    user_df["index"] = range(len(user_df))
+    return merge_user_interactions(user_df, question_df)
+
+
+def test_make_user_arrays_matches_the_txt_lines():
+    merged_df = merged_logs()
+    expected = encode_user_inters(make_user_inters(merged_df, progress=False))
+    arrays = make_user_arrays(merged_df)
+    assert sorted(arrays) == sorted(expected)
+    for key in expected:
+        assert arrays[key].dtype == expected[key].dtype, key
+        np.testing.assert_array_equal(arrays[key], expected[key], err_msg=key)
+
+
+def test_store_round_trip(tmp_path):
+    merged_df = merged_logs()
+    user_inters = make_user_inters(merged_df, progress=False)
+    with InteractionStoreWriter(str(tmp_path / "store")) as writer:
+        writer.append_users(user_inters[:7])
+        writer.append_users(user_inters[7:])
+    store = InteractionStore.load(str(tmp_path / "store"))
+    assert len(store) == len(user_inters)
+    for (header, questions, concepts, responses, timestamps, usetimes), user in zip(user_inters, store):
+        assert user["uid"] == int(header[0]) and len(user["questions"]) == int(header[1])
+        assert user["questions"].tolist() == [int(q[1:]) for q in questions]
+        assert user["responses"].tolist() == [int(r) for r in responses]
+        assert user["timestamps"].tolist() == [int(t) for t in timestamps]
+        assert user["usetimes"].tolist() == [int(t) for t in usetimes]
+        split = [user["concepts"][b:e].tolist() for b, e in zip(user["concept_offsets"][:-1], user["concept_offsets"][1:])]
+        assert split == [[int(c) for c in tag.split("_")] for tag in concepts]
+
+    # a selection gathers the same users from the flat columns
+    picked = store.select(store.seq_lens >= 5)
+    users = [u for u in store if len(u["questions"]) >= 5]
+    np.testing.assert_array_equal(picked.flat("questions"), np.concatenate([u["questions"] for u in users]))
+    np.testing.assert_array_equal(picked.flat("concepts"), np.concatenate([u["concepts"] for u in users]))
+
+
+def write_txt_file(path, user_inters):
+    with open(path, "w") as fout:
+        for user in user_inters:
+            for line in user:
+                fout.write(",".join(line) + "\n")
+
+
+@pytest.mark.parametrize("store_dir", [None, "store"])
+def test_read_data_chunked_matches_read_data(tmp_path, capsys, store_dir):
+    user_inters = make_user_inters(merged_logs(n_users=30, seed=1), progress=False)
+    # a response out of the response set drops its user like in read_data
+    user_inters[4][3][0] = "2"
+    path = str(tmp_path / "data.txt")
+    write_txt_file(path, user_inters)
+
+    df, keys = read_data(path)
+    expected_log = capsys.readouterr().out
+    assert "of r: 1," in expected_log
+    store, store_keys = read_data_chunked(path, chunk_users=4, store_dir=str(tmp_path / store_dir) if store_dir else None)
+    assert capsys.readouterr().out == expected_log
+    assert store_keys == keys
+    assert len(store) == len(df)
+    for (_, row), user in zip(df.iterrows(), store):
+        assert int(row["uid"]) == user["uid"]
+        assert row["questions"] == ",".join(f"q{q}" for q in user["questions"])
+        assert row["responses"] == ",".join(map(str, user["responses"]))
+        assert row["timestamps"] == ",".join(map(str, user["timestamps"]))
+        assert row["usetimes"] == ",".join(map(str, user["usetimes"]))
+        tags = [user["concepts"][b:e] for b, e in zip(user["concept_offsets"][:-1], user["concept_offsets"][1:])]
+        assert row["concepts"] == ",".join("_".join(map(str, tag)) for tag in tags)
+
+
+def test_read_data_chunked_rejects_a_partial_user(tmp_path):
+    user_inters = make_user_inters(merged_logs(n_users=5), progress=False)
+    path = str(tmp_path / "data.txt")
+    write_txt_file(path, user_inters)
+    with open(path, "a") as fout:
+        fout.write("7,2\nq1,q2\n")
+    with pytest.raises(ValueError):
+        read_data_chunked(path, chunk_users=2)
@@ -0,0 +1,60 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from train_args import TransformerXLTrainer
+
+
+def make_trainer(tmp_path, grad_accum):
+    args = argparse.Namespace(d_embed=32, d_head=8, d_model=32, d_inner=64, mask_token=3, eos_token=2, batch_size=4, tgt_len=7,
+                              mlm_probability=0.15, mask_seed=0, mem_len=12, mem_ring=False, attn_impl='rel_shift',
+                              attn_chunk_size=128, precision='fp32', steps_per_execution=2, log_every=1, grad_accum=grad_accum,
+                              n_head=4, n_layer=2, C_vocab_size=20, Q_vocab_size=20, R_vocab_size=2, epoch=1, mode='concepts',
+                              tf_data_dir=str(tmp_path), devices='cpu', tensorboard_log_dir=str(tmp_path / 'tb'),
+                              tensorboard_emb_log_dir=str(tmp_path / 'tb_emb'), model_save_dir=str(tmp_path / 'model'))
+    trainer = TransformerXLTrainer(args)
+    # built like train_test does before the train loop
+    dummy = tf.zeros([4, 7], tf.int32)
+    trainer.model(concepts=dummy, responses=dummy, mems=tf.zeros([2, 12, 4, 32]))
+    trainer.optimizer.build(trainer.model.trainable_variables)
+    if grad_accum > 1:
+        trainer.accum_gradients = [tf.Variable(tf.zeros_like(v), trainable=False) for v in trainer.model.trainable_variables]
+    return trainer
+
+
+def test_grad_accum_applies_the_mean_gradient_of_the_micro_batches(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 5
+    concepts = rng.integers(4, 20, (n, 4, 7)).astype(np.int32)
+    responses = rng.integers(0, 2, (n, 4, 7)).astype(np.int32)
+    labels = np.where(rng.random((n, 4, 7)) < 0.3, responses, -100).astype(np.int32)
+    dataset = tf.data.Dataset.from_tensor_slices((concepts, responses, labels))
+
+    accum = make_trainer(tmp_path, grad_accum=2)
+    reference = make_trainer(tmp_path, grad_accum=1)
+    reference.model.set_weights(accum.model.get_weights())
+
+    mems, _ = accum.init_mems()
+    train_loop = accum.make_train_loop(False)
+    for chunk in dataset.batch(2):
+        mems = train_loop(*chunk, mems)['state']
+    # the micro-batch left at the end makes one smaller update
+    accum.apply_accumulated_gradients()
+
+    # mean of the gradients of 2 consecutive micro-batches (and of the last one), the mems going on through them
+    mems, gradients = None, []
+    for i, (c, r, l) in enumerate(dataset):
+        with tf.GradientTape() as tape:
+            outputs = reference.model(concepts=c, responses=r, labels=l, mems=mems)
+            masked = l != -100
+            loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=l[masked], logits=tf.reshape(outputs.logit[masked], [-1, 2])))
+        gradients.append([tf.convert_to_tensor(g) for g in tape.gradient(loss, reference.model.trainable_variables)])
+        mems = tf.stack(outputs.mems)
+        if len(gradients) == 2 or i == n - 1:
+            mean = [tf.add_n(list(g)) / len(gradients) for g in zip(*gradients)]
+            reference.optimizer.apply_gradients(zip(mean, reference.model.trainable_variables))
+            gradients = []
+
+    assert int(accum.optimizer.iterations) == int(reference.optimizer.iterations) == 3
+    for x, y in zip(accum.model.get_weights(), reference.model.get_weights()):
+        np.testing.assert_allclose(x, y, atol=1e-5)
@@ -1,8 +1,12 @@
 import os
 import pickle
+import json
 import tensorflow as tf
 import time
-from models.model_for_kt_TFlite import TFTransfoXLModel,TFTransfoXLLMHeadModel,TFTransfoXLMLMHeadModel
+# model_for_kt.py and not the model_for_kt_TFlite.py fork: user_pos, the mems ring buffer, attn_impl and the stacked
+# (n_layer, mem_len, bsz, d_model) mems input are only there
+from models.model_for_kt import TFTransfoXLModel,TFTransfoXLLMHeadModel,TFTransfoXLMLMHeadModel
+from preprocess.data_utils import dynamic_mask_dataset
 from transformers import TransfoXLConfig
 from tensorflow.keras.utils import register_keras_serializable
 from tqdm import tqdm
@@ -56,6 +60,9 @@ class TransformerXLTrainer:
         self.test_auc = tf.keras.metrics.AUC()
 
         self.args = args
+        if args.precision == 'bf16':
+            # bfloat16 compute with float32 variables, the model keeps the attention softmax, layer norms and logits in float32
+            tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
         self.config_xl = TransfoXLConfig(
             d_embed=args.d_embed,
             d_head=args.d_head,
@@ -75,13 +82,25 @@ class TransformerXLTrainer:
             tf_data_dir=args.tf_data_dir,
             tensorboard_emb_log_dir=args.tensorboard_emb_log_dir,
             tensorboard_log_dir = args.tensorboard_log_dir,
-            model_save_dir = args.model_save_dir
+            model_save_dir = args.model_save_dir,
+            mem_ring=args.mem_ring,
+            attn_impl=args.attn_impl,
+            attn_chunk_size=args.attn_chunk_size,
+            precision=args.precision
             # mlflow_tracking_uri=args.mlflow_tracking_uri
         )
         self.learning_rate = CustomSchedule(self.config_xl.d_model)
 
         self.model = TFTransfoXLMLMHeadModel(config= self.config_xl)
+        self.dataset_info = {}
         self.optimizer = tf.keras.optimizers.Adam(self.learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+        # optimizer steps skipped for inf/nan gradients with --precision bf16
+        self.skipped_steps = tf.Variable(0, trainable=False)
+        # the one ring buffer of --mem_ring, the train loop tf.function reads it without retracing
+        self.ring_mems = None
+        # gradient sums of the micro-batches of --grad_accum, made when the model is built
+        self.accum_gradients = None
+        self.accum_count = tf.Variable(0, trainable=False)
 
     
     def load_TFdataset(self) ->(tf.data.Dataset, tf.data.Dataset, dict) :
@@ -91,10 +110,39 @@ class TransformerXLTrainer:
         test_dataset = tf.data.experimental.load(tf_test_dir)
         with open(self.config_xl.tf_data_dir+"/dkeyid2idx.pkl", "rb") as file:
             dkeyid2idx = pickle.load(file) 
+        info_path = self.config_xl.tf_data_dir+"/dataset_info.json"
+        if os.path.exists(info_path):
+            with open(info_path, "r") as file:
+                dataset_info = json.loads(file.read())
+            # a lane only continues in the next batch when the batches keep the batch_size of make_Tf_data.py
+            if dataset_info.get("batch_layout") == "lanes" and dataset_info["batch_size"] != self.config_xl.batch_size:
+                raise ValueError(f"the dataset has {dataset_info['batch_size']} lanes but batch_size is {self.config_xl.batch_size}")
+            # user_pos masks the other users of a lane, with the rows layout the mems of a row are not from the same lane
+            if dataset_info.get("user_pos") and dataset_info.get("batch_layout") != "lanes":
+                raise ValueError("the dataset has user_pos with the rows batch layout, make it with make_Tf_data.py --user_pos --batch_layout lanes")
+            logging.info('dataset_info: %s', dataset_info)
+            self.dataset_info = dataset_info
         return train_dataset,test_dataset,dkeyid2idx
 
 
 
+    def init_mems(self):
+        '''
+        Zero mems of a batch and their ring buffer position, a tf.Variable written in place with --mem_ring.
+        Zeros are what init_mems of the model gives. The TFlite fork took all-ones mems as a "no mems" sentinel and replaced them
+        with these zeros, model_for_kt.py has no sentinel, so the first segment starts from the same mems as before.
+        The mems have the compute dtype of the model, bfloat16 with --precision bf16
+        '''
+        mems = tf.zeros([self.config_xl.n_layer, self.config_xl.mem_len, self.config_xl.batch_size, self.config_xl.d_model], dtype=self.model.compute_dtype)
+        if self.config_xl.mem_ring:
+            if self.ring_mems is None:
+                self.ring_mems = tf.Variable(mems, trainable=False)
+            else:
+                self.ring_mems.assign(mems)
+            return self.ring_mems, tf.constant(0)
+        return mems, None
+
+
     def make_tensorboard_summary_writer(self):
         if not os.path.exists(self.config_xl.tensorboard_log_dir):
             os.makedirs(self.config_xl.tensorboard_log_dir)     
@@ -115,9 +163,9 @@ class TransformerXLTrainer:
 #     tf.TensorSpec(shape=(4,None,None,None), dtype=tf.float32, name="mems"),
 # ])
     @tf.function
-    def train_step(self,data1,data2, target, mems) ->  (list, tf.Tensor):
+    def train_step(self,data1,data2, target, mems, user_pos=None, mem_pos=None) ->  (list, tf.Tensor):
         with tf.GradientTape() as tape:
-            outputs = self.model(concepts=data1,responses=data2, labels=target, mems=mems)    
+            outputs = self.model(concepts=data1,responses=data2, labels=target, mems=mems, user_pos=user_pos, mem_pos=mem_pos)    
             logit = outputs.logit
             mems = outputs.mems
             
@@ -136,24 +184,109 @@ class TransformerXLTrainer:
             self.train_auc(tf.one_hot(labels, depth=predictions.shape[1]), predictions)
 
         gradients = tape.gradient(mean_loss, self.model.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        if self.args.grad_accum > 1:
+            self.accumulate_gradients(gradients)
+        else:
+            self.apply_gradients(gradients)
         
+        if outputs.mem_pos is not None:
+            # the ring buffer was written in place, only its position moves
+            return {'mem_pos':outputs.mem_pos,
+                    'mean_loss':mean_loss}
         return {'mems':tf.stack(mems, axis=0),
                 'mean_loss':mean_loss}
 
 
+    def apply_gradients(self, gradients):
+        '''
+        One optimizer update, the CustomSchedule steps with it
+        '''
+        if self.args.precision == 'bf16':
+            # bfloat16 has the exponent range of float32 so the loss is not scaled, a step with inf/nan gradients is skipped instead
+            finite = tf.reduce_all([tf.reduce_all(tf.math.is_finite(g.values if isinstance(g, tf.IndexedSlices) else g)) for g in gradients])
+
+            def apply_gradients():
+                self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+                return tf.constant(True)
+
+            def skip():
+                self.skipped_steps.assign_add(1)
+                return tf.constant(False)
+
+            tf.cond(finite, apply_gradients, skip)
+        else:
+            self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+
+
+    def accumulate_gradients(self, gradients):
+        '''
+        Add the gradients of a micro-batch to self.accum_gradients, every --grad_accum micro-batches their mean is applied
+        '''
+        for accum, gradient in zip(self.accum_gradients, gradients):
+            if gradient is not None:
+                accum.assign_add(tf.convert_to_tensor(gradient))
+        self.accum_count.assign_add(1)
+        tf.cond(self.accum_count >= self.args.grad_accum, self.apply_accumulated_gradients, lambda: tf.constant(False))
+
+
+    def apply_accumulated_gradients(self):
+        '''
+        Apply the mean of the accumulated gradients and start a new accumulation
+        '''
+        count = tf.cast(self.accum_count, tf.float32)
+        self.apply_gradients([accum / count for accum in self.accum_gradients])
+        for accum in self.accum_gradients:
+            accum.assign(tf.zeros_like(accum))
+        self.accum_count.assign(0)
+        return tf.constant(True)
+
+
+    def make_train_loop(self, with_user_pos):
+        '''
+        tf.function running train_step over a chunk of (steps, batch_size, tgt_len) batches, one host round-trip per chunk.
+        The signature is fixed: the stacked (n_layer, mem_len, batch_size, d_model) mems, or the mem_pos of self.ring_mems
+        '''
+        batches = tf.TensorSpec((None, None, None), tf.int32)
+        if self.config_xl.mem_ring:
+            state = tf.TensorSpec((), tf.int32)
+        else:
+            state = tf.TensorSpec((self.config_xl.n_layer, self.config_xl.mem_len, None, self.config_xl.d_model), self.model.compute_dtype)
+
+        @tf.function(input_signature=[batches, batches, batches, state] + ([batches] if with_user_pos else []))
+        def train_loop(data1, data2, target, state, user_pos=None):
+            loss_sum = tf.constant(0.0)
+            mean_loss = tf.constant(0.0)
+            for i in tf.range(tf.shape(data1)[0]):
+                if self.config_xl.mem_ring:
+                    output = self.train_step(data1[i], data2[i], target[i], self.ring_mems, None if user_pos is None else user_pos[i], state)
+                    state = output['mem_pos']
+                else:
+                    output = self.train_step(data1[i], data2[i], target[i], state, None if user_pos is None else user_pos[i])
+                    # the stacked mems lose the static mem_len in the model
+                    state = tf.ensure_shape(output['mems'], state.shape)
+                mean_loss = output['mean_loss']
+                loss_sum += mean_loss
+            return {'state': state, 'loss_sum': loss_sum, 'mean_loss': mean_loss}
+
+        return train_loop
+
+
     def evaluate(self,test_dataset,test_summary_writer):
         total_loss = 0.0
         num_batches = 0
         # test_mems = None
-        test_mems = tf.fill([self.config_xl.n_layer, self.config_xl.mem_len, self.config_xl.batch_size, self.config_xl.d_model], 1.0) # 시그니쳐를 위한 코드변경  
+        test_mems, test_mem_pos = self.init_mems() # 시그니쳐를 위한 코드변경  
 
-        for input_data, masked_responses, responses in tqdm(test_dataset.take(2), desc='eval'):
+        for batch in tqdm(test_dataset.take(2), desc='eval'):
+            input_data, masked_responses, responses = batch[:3]
+            # tokens since the start of the user, made by make_Tf_data.py --user_pos
+            user_pos = batch[3] if len(batch) > 3 else None
             
-            outputs = self.model(concepts=input_data, responses=masked_responses, labels=responses, mems=test_mems, training=False)
+            outputs = self.model(concepts=input_data, responses=masked_responses, labels=responses, mems=test_mems, user_pos=user_pos, mem_pos=test_mem_pos, training=False)
             logit = outputs.logit
-            test_mems =outputs.mems
-            test_mems = tf.stack(test_mems, axis=0)
+            test_mem_pos = outputs.mem_pos
+            if test_mem_pos is None:
+                test_mems = tf.stack(outputs.mems, axis=0)
 
             logit_mx = responses != -100
             logit_value = logit[logit_mx]
@@ -234,29 +367,57 @@ class TransformerXLTrainer:
             
             loss_values = []
             num_batches = 0
+            if self.config_xl.mem_ring or self.args.precision == 'bf16' or self.args.grad_accum > 1:
+                # keras saves the model with the inputs of its first call, build it with tensor mems instead of the tf.Variable
+                dummy = tf.zeros([self.config_xl.batch_size, self.config_xl.tgt_len], tf.int32)
+                dummy_mems = tf.zeros([self.config_xl.n_layer, self.config_xl.mem_len, self.config_xl.batch_size, self.config_xl.d_model], dtype=self.model.compute_dtype)
+                self.model(concepts=dummy, responses=dummy, mems=dummy_mems, mem_pos=tf.constant(0) if self.config_xl.mem_ring else None)
+                # the slots of the optimizer can not be made in the tf.cond of train_step
+                self.optimizer.build(self.model.trainable_variables)
+                if self.args.grad_accum > 1:
+                    self.accum_gradients = [tf.Variable(tf.zeros_like(v), trainable=False) for v in self.model.trainable_variables]
+            train_loop = None
             for epoch in range(self.config_xl.epoch):
                 start = time.time()
                 total_loss = 0.0
-                mems= tf.fill([self.config_xl.n_layer, self.config_xl.mem_len, self.config_xl.batch_size, self.config_xl.d_model], 1.0) # 시그니쳐를 위한 코드변경  
+                mems, mem_pos = self.init_mems() # 시그니쳐를 위한 코드변경  
                 # mems =None     
-                for input_data, masked_responses, responses in tqdm(train_dataset.take(2), desc='train'):
-                    output = self.train_step(input_data,masked_responses, responses,mems)
-                    mems=output['mems']
-                    loss_value=output['mean_loss']
-                    
-                    # mems = tf.stack(mems, axis=0) # 4차원 텐서로 만들어서 넣자 리스트가 아닌
-
-                    num_batches += 1
-                    total_loss += loss_value.numpy()
-                    if num_batches % 100 == 0:
+                epoch_dataset = train_dataset
+                if self.dataset_info.get("dynamic_mask", len(train_dataset.element_spec) == 2):
+                    # saved with make_Tf_data.py --dynamic_mask: new MLM masks every epoch
+                    epoch_dataset = dynamic_mask_dataset(train_dataset, self.config_xl.mask_token, self.config_xl.eos_token,
+                                                         self.args.mlm_probability, self.args.mask_seed, epoch)
+                if train_loop is None:
+                    train_loop = self.make_train_loop(len(epoch_dataset.element_spec) > 3)
+                # --steps_per_execution batches stacked per train_loop call, the last chunk may be shorter
+                state = mem_pos if self.config_xl.mem_ring else mems
+                for chunk in tqdm(epoch_dataset.take(2).batch(self.args.steps_per_execution), desc='train'):
+                    # (tokens, masked_R, labels) and the user_pos of make_Tf_data.py --user_pos
+                    output = train_loop(*chunk[:3], state, *chunk[3:])
+                    state = output['state']
+                    loss_value = output['mean_loss']
+                    steps = int(chunk[0].shape[0])
+
+                    num_batches += steps
+                    total_loss += output['loss_sum']
+                    if num_batches // 100 > (num_batches - steps) // 100:
                         loss_values.append(loss_value.numpy())
                         print(f'Epoch {epoch + 1} Batch {num_batches} Loss {loss_value.numpy()}')
-                        
+
+                    # the metrics are read every --log_every batches
+                    if num_batches // self.args.log_every == (num_batches - steps) // self.args.log_every:
+                        continue
                     with train_summary_writer.as_default():
                         tf.summary.scalar('loss', self.train_loss.result(), step=num_batches)
+                        if self.args.precision == 'bf16':
+                            tf.summary.scalar('skipped_steps', self.skipped_steps, step=num_batches)
                         tf.summary.scalar('accuracy', self.train_accuracy.result(), step=num_batches)
                         tf.summary.scalar('auc', self.train_auc.result(), step=num_batches)
 
+                if self.args.grad_accum > 1 and self.accum_count.numpy() > 0:
+                    # the micro-batches left at the end of the epoch make one smaller update
+                    self.apply_accumulated_gradients()
+
             self.evaluate(test_dataset,test_summary_writer)
             
             # save model            
@@ -305,7 +466,16 @@ if __name__ == "__main__":
     parser.add_argument('--eos_token', type=int, required=False, default=2)
     parser.add_argument('--batch_size', type=int, required=False, default=65)
     parser.add_argument('--tgt_len', type=int, required=False, default=140)
+    parser.add_argument('--mlm_probability', type=float, required=False, default=0.15, help='MLM mask probability of a dataset made with --dynamic_mask')
+    parser.add_argument('--mask_seed', type=int, required=False, default=0, help='Seed of the dynamic MLM masks')
     parser.add_argument('--mem_len', type=int, required=False,default=600,help='Length of the retained previous heads')
+    parser.add_argument('--mem_ring', action='store_true', help='Keep the mems in a ring buffer written in place, each step only copies tgt_len steps instead of mem_len + tgt_len')
+    parser.add_argument('--attn_impl', type=str, required=False, default='rel_shift', choices=['rel_shift', 'chunked'], help='chunked: online softmax over key blocks of attn_chunk_size, the scores of the whole klen are never kept')
+    parser.add_argument('--attn_chunk_size', type=int, required=False, default=128, help='Keys per block of --attn_impl chunked')
+    parser.add_argument('--precision', type=str, required=False, default='fp32', choices=['fp32', 'bf16'], help='bf16: mixed bfloat16 compute with float32 variables, softmax, layer norms and loss, and bfloat16 mems')
+    parser.add_argument('--steps_per_execution', type=int, required=False, default=1, help='Train steps run by one tf.function call, the host reads the results once per call')
+    parser.add_argument('--log_every', type=int, required=False, default=1, help='Write the train metrics to TensorBoard every log_every batches')
+    parser.add_argument('--grad_accum', type=int, required=False, default=1, help='Micro-batches (consecutive batches, the mems go on through them) whose mean gradient makes one optimizer update')
     parser.add_argument('--n_head', type=int, required=False, default=8,help='Number of attention heads')
     parser.add_argument('--n_layer', type=int, required=False, default=4, help='Number of hidden layers in the Transformer encoder')
     parser.add_argument('--C_vocab_size', type=int, required=False, default=188,help='how many concepts')